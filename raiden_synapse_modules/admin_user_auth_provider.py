@@ -2,7 +2,11 @@ import json
 import logging
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, Optional
+
+from raiden_synapse_modules.introspection import add_status_source, cache_stats
+from raiden_synapse_modules.known_users import KnownUsersCache
+from raiden_synapse_modules.metrics import LOGINS
 
 
 class AdminUserAuthProvider:
@@ -32,24 +36,49 @@ class AdminUserAuthProvider:
         msg = "Keys 'username' and 'password' expected in credentials."
         assert "username" in self.credentials, msg
         assert "password" in self.credentials, msg
+        self.known_users = KnownUsersCache.from_config(config)
+        add_status_source("admin_user_auth_provider", self.status)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "known_users_cache": cache_stats(
+                self.known_users.hits, self.known_users.misses, len(self.known_users)
+            )
+        }
 
     async def check_password(self, user_id: str, password: str) -> bool:
         if not password:
             self.log.error("No password provided, user=%r", user_id)
+            LOGINS.labels(provider="admin", outcome="no_password").inc()
             return False
 
         username = user_id.partition(":")[0].strip("@")
         if username == self.credentials["username"] and password == self.credentials["password"]:
             self.log.info("Logging in well known admin user")
+            if user_id in self.known_users:
+                LOGINS.labels(provider="admin", outcome="success").inc()
+                return True
             user_exists = await self.account_handler.check_user_exists(user_id)
             if not user_exists:
                 self.log.info("First well known admin user login, registering: user=%r", user_id)
                 await self.account_handler._hs.get_registration_handler().register_user(
                     localpart=username, admin=True
                 )
+            self.known_users.add(user_id)
+            LOGINS.labels(
+                provider="admin", outcome="success" if user_exists else "registered"
+            ).inc()
             return True
+        LOGINS.labels(provider="admin", outcome="invalid_credentials").inc()
         return False
 
+    async def on_logged_out(  # pylint: disable=unused-argument
+        self, user_id: str, device_id: Optional[str], access_token: str
+    ) -> None:
+        """Called by Synapse for every deleted access token, also when `user_id` gets
+        deactivated or erased. Its next login checks the database again."""
+        self.known_users.invalidate(user_id)
+
     @staticmethod
     def parse_config(config: Any) -> Any:
         return config
@@ -12,17 +12,54 @@
 # user_id must be in the format: @0x<eth_address>:<homeserver>
 # password must be hex-encoded `eth_sign(<homeserver_hostname>)`
 
+# Optionally, set the number of recovered signatures to cache (default 4096, 0 disables):
+#       recovery_cache_size: 4096
+
+# To keep signature recovery off the reactor thread during login storms, run it in the
+# reactor's thread pool. At most `max_concurrent_recoveries` run at once, logins beyond
+# `max_queued_recoveries` waiting ones are rejected:
+#       recovery_in_threadpool: true
+#       max_concurrent_recoveries: 4
+#       max_queued_recoveries: 1000
+
+# Users known to exist are cached to skip the database lookup on repeated logins. Entries
+# are dropped when the user logs out or gets deactivated, and expire after
+# `known_users_cache_ttl` seconds. A size of 0 disables the cache:
+#       known_users_cache_size: 10000
+#       known_users_cache_ttl: 3600
+
+# Every claimed address may fail `login_rate_limit_burst` times, plus
+# `login_rate_limit_per_second` after that. Further logins for it wait their turn, logins
+# that would wait longer than `login_rate_limit_max_delay_seconds` are refused without
+# recovering their signature. Valid logins don't count, so junk sent for an address only
+# refuses its owner's login while the address's queue is full:
+#       login_rate_limit_per_second: 0.1
+#       login_rate_limit_burst: 5
+#       login_rate_limit_max_delay_seconds: 20
+
 import logging
 import re
 from binascii import unhexlify
-from typing import Any, Callable
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional
 
 from coincurve import PublicKey
 from Crypto.Hash import keccak
+from synapse.logging.context import defer_to_thread, make_deferred_yieldable
+from twisted.internet.defer import DeferredSemaphore
+
+from raiden_synapse_modules.introspection import add_status_source, cache_stats
+from raiden_synapse_modules.known_users import KnownUsersCache
+from raiden_synapse_modules.login_guard import LoginGuard
+from raiden_synapse_modules.metrics import LOGINS, SIGNATURE_RECOVERY_TIME
 
 __version__ = "0.1"
 logger = logging.getLogger(__name__)
 
+RECOVERY_CACHE_SIZE_DEFAULT = 4096
+MAX_CONCURRENT_RECOVERIES_DEFAULT = 4
+MAX_QUEUED_RECOVERIES_DEFAULT = 1000
+
 
 def _sha3(data: bytes) -> bytes:
     k = keccak.new(digest_bits=256)
@@ -42,9 +79,12 @@ def _eth_sign_sha3(data: bytes) -> bytes:
 
 
 def _recover(
-    data: bytes, signature: bytes, hasher: Callable[[bytes], bytes] = _eth_sign_sha3
+    data: bytes, signature: bytes, hasher: Optional[Callable[[bytes], bytes]] = _eth_sign_sha3
 ) -> bytes:
-    """Returns account address in canonical format which signed data"""
+    """Returns account address in canonical format which signed data
+
+    With `hasher=None`, `data` must already be the 32 bytes message digest.
+    """
     if len(signature) != 65:
         logger.error("invalid signature")
         return b""
@@ -73,11 +113,60 @@ class EthAuthProvider:
         self.config = config
         self.hs_hostname = self.account_handler._hs.hostname
         self.log = logging.getLogger(__name__)
+        # The signed message is always the hostname, so its digest never changes
+        self.login_digest = _eth_sign_sha3(self.hs_hostname.encode())
+        # Reconnecting clients keep sending the same signature, `cache_info()` has the
+        # hit/miss counters
+        self.recover_signer = lru_cache(
+            maxsize=int(config.get("recovery_cache_size", RECOVERY_CACHE_SIZE_DEFAULT))
+        )(self._recover_signer)
+        self.recovery_in_threadpool = bool(config.get("recovery_in_threadpool", False))
+        self.recovery_semaphore = DeferredSemaphore(
+            int(config.get("max_concurrent_recoveries", MAX_CONCURRENT_RECOVERIES_DEFAULT))
+        )
+        self.max_queued_recoveries = int(
+            config.get("max_queued_recoveries", MAX_QUEUED_RECOVERIES_DEFAULT)
+        )
+        self.known_users = KnownUsersCache.from_config(config)
+        self.login_guard = LoginGuard.from_config(config)
+        add_status_source("eth_auth_provider", self.status)
+
+    def status(self) -> Dict[str, Any]:
+        recovery = self.recover_signer.cache_info()
+        return {
+            "recovery_cache": cache_stats(recovery.hits, recovery.misses, recovery.currsize),
+            "known_users_cache": cache_stats(
+                self.known_users.hits, self.known_users.misses, len(self.known_users)
+            ),
+            "queued_recoveries": len(self.recovery_semaphore.waiting),
+        }
+
+    def _recover_signer(self, signature: bytes) -> bytes:
+        with SIGNATURE_RECOVERY_TIME.time():
+            return _recover(data=self.login_digest, signature=signature, hasher=None)
+
+    async def _recover_signer_in_threadpool(self, signature: bytes) -> Optional[bytes]:
+        """Run `recover_signer` in the reactor's thread pool, None if the queue is full."""
+        if len(self.recovery_semaphore.waiting) >= self.max_queued_recoveries:
+            return None
+        await make_deferred_yieldable(self.recovery_semaphore.acquire())
+        try:
+            return await defer_to_thread(
+                self.account_handler._hs.get_reactor(), self.recover_signer, signature
+            )
+        finally:
+            self.recovery_semaphore.release()
 
     async def check_password(self, user_id: str, password: str) -> bool:
+        outcome = await self._check_password(user_id, password)
+        LOGINS.labels(provider="eth", outcome=outcome).inc()
+        return outcome in ("success", "registered")
+
+    async def _check_password(self, user_id: str, password: str) -> str:
+        """Verify the login and return its outcome for the login metrics."""
         if not password:
             self.log.error("no password provided, user=%r", user_id)
-            return False
+            return "no_password"
 
         if not self._password_re.match(password):
             self.log.error(
@@ -85,7 +174,7 @@ class EthAuthProvider:
                 "lowercase, 65-bytes hash. user=%r",
                 user_id,
             )
-            return False
+            return "invalid_password_format"
 
         signature = unhexlify(password[2:])
 
@@ -96,26 +185,53 @@ class EthAuthProvider:
                 "lowercase address. user=%r",
                 user_id,
             )
-            return False
+            return "invalid_user_format"
 
         user_addr_hex = user_match.group(1)
         user_addr = unhexlify(user_addr_hex[2:])
 
-        rec_addr = _recover(data=self.hs_hostname.encode(), signature=signature)
+        delay = self.login_guard.reserve(user_addr_hex)
+        if delay is None:
+            self.log.error("too many failed logins, rejecting. user=%r", user_id)
+            return "rate_limited"
+        if delay > 0:
+            self.log.debug("too many failed logins, delaying by %.1fs. user=%r", delay, user_id)
+            await make_deferred_yieldable(self.account_handler._hs.get_clock().sleep(delay))
+
+        if self.recovery_in_threadpool:
+            rec_addr = await self._recover_signer_in_threadpool(signature)
+            if rec_addr is None:
+                self.login_guard.refund(user_addr_hex)
+                self.log.error("too many pending logins, rejecting. user=%r", user_id)
+                return "too_many_pending"
+        else:
+            rec_addr = self.recover_signer(signature)
         if not rec_addr or rec_addr != user_addr:
             self.log.error(
                 "invalid account password/signature. user=%r, signer=%r", user_id, rec_addr
             )
-            return False
+            return "invalid_signature"
+        self.login_guard.refund(user_addr_hex)
 
         localpart = user_id.split(":", 1)[0][1:]
         self.log.info("eth login! valid signature. user=%r", user_id)
 
-        if not (await self.account_handler.check_user_exists(user_id)):
-            self.log.info("First login, creating new user: user=%r", user_id)
-            await self.account_handler.register_user(localpart=localpart)
-
-        return True
+        outcome = "success"
+        if user_id not in self.known_users:
+            if not (await self.account_handler.check_user_exists(user_id)):
+                self.log.info("First login, creating new user: user=%r", user_id)
+                await self.account_handler.register_user(localpart=localpart)
+                outcome = "registered"
+            self.known_users.add(user_id)
+
+        return outcome
+
+    async def on_logged_out(  # pylint: disable=unused-argument
+        self, user_id: str, device_id: Optional[str], access_token: str
+    ) -> None:
+        """Called by Synapse for every deleted access token, also when `user_id` gets
+        deactivated or erased. Its next login checks the database again."""
+        self.known_users.invalidate(user_id)
 
     @staticmethod
     def parse_config(config: Any) -> Any:
@@ -1,24 +1,46 @@
+import hashlib
+import json
 import logging
 import os
+import random
+import time
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
+import treq
 from synapse.api.errors import HttpResponseException
 from synapse.handlers.auth import AuthHandler
 from synapse.http import RequestTimedOutError
+from synapse.logging.context import make_deferred_yieldable
 from synapse.module_api import run_in_background
+from twisted.internet.error import ConnectError, DNSLookupError
+from twisted.web.http_headers import Headers
+
+from raiden_synapse_modules.introspection import add_status_source
 
 # In the RSB docker environment this file gets created during docker build from the given
 # Raiden version
 PATH_KNOWN_FEDERATION_SERVERS_DEFAULT_URL = Path(
     os.environ.get("PATH_KNOWN_FEDERATION_SERVERS_DEFAULT_URL", "/known_servers.default.txt")
 )
+# First retry delay after a failed fetch, doubled on every further failure
+RETRY_INTERVAL_MIN = 30
+# How often workers that don't fetch the list themselves check the cache file for changes
+FOLLOW_INTERVAL_DEFAULT = 10
 
 
 class FederationWhitelistReloaderProvider:
     """
     Helper that peridoically fetches and updates the allowed federation domain whitelist.
 
+    The known servers list is fetched with conditional requests and only applied when its
+    content changed. Failed fetches are retried with jittered exponential backoff.
+
+    With `cache_path` configured, the last applied list is stored on disk and applied right
+    away on startup, before the first fetch finishes. In that case only the `fetch_worker`
+    (the main process by default) fetches the list, all other workers apply the cache file
+    whenever its mtime changes.
+
     Implemented as a password provider since this is a handy way to inject code into Synapse.
     """
 
@@ -33,41 +55,196 @@ class FederationWhitelistReloaderProvider:
         self.known_servers_url = os.environ.get(
             "URL_KNOWN_FEDERATION_SERVERS", known_servers_url_default
         )
-        if not self.known_servers_url:
-            raise RuntimeError("No known servers URL provided")
         self.update_interval = config.get("update_interval", 3600)
+        self.follow_interval = config.get("follow_interval", FOLLOW_INTERVAL_DEFAULT)
         self.log = logging.getLogger(__name__)
+        # Validators of the last applied response
+        self.etag: Optional[bytes] = None
+        self.last_modified: Optional[bytes] = None
+        self.content_hash: Optional[bytes] = None
+        self.applied_at: Optional[float] = None
+        self.failures = 0
+        cache_path = config.get("cache_path")
+        self.cache_path = Path(cache_path) if cache_path is not None else None
+        self.cache_mtime: Optional[int] = None
+        fetch_worker = config.get("fetch_worker")
+        self.is_fetcher = self.cache_path is None or self.hs.config.worker_name == fetch_worker
+        if self.is_fetcher and not self.known_servers_url:
+            raise RuntimeError("No known servers URL provided")
+        self._load_cache()
+        add_status_source("federation_whitelist_reloader", self.status)
         self.clock = self.hs.get_clock()
-        self.clock.call_later(0, self.run_check_and_fetch_in_background)
-        self.log.info(
-            f"Federation whitelist reloader initialized. "
-            f"Update interval: {self.update_interval}s. "
-            f"Known servers URL: {self.known_servers_url}"
-        )
+        if self.is_fetcher:
+            self.clock.call_later(0, self.run_check_and_fetch_in_background)
+            self.log.info(
+                f"Federation whitelist reloader initialized. "
+                f"Update interval: {self.update_interval}s. "
+                f"Known servers URL: {self.known_servers_url}"
+            )
+        else:
+            self.clock.call_later(self.follow_interval, self.follow_cache)
+            self.log.info(
+                f"Federation whitelist reloader initialized. "
+                f"Following {self.cache_path} every {self.follow_interval}s."
+            )
 
     @staticmethod
     def parse_config(config: Dict[str, Any]) -> Dict[str, Any]:
         return config
 
+    def status(self) -> Dict[str, Any]:
+        """The version of the applied whitelist is the SHA-256 of the known servers list."""
+        return {
+            "version": self.content_hash.hex() if self.content_hash is not None else None,
+            "applied_at": self.applied_at,
+            "domains": len(self.hs.config.federation_domain_whitelist or ()),
+            "etag": self.etag.decode() if self.etag is not None else None,
+            "last_modified": (
+                self.last_modified.decode() if self.last_modified is not None else None
+            ),
+            "is_fetcher": self.is_fetcher,
+            "failures": self.failures,
+        }
+
     def run_check_and_fetch_in_background(self) -> None:
         run_in_background(self._check_and_update_whitelist)
 
-    async def _check_and_update_whitelist(self) -> None:
+    def retry_delay(self) -> float:
+        """Jittered exponential backoff, capped at `update_interval`."""
+        delay = min(self.update_interval, RETRY_INTERVAL_MIN * 2 ** (self.failures - 1))
+        return delay * random.uniform(0.5, 1)
+
+    def _load_cache(self) -> None:
+        """Apply the whitelist stored at `cache_path`, if there is a valid one."""
+        if self.cache_path is None:
+            return
+        try:
+            self.cache_mtime = self.cache_path.stat().st_mtime_ns
+            cache = json.loads(self.cache_path.read_text())
+            body = cache["body"].encode()
+            self._apply_known_servers(body)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as ex:
+            self.log.warning(
+                f"Ignoring invalid federation whitelist cache {self.cache_path}: {ex}"
+            )
+            return
+        self.etag = cache.get("etag", "").encode() or None
+        self.last_modified = cache.get("last_modified", "").encode() or None
+        self.log.info(f"Applied cached federation whitelist from {self.cache_path}")
+
+    def follow_cache(self) -> None:
+        """Apply the cache file written by the `fetch_worker`, if it changed."""
+        assert self.cache_path is not None
+        try:
+            mtime: Optional[int] = self.cache_path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != self.cache_mtime:
+            self._load_cache()
+        self.clock.call_later(self.follow_interval, self.follow_cache)
+
+    def _save_cache(self, body: bytes) -> None:
+        """Atomically replace the whitelist cache at `cache_path`."""
+        if self.cache_path is None:
+            return
+        cache = {
+            "etag": (self.etag or b"").decode(),
+            "last_modified": (self.last_modified or b"").decode(),
+            "body": body.decode(),
+        }
+        tmp_path = self.cache_path.with_name(f".{self.cache_path.name}.tmp")
+        try:
+            tmp_path.write_text(json.dumps(cache))
+            os.replace(tmp_path, self.cache_path)
+        except OSError as ex:
+            self.log.error(f"Could not write federation whitelist cache {self.cache_path}: {ex}")
+
+    async def _fetch_known_servers(self) -> Optional[bytes]:
+        """Fetch the known servers list, None if it wasn't modified since the last fetch."""
         http_client = self.hs.get_proxied_blacklisted_http_client()
+        headers = Headers()
+        if self.etag is not None:
+            headers.addRawHeader(b"If-None-Match", self.etag)
+        if self.last_modified is not None:
+            headers.addRawHeader(b"If-Modified-Since", self.last_modified)
+        response = await http_client.request("GET", self.known_servers_url, headers=headers)
+        if response.code == 304:
+            return None
+        body = await make_deferred_yieldable(treq.content(response))
+        if not 200 <= response.code < 300:
+            raise HttpResponseException(response.code, response.phrase.decode(), body)
+        self.etag = (response.headers.getRawHeaders(b"ETag") or [None])[0]
+        self.last_modified = (response.headers.getRawHeaders(b"Last-Modified") or [None])[0]
+        return body
+
+    def _apply_known_servers(self, body: bytes) -> bool:
+        """Swap in the whitelist from a known servers response, if its content changed.
+
+        Returns whether the whitelist got replaced.
+        """
+        content_hash = hashlib.sha256(body).digest()
+        if content_hash == self.content_hash:
+            self.log.debug("Federation known servers unchanged.")
+            return False
+        known_servers = json.loads(body)
+        if not isinstance(known_servers, dict):
+            raise TypeError(f"Invalid response format from known servers URL: {known_servers}")
+        if "all_servers" not in known_servers:
+            raise ValueError(
+                f"Known servers response is missing 'all_serves' key: {known_servers}"
+            )
+        new_whitelist: List[str] = known_servers["all_servers"]
+        if not isinstance(new_whitelist, list) or not all(
+            isinstance(domain, str) for domain in new_whitelist
+        ):
+            raise TypeError(f"Invalid 'all_servers' in known servers response: {new_whitelist}")
+        old_whitelist = set(self.hs.config.federation_domain_whitelist or ())
+        self.hs.config.federation_domain_whitelist = {domain: True for domain in new_whitelist}
+        self.content_hash = content_hash
+        self.applied_at = time.time()
+        added = sorted(set(new_whitelist) - old_whitelist)
+        removed = sorted(old_whitelist - set(new_whitelist))
+        if added or removed:
+            self.log.warning(
+                "Updated federation whitelist. Added: %s, removed: %s", added, removed
+            )
+        return True
+
+    async def _check_and_update_whitelist(self) -> None:
         try:
-            known_servers = await http_client.get_json(self.known_servers_url)
-            if not isinstance(known_servers, dict):
-                raise TypeError(f"Invalid response format from known servers URL: {known_servers}")
-            if "all_servers" not in known_servers:
-                raise ValueError(
-                    f"Known servers response is missing 'all_serves' key: {known_servers}"
-                )
-            new_whitelist = known_servers["all_servers"]
-            self.hs.config.federation_domain_whitelist = {domain: True for domain in new_whitelist}
-            self.log.warning("Updated federation whitelist. New list: %s", new_whitelist)
-        except (HttpResponseException, RequestTimedOutError, TypeError, ValueError) as ex:
+            body = await self._fetch_known_servers()
+            if body is None:
+                self.log.debug("Federation known servers not modified.")
+            elif self._apply_known_servers(body):
+                self._save_cache(body)
+            self.failures = 0
+            delay = self.update_interval
+        except (
+            HttpResponseException,
+            RequestTimedOutError,
+            ConnectError,
+            DNSLookupError,
+            TypeError,
+            ValueError,
+        ) as ex:
+            delay = self._count_failure()
             self.log.error(
                 f"Error fetching federation known servers from {self.known_servers_url}: {ex}. "
-                f"Will retry later."
+                f"Will retry in {delay:.0f}s."
+            )
+        except Exception:  # pylint: disable=broad-except
+            # Whatever went wrong, the updates must go on
+            delay = self._count_failure()
+            self.log.exception(
+                f"Updating the federation whitelist failed. Will retry in {delay:.0f}s."
             )
-        self.clock.call_later(self.update_interval, self.run_check_and_fetch_in_background)
+        self.clock.call_later(delay, self.run_check_and_fetch_in_background)
+
+    def _count_failure(self) -> float:
+        """Record a failed update and return the delay until the retry."""
+        # Don't let a bad response be skipped as "not modified" on the retry
+        self.etag = self.last_modified = None
+        self.failures += 1
+        return self.retry_delay()
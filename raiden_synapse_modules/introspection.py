@@ -0,0 +1,167 @@
+"""Admin-only HTTP resource with the internal state of the raiden modules of this process.
+
+Load it as a Synapse module:
+
+    modules:
+      - module: raiden_synapse_modules.introspection.RaidenIntrospection
+        config:
+          path: /_raiden/introspection
+          max_profile_duration_seconds: 300
+
+The other modules add a status callback with `add_status_source` when they are set up,
+`GET <path>` returns the status of all of them. `<path>/profiler` controls a
+`SamplingProfiler`, see `IntrospectionResource`.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
+
+from synapse.api.errors import AuthError, SynapseError
+from synapse.config import ConfigError
+from synapse.http.server import DirectServeJsonResource, finish_request
+from synapse.http.servlet import parse_integer
+from synapse.module_api import ModuleApi
+from twisted.web.server import Request
+
+from raiden_synapse_modules.profiler import MAX_PROFILE_DURATION_DEFAULT, SamplingProfiler
+
+log = logging.getLogger(__name__)
+
+INTROSPECTION_PATH_DEFAULT = "/_raiden/introspection"
+PROFILE_DURATION_DEFAULT = 30
+SAMPLE_INTERVAL_MS_DEFAULT = 10
+
+# Status callbacks of the modules set up in this process, by module name
+STATUS_SOURCES: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def add_status_source(name: str, source: Callable[[], Dict[str, Any]]) -> None:
+    """Include `source()` under `name` in the introspection status. The callback runs on the
+    reactor thread and must return JSON serializable data."""
+    STATUS_SOURCES[name] = source
+
+
+def cache_stats(hits: int, misses: int, size: int) -> Dict[str, Any]:
+    lookups = hits + misses
+    return {
+        "size": size,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else None,
+    }
+
+
+class IntrospectionResource(DirectServeJsonResource):
+    """Serves the introspection endpoints to server admins only.
+
+    - `GET /`: status of all modules and the profiler
+    - `POST /profiler/start?duration=<seconds>&interval_ms=<ms>`: start a profile
+    - `POST /profiler/stop`: stop the running profile early
+    - `GET /profiler`: status of the profiler
+    - `GET /profiler/profile`: download the last profile in collapsed stack format
+    """
+
+    isLeaf = True
+
+    def __init__(self, module_api: ModuleApi, profiler: SamplingProfiler) -> None:
+        super().__init__()
+        self._module_api = module_api
+        self.profiler = profiler
+
+    async def _assert_admin(self, request: Request) -> None:
+        requester = await self._module_api.get_user_by_req(request)
+        if not await self._module_api._hs.get_auth().is_server_admin(requester.user):
+            raise AuthError(403, "You are not a server admin")
+
+    @staticmethod
+    def _route(request: Request) -> Tuple[str, ...]:
+        # Twisted annotates `postpath` as Optional[bytes], it's the remaining path segments
+        postpath = cast(List[bytes], request.postpath)
+        return tuple(segment.decode() for segment in postpath if segment)
+
+    def status(self) -> Dict[str, Any]:
+        modules: Dict[str, Any] = {}
+        for name, source in STATUS_SOURCES.items():
+            try:
+                modules[name] = source()
+            except Exception as ex:  # pylint: disable=broad-except
+                log.exception(f"Status of {name} failed")
+                modules[name] = {"error": str(ex)}
+        return {"time": time.time(), "modules": modules, "profiler": self.profiler.status()}
+
+    async def _async_render_GET(self, request: Request) -> Optional[Tuple[int, Any]]:
+        await self._assert_admin(request)
+        route = self._route(request)
+        if route == ():
+            return 200, self.status()
+        if route == ("profiler",):
+            return 200, self.profiler.status()
+        if route == ("profiler", "profile"):
+            if self.profiler.started_at is None:
+                raise SynapseError(404, "No profile recorded yet")
+            body = self.profiler.collapsed().encode()
+            filename = f"raiden-profile-{int(self.profiler.started_at)}.txt"
+            request.setResponseCode(200)
+            request.setHeader(b"Content-Type", b"text/plain; charset=utf-8")
+            request.setHeader(b"Content-Disposition", f"attachment; filename={filename}".encode())
+            request.setHeader(b"Content-Length", b"%d" % len(body))
+            request.write(body)
+            finish_request(request)
+            return None
+        raise SynapseError(404, "Unknown introspection endpoint")
+
+    async def _async_render_POST(self, request: Request) -> Tuple[int, Any]:
+        await self._assert_admin(request)
+        route = self._route(request)
+        if route == ("profiler", "start"):
+            duration = parse_integer(request, "duration", default=PROFILE_DURATION_DEFAULT)
+            interval_ms = parse_integer(request, "interval_ms", default=SAMPLE_INTERVAL_MS_DEFAULT)
+            if duration <= 0 or interval_ms <= 0:
+                raise SynapseError(400, "duration and interval_ms must be positive")
+            if not self.profiler.start(duration, interval_ms / 1000):
+                raise SynapseError(409, "A profile is already running")
+            return 200, self.profiler.status()
+        if route == ("profiler", "stop"):
+            if not self.profiler.stop():
+                raise SynapseError(409, "No profile is running")
+            return 200, self.profiler.status()
+        raise SynapseError(404, "Unknown introspection endpoint")
+
+
+@dataclass
+class IntrospectionConfig:
+    path: str = INTROSPECTION_PATH_DEFAULT
+    max_profile_duration: float = MAX_PROFILE_DURATION_DEFAULT
+
+
+class RaidenIntrospection:
+    """Registers the `IntrospectionResource` of this process with Synapse.
+
+    Every worker that loads the module serves the state of its own process.
+
+    Args:
+        config: A configuration object.
+        api: An instance of Synapse's ModuleApi.
+    """
+
+    def __init__(self, config: IntrospectionConfig, api: ModuleApi) -> None:
+        self.profiler = SamplingProfiler(max_duration=config.max_profile_duration)
+        self.resource = IntrospectionResource(api, self.profiler)
+        api.register_web_resource(config.path, self.resource)
+        log.info(f"Serving raiden modules introspection at {config.path}")
+
+    @staticmethod
+    def parse_config(config_dict: Dict[str, Any]) -> IntrospectionConfig:
+        path = config_dict.get("path", INTROSPECTION_PATH_DEFAULT)
+        if not isinstance(path, str) or not path.startswith("/"):
+            raise ConfigError("`path` must be an absolute URL path.")
+        try:
+            max_profile_duration = float(
+                config_dict.get("max_profile_duration_seconds", MAX_PROFILE_DURATION_DEFAULT)
+            )
+        except (TypeError, ValueError) as ex:
+            raise ConfigError("`max_profile_duration_seconds` must be a number.") from ex
+        if max_profile_duration <= 0:
+            raise ConfigError("`max_profile_duration_seconds` must be positive.")
+        return IntrospectionConfig(path=path, max_profile_duration=max_profile_duration)
@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict
+
+KNOWN_USERS_CACHE_SIZE_DEFAULT = 10000
+KNOWN_USERS_CACHE_TTL_DEFAULT = 3600
+
+
+class KnownUsersCache:
+    """Process-local set of user ids that are known to exist in the homeserver database.
+
+    Entries expire `ttl` seconds after they were added, the least recently used ones are
+    dropped beyond `max_size`. A `max_size` of 0 disables the cache.
+
+    The auth providers invalidate a user from their `on_logged_out` hook. Synapse calls it
+    for every deleted access token, which includes all tokens of a user that gets
+    deactivated or erased. That only reaches the process doing the deactivation, in other
+    workers a stale entry lives for at most `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        max_size: int = KNOWN_USERS_CACHE_SIZE_DEFAULT,
+        ttl: float = KNOWN_USERS_CACHE_TTL_DEFAULT,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expiry: "OrderedDict[str, float]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "KnownUsersCache":
+        return cls(
+            max_size=int(config.get("known_users_cache_size", KNOWN_USERS_CACHE_SIZE_DEFAULT)),
+            ttl=float(config.get("known_users_cache_ttl", KNOWN_USERS_CACHE_TTL_DEFAULT)),
+        )
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def __contains__(self, user_id: object) -> bool:
+        known = self._lookup(user_id)
+        if known:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return known
+
+    def _lookup(self, user_id: object) -> bool:
+        if not isinstance(user_id, str):
+            return False
+        expiry = self._expiry.get(user_id)
+        if expiry is None:
+            return False
+        if expiry <= time.monotonic():
+            del self._expiry[user_id]
+            return False
+        self._expiry.move_to_end(user_id)
+        return True
+
+    def add(self, user_id: str) -> None:
+        if self.max_size <= 0:
+            return
+        self._expiry[user_id] = time.monotonic() + self.ttl
+        self._expiry.move_to_end(user_id)
+        while len(self._expiry) > self.max_size:
+            self._expiry.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        """Forget `user_id`, e.g. after it got deactivated or erased."""
+        self._expiry.pop(user_id, None)
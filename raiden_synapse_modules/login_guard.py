@@ -0,0 +1,93 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from raiden_synapse_modules.metrics import LOGIN_GUARD_DELAYS, LOGIN_GUARD_REJECTIONS
+
+LOGIN_RATE_LIMIT_PER_SECOND_DEFAULT = 0.1
+LOGIN_RATE_LIMIT_BURST_DEFAULT = 5
+LOGIN_RATE_LIMIT_MAX_DELAY_DEFAULT = 20.0
+# Upper bound for the number of addresses with a token bucket
+MAX_RATE_LIMITED_ADDRESSES = 100000
+
+# (tokens, last refill)
+Bucket = Tuple[float, float]
+
+
+class LoginGuard:
+    """Caps the signature recoveries per claimed address.
+
+    Every login takes a token from the bucket of the claimed address before its signature
+    is recovered, and gets it back if the signature turns out to be valid. The bucket
+    refills at `rate` tokens per second up to `burst`, so an address can fail `burst`
+    verifications at once and `rate` per second after that.
+
+    Once an address is out of tokens, its logins wait for the next token to become due.
+    Tokens are taken in advance, so concurrent logins queue up one after another. A login
+    that would have to wait longer than `max_delay` seconds is refused without a recovery.
+    Junk sent for an address can therefore delay its owner's login, and only refuse it
+    while the queue of the address is full. Repeated identical junk doesn't need the guard,
+    the provider's recovery cache answers it without a new recovery.
+
+    A burst of 0 disables the guard.
+    """
+
+    def __init__(
+        self,
+        rate: float = LOGIN_RATE_LIMIT_PER_SECOND_DEFAULT,
+        burst: int = LOGIN_RATE_LIMIT_BURST_DEFAULT,
+        max_delay: float = LOGIN_RATE_LIMIT_MAX_DELAY_DEFAULT,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self._buckets: "OrderedDict[str, Bucket]" = OrderedDict()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "LoginGuard":
+        return cls(
+            rate=float(
+                config.get("login_rate_limit_per_second", LOGIN_RATE_LIMIT_PER_SECOND_DEFAULT)
+            ),
+            burst=int(config.get("login_rate_limit_burst", LOGIN_RATE_LIMIT_BURST_DEFAULT)),
+            max_delay=float(
+                config.get(
+                    "login_rate_limit_max_delay_seconds", LOGIN_RATE_LIMIT_MAX_DELAY_DEFAULT
+                )
+            ),
+        )
+
+    def _tokens(self, address: str, now: float) -> float:
+        tokens, last_refill = self._buckets.get(address, (self.burst, now))
+        return min(float(self.burst), tokens + (now - last_refill) * self.rate)
+
+    def reserve(self, address: str) -> Optional[float]:
+        """Take a token of `address` for verifying a login.
+
+        Returns:
+            The seconds to wait before verifying, 0 to verify right away, or None if the
+            login has to be refused.
+        """
+        if self.burst <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens = self._tokens(address, now)
+        delay = 0.0
+        if tokens < 1:
+            if self.rate <= 0 or (1 - tokens) / self.rate > self.max_delay:
+                LOGIN_GUARD_REJECTIONS.inc()
+                return None
+            delay = (1 - tokens) / self.rate
+            LOGIN_GUARD_DELAYS.inc()
+        self._buckets[address] = (tokens - 1, now)
+        self._buckets.move_to_end(address)
+        while len(self._buckets) > MAX_RATE_LIMITED_ADDRESSES:
+            self._buckets.popitem(last=False)
+        return delay
+
+    def refund(self, address: str) -> None:
+        """Give back the token of a login that was verified successfully or not at all."""
+        if address not in self._buckets:
+            return
+        tokens, last_refill = self._buckets[address]
+        self._buckets[address] = (min(float(self.burst), tokens + 1), last_refill)
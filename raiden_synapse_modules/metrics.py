@@ -0,0 +1,101 @@
+"""Prometheus metrics of the raiden synapse modules.
+
+Synapse exposes the default `prometheus_client` registry on its metrics listener, so
+everything defined here shows up there without further setup.
+"""
+from prometheus_client import Counter, Gauge, Histogram
+
+# presence router
+RPC_LATENCY = Histogram(
+    "raiden_presence_router_rpc_seconds",
+    "Latency of ethereum JSON-RPC requests",
+    ["method"],
+)
+PRESENCE_FANOUT = Histogram(
+    "raiden_presence_router_fanout_destinations",
+    "Number of service users a presence batch is routed to",
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000),
+)
+PRESENCE_PUSH_TIME = Histogram(
+    "raiden_presence_router_presence_push_seconds",
+    "Time to send all current presences to newly registered service users",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+PRESENCE_PUSH_PENDING = Gauge(
+    "raiden_presence_router_presence_push_pending_users",
+    "Service users waiting for the current presences",
+)
+PRESENCE_PUSH_USERS = Counter(
+    "raiden_presence_router_presence_push_users_total",
+    "Service users the current presences were sent to",
+)
+PRESENCE_PUSHES = Counter(
+    "raiden_presence_router_presence_pushes_total",
+    "Completed pushes of the current presences",
+)
+PRESENCE_NOOP_UPDATES = Counter(
+    "raiden_presence_router_presence_noop_updates_total",
+    "Presence updates not routed because the user's state did not change",
+)
+PRESENCE_COALESCED_BATCHES = Counter(
+    "raiden_presence_router_presence_coalesced_batches_total",
+    "Presence batches whose notification was merged into the end of the coalescing window",
+)
+REGISTERED_SERVICES = Gauge(
+    "raiden_presence_router_registered_services",
+    "Number of services with a valid registration",
+)
+NEXT_EXPIRY = Gauge(
+    "raiden_presence_router_next_expiry_timestamp",
+    "Earliest `valid_till` of all registered services",
+)
+LAST_SYNCED_BLOCK = Gauge(
+    "raiden_presence_router_last_synced_block",
+    "Number of the last block processed by the blockchain sync",
+)
+CHAIN_REORGS = Counter(
+    "raiden_presence_router_chain_reorgs_total",
+    "Chain reorganizations the registry state was rolled back for",
+)
+SYNC_LAG = Gauge(
+    "raiden_presence_router_sync_lag_seconds",
+    "Seconds since the last successful blockchain sync",
+)
+RPC_ENDPOINT_UP = Gauge(
+    "raiden_presence_router_rpc_endpoint_up",
+    "Whether an ethereum RPC endpoint of the pool is considered healthy",
+    ["endpoint"],
+)
+RPC_ENDPOINT_LATENCY = Gauge(
+    "raiden_presence_router_rpc_endpoint_latency_seconds",
+    "Moving average of the request latency of an ethereum RPC endpoint",
+    ["endpoint"],
+)
+RPC_ENDPOINT_ERRORS = Counter(
+    "raiden_presence_router_rpc_endpoint_errors_total",
+    "Failed requests to an ethereum RPC endpoint",
+    ["endpoint"],
+)
+RPC_HEDGED_REQUESTS = Counter(
+    "raiden_presence_router_rpc_hedged_requests_total",
+    "Reads sent to a second ethereum RPC endpoint because the first one was slow",
+)
+
+# auth providers
+LOGINS = Counter(
+    "raiden_auth_logins_total",
+    "Login attempts by auth provider and outcome",
+    ["provider", "outcome"],
+)
+SIGNATURE_RECOVERY_TIME = Histogram(
+    "raiden_eth_auth_signature_recovery_seconds",
+    "Time to recover the signer of a login signature (cache misses only)",
+)
+LOGIN_GUARD_DELAYS = Counter(
+    "raiden_login_guard_delayed_total",
+    "Logins delayed because their claimed address failed too many verifications",
+)
+LOGIN_GUARD_REJECTIONS = Counter(
+    "raiden_login_guard_rejected_total",
+    "Logins refused because too many logins for their claimed address were waiting",
+)
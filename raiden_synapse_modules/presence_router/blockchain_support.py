@@ -1,14 +1,53 @@
-from typing import Dict, Tuple, cast
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, List, Sequence, Tuple, cast
 
-from eth_typing import Address
-from eth_utils import to_checksum_address
+from eth_typing import URI, Address
+from eth_utils import to_checksum_address, to_hex
+from hexbytes import HexBytes
 from web3 import Web3
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.events import event_abi_to_log_topic
 from web3._utils.filters import Filter
-from web3.contract import Contract
-from web3.types import BlockIdentifier
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3._utils.request import make_post_request
+from web3.contract import Contract, ContractFunction
+from web3.providers import HTTPProvider
+from web3.types import ABI, BlockIdentifier, EventData, FilterParams, RPCEndpoint, RPCResponse
 
 from raiden_contracts.constants import CONTRACT_SERVICE_REGISTRY, EVENT_REGISTERED_SERVICE
 from raiden_contracts.contract_manager import ContractManager, contracts_precompiled_path
+from raiden_synapse_modules.metrics import RPC_LATENCY
+from raiden_synapse_modules.presence_router.constants import (
+    LOG_CHUNK_SIZE_DEFAULT,
+    LOG_PARALLELISM_DEFAULT,
+    RPC_BATCH_PARALLELISM,
+)
+from raiden_synapse_modules.presence_router.rpc_pool import RPCPool
+
+log = logging.getLogger(__name__)
+
+# Substrings of the errors nodes and providers return when an `eth_getLogs` range is too large
+LOG_RANGE_ERRORS = (
+    "range",
+    "too many",
+    "too large",
+    "more than",
+    "limit exceeded",
+    "response size",
+)
+
+
+@lru_cache(maxsize=None)
+def service_registry_abi() -> ABI:
+    """
+    ABI of ServiceRegistry.sol. Reading it parses all precompiled contracts, so this happens
+    only once per process.
+    """
+    contract_manager = ContractManager(contracts_precompiled_path())
+    return contract_manager.get_contract_abi(CONTRACT_SERVICE_REGISTRY)
 
 
 def setup_contract_from_address(service_registry_address: Address, w3: Web3) -> Contract:
@@ -16,19 +55,134 @@ def setup_contract_from_address(service_registry_address: Address, w3: Web3) ->
     Setup Contract object for the ServiceRegistry.sol contract at the given address.
     """
     service_registry: Contract
-    abi = ContractManager(contracts_precompiled_path()).get_contract_abi(CONTRACT_SERVICE_REGISTRY)
     service_registry = w3.eth.contract(
-        abi=abi, address=to_checksum_address(service_registry_address)
+        abi=service_registry_abi(), address=to_checksum_address(service_registry_address)
     )
     return service_registry
 
 
+def rpc_latency_middleware(
+    make_request: Callable[[RPCEndpoint, Any], RPCResponse], _w3: Web3
+) -> Callable[[RPCEndpoint, Any], RPCResponse]:
+    """
+    web3 middleware that records the latency of every JSON-RPC request per method.
+    """
+
+    def middleware(method: RPCEndpoint, params: Any) -> RPCResponse:
+        with RPC_LATENCY.labels(method=method).time():
+            return make_request(method, params)
+
+    return middleware
+
+
+class BatchNotSupportedError(ValueError):
+    """The node answered a JSON-RPC batch with something else than a list of responses."""
+
+
+def _post_batch(
+    post: Callable[[bytes], bytes],
+    batch: Sequence[Tuple[RPCEndpoint, Sequence[Any]]],
+    first_id: int,
+) -> List[Any]:
+    payload = [
+        {"jsonrpc": "2.0", "method": method, "params": params, "id": request_id}
+        for request_id, (method, params) in enumerate(batch, start=first_id)
+    ]
+    with RPC_LATENCY.labels(method="batch").time():
+        raw_response = post(json.dumps(payload).encode())
+    responses = json.loads(raw_response)
+    if not isinstance(responses, list):
+        raise BatchNotSupportedError(f"Batch request rejected by node: {responses}")
+    by_id = {response.get("id"): response for response in responses}
+    results = []
+    for request_id in range(first_id, first_id + len(payload)):
+        response = by_id.get(request_id)
+        if response is None:
+            raise ValueError(f"Missing response for batched request {request_id}")
+        if "error" in response:
+            raise ValueError(response["error"])
+        results.append(response["result"])
+    return results
+
+
+def make_batch_request(
+    w3: Web3, requests: Sequence[Tuple[RPCEndpoint, Sequence[Any]]], batch_size: int
+) -> List[Any]:
+    """
+    Send `requests` as JSON-RPC batches of at most `batch_size` calls each and return the
+    raw results in request order.
+
+    Up to `RPC_BATCH_PARALLELISM` batches are sent at once, so even large registries take
+    only a few round trips. Providers that can't batch (e.g. the eth_tester provider) get the
+    requests one by one.
+    """
+    provider = w3.provider
+    post: Callable[[bytes], bytes]
+    if isinstance(provider, RPCPool):
+        post = provider.post
+    elif isinstance(provider, HTTPProvider):
+        post = partial(
+            make_post_request,
+            cast(URI, provider.endpoint_uri),
+            **provider.get_request_kwargs(),
+        )
+    else:
+        return [w3.manager.request_blocking(method, params) for method, params in requests]
+
+    offsets = range(0, len(requests), batch_size)
+    if len(offsets) <= 1:
+        return _post_batch(post, requests, 0)
+    with ThreadPoolExecutor(max_workers=min(len(offsets), RPC_BATCH_PARALLELISM)) as executor:
+        futures = []
+        for offset in offsets:
+            end = offset + batch_size
+            futures.append(executor.submit(_post_batch, post, requests[offset:end], offset))
+        return [result for future in futures for result in future.result()]
+
+
+def _batch_call(
+    w3: Web3, functions: Sequence[ContractFunction], block_number: int, batch_size: int
+) -> List[Any]:
+    """
+    Run `eth_call` for all `functions` at `block_number` in batches and decode the results
+    the same way `ContractFunction.call` does.
+    """
+    requests = [
+        (
+            RPCEndpoint("eth_call"),
+            [
+                {"to": function.address, "data": function._encode_transaction_data()},
+                to_hex(block_number),
+            ],
+        )
+        for function in functions
+    ]
+    results = []
+    for function, return_data in zip(functions, make_batch_request(w3, requests, batch_size)):
+        output_types = get_abi_output_types(function.abi)
+        output_data = w3.codec.decode_abi(output_types, HexBytes(return_data))
+        normalized_data = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, output_data)
+        results.append(normalized_data[0])
+    return results
+
+
 def read_initial_services_addresses(
-    service_registry: Contract, block_identifier: BlockIdentifier = "latest"
+    service_registry: Contract,
+    block_identifier: BlockIdentifier = "latest",
+    batch_size: int = 0,
 ) -> Dict[Address, int]:
     """
     Read ethereum addresses for valid registered services from the ServiceRegistry contract.
+
+    With a positive `batch_size` all calls are pinned to a single block and sent as JSON-RPC
+    batches, which takes four round trips however many deposits there are, instead of up to
+    `3 * deposits`. Nodes that reject batches get the calls one by one.
     """
+    if batch_size > 0:
+        try:
+            return _read_services_addresses_batched(service_registry, block_identifier, batch_size)
+        except BatchNotSupportedError as ex:
+            log.warning(f"{ex}. Reading the ServiceRegistry without batching.")
     if service_registry is not None:
         services_addresses: Dict[Address, int] = {}
         for index in range(
@@ -51,12 +205,168 @@ def read_initial_services_addresses(
     return services_addresses
 
 
-def install_filters(service_registry: Contract) -> Tuple[Filter, Filter]:
+def _read_services_addresses_batched(
+    service_registry: Contract, block_identifier: BlockIdentifier, batch_size: int
+) -> Dict[Address, int]:
+    w3 = service_registry.web3
+    functions = service_registry.functions
+    block = w3.eth.get_block(block_identifier)
+
+    (deposits_len,) = _batch_call(w3, [functions.everMadeDepositsLen()], block["number"], 1)
+    addresses = _batch_call(
+        w3,
+        [functions.ever_made_deposits(index) for index in range(deposits_len)],
+        block["number"],
+        batch_size,
+    )
+    addresses = list(dict.fromkeys(address for address in addresses if address is not None))
+    # `hasValidRegistration` is `block.timestamp < service_valid_till`, so reading
+    # `service_valid_till` alone is enough
+    valid_tills = _batch_call(
+        w3,
+        [functions.service_valid_till(address) for address in addresses],
+        block["number"],
+        batch_size,
+    )
+    return {
+        address: valid_till
+        for address, valid_till in zip(addresses, valid_tills)
+        if valid_till > block["timestamp"]
+    }
+
+
+def registered_service_log_filter(service_registry: Contract) -> Dict[str, Any]:
     """
-    Install eth filters for new Block and `ServiceRegistry.sol::RegisteredService` events.
+    Raw `eth_getLogs`/`eth_subscribe` filter params for `RegisteredService` events.
+    """
+    event = getattr(service_registry.events, EVENT_REGISTERED_SERVICE)
+    return {
+        "address": service_registry.address,
+        "topics": [to_hex(event_abi_to_log_topic(event._get_event_abi()))],
+    }
+
+
+def install_block_filter(service_registry: Contract) -> Filter:
+    """Install an eth filter for new blocks."""
+    return service_registry.web3.eth.filter("latest")
+
+
+def install_event_filter(
+    service_registry: Contract, from_block: BlockIdentifier = "latest"
+) -> Filter:
+    """
+    Install an eth filter for `ServiceRegistry.sol::RegisteredService` events.
+
+    Only events from `from_block` onwards are reported, older events are fetched with
+    `LogBackfill`.
     """
-    block_filter = service_registry.web3.eth.filter("latest")
     event_filter = getattr(service_registry.events, EVENT_REGISTERED_SERVICE).createFilter(
-        fromBlock=0
+        fromBlock=from_block
+    )
+    return cast(Filter, event_filter)
+
+
+def install_filters(
+    service_registry: Contract, from_block: BlockIdentifier = "latest"
+) -> Tuple[Filter, Filter]:
+    """
+    Install eth filters for new Block and `ServiceRegistry.sol::RegisteredService` events.
+    """
+    return (
+        install_block_filter(service_registry),
+        install_event_filter(service_registry, from_block),
     )
-    return (block_filter, cast(Filter, event_filter))
+
+
+def is_log_range_error(error: Exception) -> bool:
+    """Whether a failed `eth_getLogs` call should be retried with a smaller block range."""
+    from requests.exceptions import ReadTimeout
+
+    if isinstance(error, ReadTimeout):
+        return True
+    return isinstance(error, ValueError) and any(
+        marker in str(error).lower() for marker in LOG_RANGE_ERRORS
+    )
+
+
+class LogBackfill:
+    """
+    Fetches the `RegisteredService` events of a block range with `eth_getLogs`.
+
+    The range is split into chunks of at most `chunk_size` blocks, up to `parallelism` of
+    them are requested at once. When the node rejects a range as too large, the chunk size
+    is halved and the chunk retried. It grows back after every successful round, up to the
+    configured size.
+
+    `cursor` is the first block whose events were not fetched yet. Events of finished
+    chunks are kept when a later chunk fails, so the next `fetch` resumes with the first
+    unfinished chunk instead of starting over, and still returns them. `advance` moves the
+    cursor past blocks whose events arrived otherwise, `reset` moves it back after a reorg.
+    """
+
+    def __init__(
+        self,
+        service_registry: Contract,
+        cursor: int,
+        chunk_size: int = LOG_CHUNK_SIZE_DEFAULT,
+        parallelism: int = LOG_PARALLELISM_DEFAULT,
+    ) -> None:
+        self.service_registry = service_registry
+        self.cursor = cursor
+        self.max_chunk_size = chunk_size
+        self.chunk_size = chunk_size
+        self.parallelism = parallelism
+        self._event = getattr(service_registry.events, EVENT_REGISTERED_SERVICE)()
+        self._log_filter = registered_service_log_filter(service_registry)
+        self._fetched: List[EventData] = []
+
+    def advance(self, block_number: int) -> None:
+        """Skip the blocks up to `block_number`, e.g. because a filter reported them."""
+        self.cursor = max(self.cursor, block_number + 1)
+
+    def reset(self, cursor: int) -> None:
+        """Fetch again from `cursor` on. The events kept from an unfinished `fetch` are
+        dropped, they may come from orphaned blocks."""
+        self.cursor = cursor
+        self._fetched = []
+
+    def _get_logs(self, from_block: int, to_block: int) -> List[EventData]:
+        filter_params = cast(
+            FilterParams, {**self._log_filter, "fromBlock": from_block, "toBlock": to_block}
+        )
+        logs = self.service_registry.web3.eth.get_logs(filter_params)
+        return [self._event.processLog(entry) for entry in logs]
+
+    def _next_chunks(self, to_block: int) -> List[Tuple[int, int]]:
+        chunks: List[Tuple[int, int]] = []
+        start = self.cursor
+        while start <= to_block and len(chunks) < self.parallelism:
+            end = min(to_block, start + self.chunk_size - 1)
+            chunks.append((start, end))
+            start = end + 1
+        return chunks
+
+    def fetch(self, to_block: int) -> List[EventData]:
+        """Return the events from `cursor` up to and including `to_block`, in chain order."""
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            while self.cursor <= to_block:
+                chunks = self._next_chunks(to_block)
+                futures = [executor.submit(self._get_logs, *chunk) for chunk in chunks]
+                for (start, end), future in zip(chunks, futures):
+                    try:
+                        events = future.result()
+                    except Exception as ex:  # pylint: disable=broad-except
+                        if not is_log_range_error(ex) or start == end:
+                            raise
+                        self.chunk_size = max(1, (end - start + 1) // 2)
+                        log.info(
+                            f"eth_getLogs for blocks {start}-{end} failed: {ex}. "
+                            f"Retrying with {self.chunk_size} blocks per request."
+                        )
+                        break
+                    self._fetched.extend(events)
+                    self.cursor = end + 1
+                else:
+                    self.chunk_size = min(self.max_chunk_size, self.chunk_size * 2)
+        events, self._fetched = self._fetched, []
+        return events
@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Optional, cast
+
+from eth_typing import Address
+from eth_utils import to_checksum_address
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RegistryCheckpoint:
+    """State of the ServiceRegistry as seen by the presence router at a given block."""
+
+    chain_id: int
+    service_registry_address: str
+    block_number: int
+    block_hash: str
+    registered_services: Dict[str, int]
+
+    @property
+    def services(self) -> Dict[Address, int]:
+        return {
+            cast(Address, address): valid_till
+            for address, valid_till in self.registered_services.items()
+        }
+
+    @classmethod
+    def from_services(
+        cls,
+        chain_id: int,
+        service_registry_address: str,
+        block_number: int,
+        block_hash: str,
+        registered_services: Dict[Address, int],
+    ) -> "RegistryCheckpoint":
+        return cls(
+            chain_id=chain_id,
+            service_registry_address=to_checksum_address(service_registry_address),
+            block_number=block_number,
+            block_hash=block_hash,
+            registered_services={
+                to_checksum_address(address): valid_till
+                for address, valid_till in registered_services.items()
+            },
+        )
+
+
+def load_checkpoint(path: Path) -> Optional[RegistryCheckpoint]:
+    """Load a checkpoint from `path`. Returns None if it is missing or unreadable."""
+    try:
+        data = json.loads(path.read_text())
+        checkpoint = RegistryCheckpoint(
+            chain_id=int(data["chain_id"]),
+            service_registry_address=to_checksum_address(data["service_registry_address"]),
+            block_number=int(data["block_number"]),
+            block_hash=str(data["block_hash"]),
+            registered_services={
+                to_checksum_address(address): int(valid_till)
+                for address, valid_till in data["registered_services"].items()
+            },
+        )
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError, KeyError, AttributeError) as ex:
+        log.warning(f"Ignoring unreadable registry checkpoint '{path}': {ex}")
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path: Path, checkpoint: RegistryCheckpoint) -> None:
+    """Atomically replace the checkpoint at `path`."""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(json.dumps(asdict(checkpoint)))
+    os.replace(tmp_path, path)
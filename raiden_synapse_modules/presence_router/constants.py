@@ -0,0 +1,8 @@
+# Defaults of the `eth_getLogs` backfill, see `blockchain_support.LogBackfill`. They live here
+# so the config can be parsed without importing web3.
+LOG_CHUNK_SIZE_DEFAULT = 5000
+LOG_PARALLELISM_DEFAULT = 4
+# Calls per JSON-RPC batch of the initial ServiceRegistry scan
+RPC_BATCH_SIZE_DEFAULT = 100
+# Batches of the initial scan in flight at once
+RPC_BATCH_PARALLELISM = 4
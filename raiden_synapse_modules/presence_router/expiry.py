@@ -0,0 +1,73 @@
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+from eth_typing import Address
+
+# Rebuild the heap once stale entries outnumber the live ones by this factor
+COMPACTION_FACTOR = 2
+
+
+class ExpiryIndex:
+    """Min-heap over the `valid_till` values of a `registered_services` mapping.
+
+    Renewals push a new heap entry and leave the old one in place. Entries whose
+    `valid_till` doesn't match the mapping anymore are dropped lazily when they reach
+    the top of the heap, so expiring `k` out of `n` services costs O(k log n).
+
+    The index only reads `services`, all changes go through `update`, `remove` and
+    `pop_expired(_items)`.
+    """
+
+    def __init__(self, services: Dict[Address, int]) -> None:
+        self.services = services
+        self._heap: List[Tuple[int, Address]] = []
+        self._rebuild()
+
+    def __len__(self) -> int:
+        return len(self.services)
+
+    def _rebuild(self) -> None:
+        self._heap = [(valid_till, address) for address, valid_till in self.services.items()]
+        heapq.heapify(self._heap)
+
+    def _is_stale(self, entry: Tuple[int, Address]) -> bool:
+        valid_till, address = entry
+        return self.services.get(address) != valid_till
+
+    def update(self, address: Address, valid_till: int) -> None:
+        """Register `address` as valid until `valid_till`."""
+        if self.services.get(address) == valid_till:
+            return
+        self.services[address] = valid_till
+        heapq.heappush(self._heap, (valid_till, address))
+        if len(self._heap) > COMPACTION_FACTOR * len(self.services) + 64:
+            self._rebuild()
+
+    def remove(self, address: Address) -> None:
+        """Drop `address`, its heap entries turn stale."""
+        self.services.pop(address, None)
+
+    @property
+    def next_expiry(self) -> Optional[int]:
+        """The smallest `valid_till` of all services, None if there are none."""
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def pop_expired(self, timestamp: int) -> List[Address]:
+        """Remove and return all services with `valid_till <= timestamp`."""
+        return [address for address, _ in self.pop_expired_items(timestamp)]
+
+    def pop_expired_items(self, timestamp: int) -> List[Tuple[Address, int]]:
+        """Like `pop_expired`, but returns `(address, valid_till)` pairs."""
+        expired: List[Tuple[Address, int]] = []
+        while self._heap and self._heap[0][0] <= timestamp:
+            entry = heapq.heappop(self._heap)
+            if self._is_stale(entry):
+                continue
+            valid_till, address = entry
+            del self.services[address]
+            expired.append((address, valid_till))
+        return expired
@@ -1,33 +1,95 @@
 import logging
-import threading
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Dict, Iterable, List, Literal, Optional, Set, Union, cast
+from functools import lru_cache
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 from urllib.parse import urlparse
 
 from eth_typing import Address
-from eth_utils import encode_hex, to_canonical_address, to_checksum_address
+from eth_utils import encode_hex, to_canonical_address, to_checksum_address, to_normalized_address
 from hexbytes import HexBytes
-from requests.exceptions import ReadTimeout
 from synapse.config import ConfigError
-from synapse.handlers.presence import UserPresenceState
+from synapse.logging.context import defer_to_thread
 from synapse.module_api import ModuleApi, run_in_background
-from synapse.types import UserID
-from web3 import Web3
-from web3.exceptions import BlockNotFound, ExtraDataLengthError
-
-from raiden_contracts.constants import CONTRACT_SERVICE_REGISTRY, CONTRACTS_VERSION
-from raiden_contracts.contract_manager import get_contracts_deployment_info
-from raiden_contracts.utils.type_aliases import ChainID
-from raiden_synapse_modules.presence_router.blockchain_support import (
-    install_filters,
-    read_initial_services_addresses,
-    setup_contract_from_address,
+
+from raiden_synapse_modules.introspection import add_status_source
+from raiden_synapse_modules.metrics import (
+    CHAIN_REORGS,
+    LAST_SYNCED_BLOCK,
+    NEXT_EXPIRY,
+    PRESENCE_FANOUT,
+    REGISTERED_SERVICES,
+    SYNC_LAG,
+)
+from raiden_synapse_modules.presence_router.checkpoint import (
+    RegistryCheckpoint,
+    load_checkpoint,
+    save_checkpoint,
+)
+from raiden_synapse_modules.presence_router.constants import (
+    LOG_CHUNK_SIZE_DEFAULT,
+    LOG_PARALLELISM_DEFAULT,
+    RPC_BATCH_SIZE_DEFAULT,
+)
+from raiden_synapse_modules.presence_router.expiry import ExpiryIndex
+from raiden_synapse_modules.presence_router.presence_coalesce import (
+    PRESENCE_COALESCE_WINDOW_DEFAULT,
+    CoalescedRouting,
+    PresenceCoalescer,
 )
+from raiden_synapse_modules.presence_router.presence_push import (
+    PRESENCE_PUSH_PAGE_SIZE_DEFAULT,
+    PRESENCE_PUSH_PAGES_PER_SECOND_DEFAULT,
+    PRESENCE_PUSH_WINDOW_DEFAULT,
+    PresencePusher,
+)
+from raiden_synapse_modules.presence_router.reorg import (
+    BLOCK_CONFIRMATIONS_DEFAULT,
+    ChainHistory,
+    DeepReorgError,
+)
+
+if TYPE_CHECKING:
+    # Only the chain sync owner talks to the ethereum node, web3 and raiden_contracts are
+    # imported where they are needed, so other workers start up without them
+    from synapse.handlers.presence import UserPresenceState
+    from web3 import Web3
+    from web3._utils.filters import Filter
+    from web3.types import BlockData, EventData
+
+    from raiden_synapse_modules.presence_router.subscription import RegistrySubscription
 
 log = logging.getLogger(__name__)
 
+# Upper bound for the delay between blockchain syncs while the ethereum node is failing
+MAX_SYNC_BACKOFF_SECONDS = 300
+
+# Block headers are only fetched when a service expires within this many seconds of the
+# local clock, when there are new events or when the last fetched header is older than this
+BLOCK_HEADER_MARGIN_SECONDS = 600
+
+# The registry checkpoint is written whenever the registry changes. New blocks alone only
+# move it forward this often, a restart replays the events of the blocks in between.
+CHECKPOINT_INTERVAL_SECONDS = 60
+
+# Number of registered service addresses whose local user id is memoized
+LOCAL_USER_CACHE_SIZE = 16384
+
 
 class WorkerType(Enum):
     MAIN = None
@@ -40,6 +102,30 @@ class PFSPresenceRouterConfig:
     service_registry_address: Optional[Address]
     ethereum_rpc: str
     blockchain_sync: int
+    rpc_batch_size: int = RPC_BATCH_SIZE_DEFAULT
+    registry_checkpoint_path: Optional[Path] = None
+    chain_sync_worker: Optional[str] = None
+    ethereum_ws_rpc: Optional[str] = None
+    log_chunk_size: int = LOG_CHUNK_SIZE_DEFAULT
+    log_parallelism: int = LOG_PARALLELISM_DEFAULT
+    # All configured RPC endpoints, `ethereum_rpc` is the first one
+    ethereum_rpc_endpoints: List[str] = field(default_factory=list)
+    rpc_hedge_after: float = 0
+    presence_push_window: float = PRESENCE_PUSH_WINDOW_DEFAULT
+    presence_push_page_size: int = PRESENCE_PUSH_PAGE_SIZE_DEFAULT
+    presence_push_pages_per_second: float = PRESENCE_PUSH_PAGES_PER_SECOND_DEFAULT
+    presence_coalesce_window: float = PRESENCE_COALESCE_WINDOW_DEFAULT
+    block_confirmations: int = BLOCK_CONFIRMATIONS_DEFAULT
+
+
+@dataclass
+class ChainUpdate:
+    """Everything fetched from the ethereum node in one blockchain sync."""
+
+    block: Optional["BlockData"]
+    registered_services: List["EventData"]
+    # Undo all changes made after this block before applying the update
+    rollback_to: Optional[int] = None
 
 
 class PFSPresenceRouter:
@@ -48,21 +134,40 @@ class PFSPresenceRouter:
 
     Basic flow:
         - on startup
-            - read all registered services
+            - load the registry checkpoint, or read all registered services if there is
+              no usable checkpoint
             - check for local service users
-            - send ALL presences to local service users
-        - every config.blockchain_sync_seconds
-            - check for new filter hits (RegisteredService, Block)
-        - on RegisteredService
+            - send ALL presences to local service users (see `PresencePusher`)
+        - every config.blockchain_sync_seconds (backing off while the node fails)
+            - when (re-)installing the filters, fetch the RegisteredService events since
+              the last processed block with chunked, parallel `eth_getLogs` calls
+            - fetch new filter hits (RegisteredService, Block) in a worker thread
+            - apply them on the reactor thread in a single step
+        - or, with `ethereum_ws_rpc` configured, on every `eth_subscribe` notification
+            - apply the new block header or RegisteredService event on the reactor thread
+        - on a reorg (block hash mismatch in poll mode, removed logs with `eth_subscribe`)
+            - undo the registry changes made in the orphaned blocks (see `ChainHistory`)
+            - fetch the RegisteredService events of the new blocks
+        - on RegisteredService (once it has `block_confirmations` blocks on top)
             - update registered_services
             - recompile local service users
             - send ALL presences to new service users
-        - on Block
+        - on Block (only the newest one per sync, skipped while no expiry is near)
             - check block.timestamp against next_expiry
         - on expired services
             - update registered_services
             - recompile local service users
 
+    With `registry_checkpoint_path` configured, only the `chain_sync_worker` (the main
+    process by default) talks to the ethereum node. It publishes its state through the
+    checkpoint file, all other workers apply the file whenever it changes.
+
+    With several `ethereum_rpc` endpoints, every request goes to the fastest healthy one and
+    fails over to the others on errors (see `RPCPool`).
+
+    With `presence_coalesce_window_seconds` set, unchanged presence states are dropped and
+    the service users are notified at most once per window (see `PresenceCoalescer`).
+
     Args:
         config: A configuration object.
         module_api: An instance of Synapse's ModuleApi.
@@ -72,11 +177,96 @@ class PFSPresenceRouter:
         self._module_api: ModuleApi = module_api
         self._config: PFSPresenceRouterConfig = config
 
+        self.is_chain_sync_owner = (
+            config.registry_checkpoint_path is None
+            or self._module_api._hs.config.worker_name == config.chain_sync_worker
+        )
+        self.registered_services: Dict[Address, int] = {}
+        self.last_block: Tuple[int, HexBytes] = (0, HexBytes(b""))
+        self.chain_history = ChainHistory(confirmations=config.block_confirmations)
+        self._checkpoint_mtime: Optional[int] = None
+        # Whether the registry changed since the checkpoint was saved, and when it was saved
+        self._checkpoint_dirty = False
+        self._checkpoint_saved_at = 0.0
+        if self.is_chain_sync_owner:
+            self.setup_chain_sync()
+        else:
+            checkpoint = self._read_published_checkpoint()
+            if checkpoint is not None:
+                self.registered_services = checkpoint.services
+                self.last_block = (checkpoint.block_number, HexBytes(checkpoint.block_hash))
+        self.expiry_index = ExpiryIndex(self.registered_services)
+        self._local_user_cache = lru_cache(maxsize=LOCAL_USER_CACHE_SIZE)(self._make_local_user)
+        # Fully qualified user ids of the registered services, e.g. `@0x…:example.org`
+        self.local_users: Set[str] = set()
+        self.update_local_users()
+        self.last_update = time.time()
+        SYNC_LAG.set_function(lambda: time.time() - self.last_update)
+        self._update_metrics()
+        add_status_source("presence_router", self.status)
+        self._reactor = self._module_api._hs.get_reactor()
+        self._clock = self._module_api._hs.get_clock()
+        if self.is_chain_sync_owner and config.registry_checkpoint_path is not None:
+            self._reactor.addSystemEventTrigger("before", "shutdown", self.save_checkpoint)
+        self.presence_pusher = PresencePusher(
+            self._module_api.send_local_online_presence_to,
+            self._clock,
+            window=config.presence_push_window,
+            page_size=config.presence_push_page_size,
+            pages_per_second=config.presence_push_pages_per_second,
+        )
+        if self.worker_type is WorkerType.FEDERATION_SENDER:
+            # The initial presence update only needs to be sent from within the
+            # `federation_sender` worker process
+            self.presence_pusher.schedule(self.local_users)
+        self.presence_coalescer: Optional[PresenceCoalescer] = None
+        if config.presence_coalesce_window > 0:
+            self.presence_coalescer = PresenceCoalescer(
+                self._notify_local_users, self._clock, config.presence_coalesce_window
+            )
+        self.block_filter: Optional["Filter"] = None
+        self.event_filter: Optional["Filter"] = None
+        self._sync_failures = 0
+        self._last_header_time = 0.0
+        self.subscription: Optional["RegistrySubscription"] = None
+        if self.is_chain_sync_owner and config.ethereum_ws_rpc is not None:
+            # The module, as the class is imported for type checking only
+            from raiden_synapse_modules.presence_router import subscription
+
+            self.subscription = subscription.RegistrySubscription(
+                config.ethereum_ws_rpc,
+                self.registry,
+                # Events up to and including `last_block` are already applied
+                from_block=lambda: self.last_block[0] + 1,
+                on_update=self._on_subscription_update,
+                log_chunk_size=config.log_chunk_size,
+                log_parallelism=config.log_parallelism,
+            )
+            self.subscription.start()
+            self._reactor.addSystemEventTrigger("before", "shutdown", self.subscription.stop)
+        elif self.is_chain_sync_owner:
+            self._clock.call_later(0, self._run_sync_in_background)
+        else:
+            self._clock.call_later(self._config.blockchain_sync, self.follow_checkpoint)
+        log.debug("Module setup done")
+
+    def setup_chain_sync(self) -> None:
+        """Connect to the ethereum node and load the current ServiceRegistry state."""
+        from raiden_contracts.constants import CONTRACT_SERVICE_REGISTRY, CONTRACTS_VERSION
+        from raiden_contracts.contract_manager import get_contracts_deployment_info
+        from raiden_contracts.utils.type_aliases import ChainID
+        from raiden_synapse_modules.presence_router.blockchain_support import (
+            LogBackfill,
+            read_initial_services_addresses,
+            setup_contract_from_address,
+        )
+
         self.web3 = self.setup_web3()
+        self.chain_id = ChainID(self.web3.eth.chain_id)
 
         service_registry_address = self._config.service_registry_address
         if service_registry_address is None:
-            chain_id = ChainID(self.web3.eth.chain_id)
+            chain_id = self.chain_id
             deployment_data = get_contracts_deployment_info(
                 chain_id=chain_id,
                 version=CONTRACTS_VERSION,
@@ -89,25 +279,32 @@ class PFSPresenceRouter:
             )
 
         self.registry = setup_contract_from_address(service_registry_address, self.web3)
-        self.registered_services: Dict[Address, int] = read_initial_services_addresses(
-            self.registry
-        )
-        if len(self.registered_services):
-            self.next_expiry = min(self.registered_services.values())
+        checkpoint = self.load_checkpoint()
+        if checkpoint is not None:
+            self.registered_services = checkpoint.services
+            self.last_block = (checkpoint.block_number, HexBytes(checkpoint.block_hash))
+            self.chain_history.add_block(self.web3.eth.getBlock(checkpoint.block_number))
+            log.info(f"Resuming from registry checkpoint at block {checkpoint.block_number}")
         else:
-            self.next_expiry = 0
-        self.local_users: List[UserID] = []
-        self.update_local_users()
-        if self.worker_type is WorkerType.FEDERATION_SENDER:
-            # The initial presence update only needs to be sent from within the
-            # `federation_sender` worker process
-            run_in_background(
-                self.send_current_presences_to,
-                self.local_users,
+            block = self.web3.eth.getBlock("latest")
+            self.registered_services = read_initial_services_addresses(
+                self.registry, block["number"], batch_size=self._config.rpc_batch_size
             )
-        thread = threading.Thread(target=self._check_filters, name="_check_filters")
-        thread.start()
-        log.debug("Module setup done")
+            self.last_block = (block["number"], HexBytes(block["hash"]))
+            self.chain_history.add_block(block)
+            self.save_checkpoint()
+        self.log_backfill = LogBackfill(
+            self.registry,
+            cursor=self.last_block[0] + 1,
+            chunk_size=self._config.log_chunk_size,
+            parallelism=self._config.log_parallelism,
+        )
+        # Last block of the pending backfill, set whenever the filters get (re-)installed
+        self._backfill_to: Optional[int] = None
+        # Events of a finished backfill, kept until a sync hands them over in its update
+        self._backfilled: List["EventData"] = []
+        # Subscription updates waiting for the reorg check after a reconnect, if one runs
+        self._held_updates: Optional[List[Tuple[ChainUpdate, bool]]] = None
 
     @property
     def worker_type(self) -> WorkerType:
@@ -117,6 +314,12 @@ class PFSPresenceRouter:
         except ValueError:
             return WorkerType.OTHER
 
+    @property
+    def next_expiry(self) -> int:
+        """Earliest `valid_till` of all registered services, 0 if there are none."""
+        next_expiry = self.expiry_index.next_expiry
+        return next_expiry if next_expiry is not None else 0
+
     @staticmethod
     def parse_config(config_dict: dict) -> PFSPresenceRouterConfig:
         """Parse a configuration dictionary from the homeserver config, do
@@ -133,6 +336,31 @@ class PFSPresenceRouter:
         except ValueError:
             raise ConfigError("`blockchain_sync_seconds` needs to be an integer")
 
+        try:
+            rpc_batch_size = int(config_dict.get("rpc_batch_size", RPC_BATCH_SIZE_DEFAULT))
+        except ValueError:
+            raise ConfigError("`rpc_batch_size` needs to be an integer")
+
+        try:
+            log_chunk_size = int(config_dict.get("log_chunk_size", LOG_CHUNK_SIZE_DEFAULT))
+            log_parallelism = int(config_dict.get("log_parallelism", LOG_PARALLELISM_DEFAULT))
+            if log_chunk_size < 1 or log_parallelism < 1:
+                raise ValueError()
+        except ValueError:
+            raise ConfigError(
+                "`log_chunk_size` and `log_parallelism` need to be positive integers"
+            )
+
+        registry_checkpoint_path = config_dict.get("registry_checkpoint_path")
+        if registry_checkpoint_path is not None:
+            registry_checkpoint_path = Path(registry_checkpoint_path)
+            if not registry_checkpoint_path.parent.is_dir():
+                raise ConfigError("`registry_checkpoint_path` must be in an existing directory")
+
+        chain_sync_worker = config_dict.get("chain_sync_worker")
+        if chain_sync_worker is not None and not isinstance(chain_sync_worker, str):
+            raise ConfigError("`chain_sync_worker` needs to be a worker name")
+
         service_registry_address = config_dict.get("service_registry_address")
         if service_registry_address is not None:
             try:
@@ -142,25 +370,99 @@ class PFSPresenceRouter:
             except (TypeError, ValueError):
                 raise ConfigError("`service_registry_address` is not a valid address")
 
+        ethereum_rpc = config_dict.get("ethereum_rpc")
+        ethereum_rpc_endpoints = ethereum_rpc if isinstance(ethereum_rpc, list) else [ethereum_rpc]
         try:
-            ethereum_rpc = config_dict.get("ethereum_rpc")
-            parsed_ethereum_rpc = urlparse(ethereum_rpc)
-            if not all([parsed_ethereum_rpc.scheme, parsed_ethereum_rpc.netloc]):
+            if not ethereum_rpc_endpoints:
                 raise ValueError()
-        except ValueError:
+            for endpoint in ethereum_rpc_endpoints:
+                parsed_ethereum_rpc = urlparse(endpoint)
+                if not all([parsed_ethereum_rpc.scheme, parsed_ethereum_rpc.netloc]):
+                    raise ValueError()
+        except (ValueError, AttributeError):
             raise ConfigError("`ethereum_rpc` is not properly configured")
 
+        try:
+            rpc_hedge_after = float(config_dict.get("rpc_hedge_after_seconds", 0))
+        except ValueError:
+            raise ConfigError("`rpc_hedge_after_seconds` needs to be a number")
+
+        try:
+            presence_push_window = float(
+                config_dict.get("presence_push_window_seconds", PRESENCE_PUSH_WINDOW_DEFAULT)
+            )
+            presence_push_page_size = int(
+                config_dict.get("presence_push_page_size", PRESENCE_PUSH_PAGE_SIZE_DEFAULT)
+            )
+            presence_push_pages_per_second = float(
+                config_dict.get(
+                    "presence_push_pages_per_second", PRESENCE_PUSH_PAGES_PER_SECOND_DEFAULT
+                )
+            )
+            if presence_push_page_size < 1:
+                raise ValueError()
+        except ValueError:
+            raise ConfigError(
+                "`presence_push_window_seconds`, `presence_push_page_size` and "
+                "`presence_push_pages_per_second` need to be numbers, the page size positive"
+            )
+
+        try:
+            presence_coalesce_window = float(
+                config_dict.get(
+                    "presence_coalesce_window_seconds", PRESENCE_COALESCE_WINDOW_DEFAULT
+                )
+            )
+        except ValueError:
+            raise ConfigError("`presence_coalesce_window_seconds` needs to be a number")
+
+        try:
+            block_confirmations = int(
+                config_dict.get("block_confirmations", BLOCK_CONFIRMATIONS_DEFAULT)
+            )
+            if block_confirmations < 0:
+                raise ValueError()
+        except ValueError:
+            raise ConfigError("`block_confirmations` needs to be a non-negative integer")
+
+        ethereum_ws_rpc = config_dict.get("ethereum_ws_rpc")
+        if ethereum_ws_rpc is not None:
+            parsed_ethereum_ws_rpc = urlparse(str(ethereum_ws_rpc))
+            if parsed_ethereum_ws_rpc.scheme not in ("ws", "wss") or not (
+                parsed_ethereum_ws_rpc.netloc
+            ):
+                raise ConfigError("`ethereum_ws_rpc` needs to be a ws:// or wss:// URL")
+
         return PFSPresenceRouterConfig(
-            service_registry_address, ethereum_rpc, blockchain_sync  # type: ignore
+            service_registry_address,
+            ethereum_rpc_endpoints[0],
+            blockchain_sync,
+            rpc_batch_size,
+            registry_checkpoint_path,
+            chain_sync_worker,
+            ethereum_ws_rpc,
+            log_chunk_size,
+            log_parallelism,
+            ethereum_rpc_endpoints,
+            rpc_hedge_after,
+            presence_push_window,
+            presence_push_page_size,
+            presence_push_pages_per_second,
+            presence_coalesce_window,
+            block_confirmations,
         )
 
     async def get_users_for_states(
         self,
-        state_updates: Iterable[UserPresenceState],
-    ) -> Dict[str, Set[UserPresenceState]]:
+        state_updates: Iterable["UserPresenceState"],
+    ) -> Dict[str, FrozenSet["UserPresenceState"]]:
         """Given an iterable of user presence updates, determine where each one
         needs to go.
 
+        All local service users receive the same updates, so they share a single
+        immutable set. Only the last update per user_id within the batch is kept.
+        With a `PresenceCoalescer`, the result only lists the service users to notify now.
+
         Args:
             state_updates: An iterable of user presence state updates.
 
@@ -168,10 +470,17 @@ class PFSPresenceRouter:
           A dictionary of user_id -> set of UserPresenceState that the user should
           receive.
         """
-        destination_users: Dict[str, Set[UserPresenceState]] = {}
-        for user in self.local_users:
-            destination_users[user] = set(state_updates)
-        return destination_users
+        PRESENCE_FANOUT.observe(len(self.local_users))
+        if not self.local_users:
+            return {}
+        newest_states = {state.user_id: state for state in state_updates}
+        shared_states = frozenset(newest_states.values())
+        if self.presence_coalescer is None:
+            return dict.fromkeys(self.local_users, shared_states)
+        notify_now = self.presence_coalescer.notify_now(newest_states.values())
+        return CoalescedRouting(
+            self.local_users if notify_now else (), shared_states, self.local_users
+        )
 
     async def get_interested_users(self, user_id: str) -> Union[Set[str], Literal["ALL"]]:
         """
@@ -194,9 +503,43 @@ class PFSPresenceRouter:
             return "ALL"
         return set()
 
-    def setup_web3(self) -> Web3:
-        provider = Web3.HTTPProvider(self._config.ethereum_rpc)
+    def _notify_local_users(self) -> None:
+        """Wake up the syncs of the service users to read the coalesced presence.
+
+        The `ModuleApi` of Synapse 1.37 has no way to wake up a sync without sending
+        presence: `send_local_online_presence_to` pushes the presence of every online user.
+        This uses the notifier and datastore of the homeserver instead, which is why
+        `matrix-synapse` is pinned to an exact version. `test_notify_local_users` checks the
+        internals it relies on.
+        """
+        if not self.local_users:
+            return
+        hs = self._module_api._hs
+        hs.get_notifier().on_new_event(
+            "presence_key",
+            hs.get_datastore().get_current_presence_token(),
+            users=list(self.local_users),
+        )
+
+    def setup_web3(self) -> "Web3":
+        from web3 import Web3
+        from web3.exceptions import ExtraDataLengthError
+        from web3.providers.base import BaseProvider
+
+        from raiden_synapse_modules.presence_router.blockchain_support import (
+            rpc_latency_middleware,
+        )
+        from raiden_synapse_modules.presence_router.rpc_pool import RPCPool
+
+        provider: BaseProvider
+        if len(self._config.ethereum_rpc_endpoints) > 1:
+            provider = RPCPool(
+                self._config.ethereum_rpc_endpoints, hedge_after=self._config.rpc_hedge_after
+            )
+        else:
+            provider = Web3.HTTPProvider(self._config.ethereum_rpc)
         web3 = Web3(provider)
+        web3.middleware_onion.add(rpc_latency_middleware, "rpc_latency")
         try:
             web3.eth.getBlock("latest")
         except ExtraDataLengthError:
@@ -205,118 +548,455 @@ class PFSPresenceRouter:
             web3.middleware_onion.inject(geth_poa_middleware, layer=0)
         return web3
 
+    def load_checkpoint(self) -> Optional[RegistryCheckpoint]:
+        """Load the registry checkpoint, if it belongs to this chain and registry and its
+        block is still part of the canonical chain."""
+        from web3.exceptions import BlockNotFound
+
+        path = self._config.registry_checkpoint_path
+        if path is None:
+            return None
+        checkpoint = load_checkpoint(path)
+        if checkpoint is None:
+            return None
+        if checkpoint.chain_id != self.chain_id:
+            log.warning(f"Registry checkpoint is for chain {checkpoint.chain_id}, rescanning.")
+            return None
+        if checkpoint.service_registry_address != self.registry.address:
+            log.warning("Registry checkpoint is for a different ServiceRegistry, rescanning.")
+            return None
+        try:
+            block = self.web3.eth.getBlock(checkpoint.block_number)
+        except BlockNotFound:
+            block = None
+        if block is None or HexBytes(block["hash"]) != HexBytes(checkpoint.block_hash):
+            log.warning(
+                f"Registry checkpoint block {checkpoint.block_number} is not part of the "
+                f"canonical chain anymore, rescanning."
+            )
+            return None
+        return checkpoint
+
+    def save_checkpoint(self) -> None:
+        """Store `self.registered_services` together with the last processed block."""
+        path = self._config.registry_checkpoint_path
+        if path is None:
+            return
+        block_number, block_hash = self.last_block
+        checkpoint = RegistryCheckpoint.from_services(
+            chain_id=self.chain_id,
+            service_registry_address=self.registry.address,
+            block_number=block_number,
+            block_hash=encode_hex(block_hash),
+            registered_services=self.registered_services,
+        )
+        try:
+            save_checkpoint(path, checkpoint)
+        except OSError as ex:
+            log.error(f"Could not write registry checkpoint '{path}': {ex}")
+            return
+        self._checkpoint_dirty = False
+        self._checkpoint_saved_at = time.time()
+
+    def _save_checkpoint_if_due(self) -> None:
+        """Save the checkpoint if the registry changed, otherwise only every
+        `CHECKPOINT_INTERVAL_SECONDS` while new blocks come in.
+
+        Followers learn about registry changes from the checkpoint, so those are published
+        right away. The block number alone only limits the replay after a restart.
+        """
+        if self._checkpoint_dirty or (
+            time.time() - self._checkpoint_saved_at >= CHECKPOINT_INTERVAL_SECONDS
+        ):
+            self.save_checkpoint()
+
+    def _read_published_checkpoint(self) -> Optional[RegistryCheckpoint]:
+        """Read the checkpoint of the chain sync owner, None if it didn't change."""
+        path = self._config.registry_checkpoint_path
+        assert path is not None
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            return None
+        if mtime == self._checkpoint_mtime:
+            return None
+        self._checkpoint_mtime = mtime
+        return load_checkpoint(path)
+
+    def follow_checkpoint(self) -> None:
+        """Apply the registry state published by the chain sync owner, if it changed."""
+        checkpoint = self._read_published_checkpoint()
+        if checkpoint is not None:
+            services = checkpoint.services
+            for address in [
+                address for address in self.registered_services if address not in services
+            ]:
+                self.remove_service(address)
+            for address, valid_till in services.items():
+                self.on_registered_service(address, valid_till)
+            self.last_block = (checkpoint.block_number, HexBytes(checkpoint.block_hash))
+            self.last_update = time.time()
+            self._update_metrics()
+        self._clock.call_later(self._config.blockchain_sync, self.follow_checkpoint)
+
     def _setup_filters(self) -> None:
-        block_filter, event_filter = install_filters(self.registry)
-        self.block_filter = block_filter
-        self.event_filter = event_filter
+        """Install the missing filters and schedule a backfill up to the current block.
 
-    def _check_filters(self) -> None:
-        self._setup_filters()
+        The filters only report new events, the backfill fetches the older ones. It resumes
+        where it stopped, but never before `last_block`, whose events are already part of
+        `registered_services`. The head is read after installing the filters, so no block
+        falls in between. Events that both report arrive in the same update and are applied
+        once, as `chain_history.pending` is keyed by log.
+        """
+        from raiden_synapse_modules.presence_router.blockchain_support import (
+            install_block_filter,
+            install_event_filter,
+        )
 
-        while True:
-            try:
-                self._check_filters_once()
-                time.sleep(self._config.blockchain_sync)
+        if self.block_filter is None:
+            self.block_filter = install_block_filter(self.registry)
+        if self.event_filter is None:
+            self.event_filter = install_event_filter(self.registry)
+        self.log_backfill.advance(self.last_block[0])
+        self._backfill_to = self.web3.eth.block_number
 
-            except ValueError as err:
-                if "filter not found" in str(err):
-                    log.info("Filter got dropped by node. Renewing them.")
-                    self._check_filters()
+    def _run_sync_in_background(self) -> None:
+        run_in_background(self._sync)
 
-                else:
-                    raise err
+    async def _sync(self) -> None:
+        """Fetch and apply one blockchain sync, then schedule the next one.
+
+        All RPC calls run in the reactor's thread pool. The state changes are applied on the
+        reactor thread without yielding, so presence routing never sees half-updated state.
+        """
+        update: Optional[ChainUpdate] = None
+        try:
+            update = await defer_to_thread(self._reactor, self._poll_chain, self.next_expiry)
+        except ValueError as err:
+            if "filter not found" in str(err):
+                log.info("Filter got dropped by node. Renewing them.")
+                self.block_filter = None
+                self.event_filter = None
+            else:
+                log.error(f"Blockchain sync failed: {err}")
+        except Exception as ex:  # pylint: disable=broad-except
+            log.error(f"Blockchain sync failed: {ex}")
+
+        if update is not None:
+            self._apply_chain_update(update)
+            self._sync_failures = 0
+            delay = self._config.blockchain_sync
+        else:
+            self._sync_failures += 1
+            delay = min(
+                self._config.blockchain_sync * 2 ** self._sync_failures,
+                max(self._config.blockchain_sync, MAX_SYNC_BACKOFF_SECONDS),
+            )
+            log.info(f"Retrying blockchain sync in {delay} seconds")
+        self._clock.call_later(delay, self._run_sync_in_background)
+
+    def _poll_chain(self, next_expiry: int) -> Optional[ChainUpdate]:
+        """Blocking part of a blockchain sync, (re-)installs the filters if necessary.
+
+        A pending backfill is finished first. If it fails, the next sync retries it from
+        the first block that wasn't fetched yet. Its events are kept until they are returned,
+        so they aren't lost when polling the filters fails afterwards.
+        """
+        if self.block_filter is None or self.event_filter is None:
+            self._setup_filters()
+        if self._backfill_to is not None:
+            self._backfilled.extend(self.log_backfill.fetch(self._backfill_to))
+            self._backfill_to = None
+        update = self._fetch_chain_update(next_expiry)
+        if update is None:
+            if not self._backfilled:
+                return None
+            update = ChainUpdate(block=None, registered_services=[])
+        update.registered_services = self._backfilled + update.registered_services
+        if update.block is not None and (self.chain_history.changes or self.chain_history.pending):
+            self._check_reorg(update)
+        self._backfilled = []
+        return update
+
+    def _check_reorg(self, update: ChainUpdate) -> None:
+        """Turn `update` into a rollback to the fork point if its block doesn't descend from
+        the last recorded one, with the events since the fork point fetched again."""
+        assert update.block is not None
+        try:
+            fork = self.chain_history.find_fork(
+                update.block, canonical_hash=lambda number: self.web3.eth.getBlock(number)["hash"]
+            )
+        except DeepReorgError as ex:
+            log.error(f"{ex}. Rolling back all recorded blocks, restart to rescan the registry.")
+            fork = self.chain_history.blocks[0].number - 1
+        if fork is None:
+            return
+        log.warning(f"Chain reorganization, rolling back to block {fork}")
+        block_number = update.block["number"]
+        # If fetching fails, the next sync resumes the backfill and finds the fork again
+        self.log_backfill.reset(fork + 1)
+        self._backfill_to = block_number
+        events = self.log_backfill.fetch(block_number)
+        self._backfill_to = None
+        update.registered_services = events + [
+            event
+            for event in update.registered_services
+            if not fork < event["blockNumber"] <= block_number
+        ]
+        update.rollback_to = fork
 
     def _check_filters_once(self) -> None:
+        update = self._poll_chain(self.next_expiry)
+        if update is not None:
+            self._apply_chain_update(update)
+
+    def _needs_block_header(self, next_expiry: int, has_events: bool) -> bool:
+        """Whether the newest block header is needed to process this sync.
+
+        The header provides the timestamp for service expiry and the block number for the
+        registry checkpoint. While no service is about to expire and nothing changed, the
+        local clock is good enough to skip it.
+        """
+        now = time.time()
+        return (
+            has_events
+            or next_expiry <= now + BLOCK_HEADER_MARGIN_SECONDS
+            or self._last_header_time <= now - BLOCK_HEADER_MARGIN_SECONDS
+        )
+
+    def _fetch_chain_update(self, next_expiry: int) -> Optional[ChainUpdate]:
+        from requests.exceptions import ReadTimeout
+        from web3.exceptions import BlockNotFound
+
         log.debug("Checking filters.")
+        assert self.block_filter is not None and self.event_filter is not None
         start = time.time()
         try:
             receipts = self.block_filter.get_new_entries()
-            log.info(f"Got new block entries in {time.time() - start} seconds")
             registered_services = self.event_filter.get_new_entries()
-            log.info(f"Got new event entries in {time.time() - start} seconds")
+            block: Optional["BlockData"] = None
+            # Only the newest block matters, expiry is monotonic in the block timestamp
+            has_events = bool(registered_services or self.chain_history.pending)
+            if receipts and self._needs_block_header(next_expiry, has_events):
+                blockhash = cast(HexBytes, receipts[-1])
+                try:
+                    block = self.web3.eth.getBlock(blockhash)
+                    self._last_header_time = time.time()
+                except BlockNotFound:
+                    log.debug(f"Block {encode_hex(blockhash)} not found.")
         except ReadTimeout:
             log.error(
                 f"Connection error: check_filters timeout after {time.time() - start} seconds"
             )
-            return
+            return None
+        return ChainUpdate(
+            block=block, registered_services=cast(List["EventData"], registered_services)
+        )
+
+    def _on_subscription_update(
+        self,
+        block: Optional["BlockData"],
+        registered_services: List["EventData"],
+        orphaned_block: Optional[int] = None,
+        reconnected: bool = False,
+    ) -> None:
+        """Called from the subscription thread, hands the update to the reactor thread."""
+        update = ChainUpdate(
+            block=block,
+            registered_services=registered_services,
+            rollback_to=None if orphaned_block is None else orphaned_block - 1,
+        )
+        self._reactor.callFromThread(self._apply_subscription_update, update, reconnected)
 
-        for receipt in receipts:
-            blockhash = cast(HexBytes, receipt)
-            self.on_new_block(blockhash)
-        for registered_service in registered_services:
-            self.on_registered_service(
-                registered_service.args.service,  # type: ignore
-                registered_service.args.valid_till,  # type: ignore
+    def _apply_subscription_update(self, update: ChainUpdate, reconnected: bool) -> None:
+        """Apply the updates of the subscription in the order they arrive.
+
+        The first head after a (re)connect can follow a gap, in which a reorg may have
+        happened without the node reporting the removed logs. Like in a blockchain sync, the
+        recorded blocks are then checked against the canonical chain in the thread pool, and
+        the updates arriving meanwhile wait for it.
+        """
+        if self._held_updates is not None:
+            self._held_updates.append((update, reconnected))
+        elif reconnected and update.block is not None and self.chain_history.head is not None:
+            self._held_updates = []
+            run_in_background(self._check_reorg_and_apply, update)
+        else:
+            self._apply_chain_update(update)
+
+    async def _check_reorg_and_apply(self, update: ChainUpdate) -> None:
+        try:
+            await defer_to_thread(self._reactor, self._check_reorg, update)
+        except Exception as ex:  # pylint: disable=broad-except
+            log.error(f"Checking for a chain reorganization after reconnecting failed: {ex}")
+        held, self._held_updates = self._held_updates or [], None
+        self._apply_chain_update(update)
+        for held_update, reconnected in held:
+            self._apply_subscription_update(held_update, reconnected)
+
+    def _apply_chain_update(self, update: ChainUpdate) -> None:
+        if update.rollback_to is not None:
+            self.roll_back(update.rollback_to)
+        if update.block is not None:
+            self.on_new_block(update.block)
+        self.chain_history.add_events(update.registered_services)
+        for registered_service in self.chain_history.pop_confirmed():
+            service_address = registered_service.args.service  # type: ignore
+            valid_till = registered_service.args.valid_till  # type: ignore
+            self.chain_history.record(
+                registered_service["blockNumber"],
+                service_address,
+                self.registered_services.get(service_address),
+                valid_till,
             )
+            self.on_registered_service(service_address, valid_till)
+        self._advance_log_backfill(update)
+        confirmed = self.chain_history.confirmed_block()
+        if confirmed is not None:
+            if confirmed.number > self.last_block[0]:
+                self.last_block = (confirmed.number, confirmed.hash)
+            if confirmed.timestamp > self.next_expiry:
+                for address, valid_till in self.expire_services(confirmed.timestamp):
+                    self.chain_history.record(confirmed.number, address, valid_till, None)
+        if (
+            update.block is not None
+            or update.registered_services
+            or update.rollback_to is not None
+        ):
+            self._save_checkpoint_if_due()
         self.last_update = time.time()
-        log.info(f"Filters checked in {time.time() - start} seconds")
-
-    async def send_current_presences_to(self, users: List[UserID]) -> None:
-        """Send all presences to users."""
-        start = time.time()
-        log.debug(f"Sending presences to {len(users)} users")
-        await self._module_api.send_local_online_presence_to(users)
-        log.info(f"Presences updated in {time.time() - start} seconds")
+        self._update_metrics()
+
+    def _advance_log_backfill(self, update: ChainUpdate) -> None:
+        """Move the backfill past the blocks of `update`, so renewed filters don't fetch and
+        apply their events again. The event filter is polled after the block filter, so it
+        reported all events up to the new block."""
+        for event in update.registered_services:
+            self.log_backfill.advance(event["blockNumber"])
+        if update.block is not None:
+            self.log_backfill.advance(update.block["number"])
+
+    def status(self) -> Dict[str, Any]:
+        """Registry snapshot and sync state for the introspection resource."""
+        return {
+            "chain_sync_owner": self.is_chain_sync_owner,
+            "registered_services": {
+                to_checksum_address(address): valid_till
+                for address, valid_till in self.registered_services.items()
+            },
+            "next_expiry": self.next_expiry,
+            "last_block": {"number": self.last_block[0], "hash": encode_hex(self.last_block[1])},
+            "sync_lag_seconds": time.time() - self.last_update,
+            "pending_events": len(self.chain_history.pending),
+            "local_users": len(self.local_users),
+        }
+
+    def _update_metrics(self) -> None:
+        REGISTERED_SERVICES.set(len(self.registered_services))
+        NEXT_EXPIRY.set(self.next_expiry)
+        LAST_SYNCED_BLOCK.set(self.last_block[0])
 
     def on_registered_service(self, service_address: Address, expiry: int) -> None:
         """Called, when there is a new RegisteredService event on the blockchain."""
         # service_address is already known, update the expiry
         log.debug("New registered service {to_checksum_address(service_address)}")
+        self._checkpoint_dirty = True
         if service_address in self.registered_services:
-            self.registered_services[service_address] = expiry
+            self.expiry_index.update(service_address, expiry)
         # new service, add and send current presences
         else:
-            self.registered_services[service_address] = expiry
+            self.expiry_index.update(service_address, expiry)
             local_user = self.to_local_user(service_address)
             if local_user is not None:
-                self.local_users.append(local_user)
+                self.local_users.add(local_user)
                 if self.worker_type is WorkerType.FEDERATION_SENDER:
                     # The initial presence update only needs to be sent from within the
                     # `federation_sender` worker process
-                    run_in_background(
-                        self.send_current_presences_to,
-                        [local_user],
-                    )
-        if len(self.registered_services):
-            self.next_expiry = min(self.registered_services.values())
-
-    def on_new_block(self, blockhash: HexBytes) -> None:
-        """Called, when there is a new Block on the blockchain."""
-        log.debug(f"New block {encode_hex(blockhash)}.")
-        start = time.time()
+                    self.presence_pusher.schedule([local_user])
+
+    def on_new_block(self, block: "BlockData") -> None:
+        """Called, when there is a new Block on the blockchain.
+
+        Expiries and `last_block` only follow blocks with enough confirmations, see
+        `_apply_chain_update`.
+        """
+        log.debug(f"New block {encode_hex(block['hash'])}.")
         try:
-            timestamp: int = self.web3.eth.getBlock(blockhash)["timestamp"]
-            log.info(f"getBlock finished in {time.time() - start} seconds")
-            if timestamp > self.next_expiry:
-                self.expire_services(timestamp)
-                if len(self.registered_services):
-                    self.next_expiry = min(self.registered_services.values())
-        except BlockNotFound:
-            log.error(f"getBlock failed after {time.time() - start} seconds")
-            log.debug(f"Block {encode_hex(blockhash)} not found.")
-
-    def expire_services(self, timestamp: int) -> None:
-        registered_services: Dict[Address, int] = {}
-        for address, expiry in self.registered_services.items():
-            if expiry > timestamp:
-                registered_services[address] = expiry
-        self.registered_services = registered_services
-        self.update_local_users()
+            fork = self.chain_history.find_fork(block)
+        except DeepReorgError as ex:
+            log.error(f"{ex}. Rolling back all recorded blocks, restart to rescan the registry.")
+            fork = block["number"] - 1
+        if fork is not None:
+            self.roll_back(fork)
+        self.chain_history.add_block(block)
+
+    def roll_back(self, block_number: int) -> None:
+        """Undo the registry changes made in the blocks after `block_number`."""
+        updates = self.chain_history.roll_back(block_number)
+        if self.log_backfill.cursor > block_number + 1:
+            self.log_backfill.reset(block_number + 1)
+        self._backfilled = [
+            event for event in self._backfilled if event["blockNumber"] <= block_number
+        ]
+        # The checkpoint must not keep pointing to an orphaned block
+        self._checkpoint_dirty = True
+        for address, valid_till in updates:
+            if valid_till is None:
+                self.remove_service(address)
+            else:
+                self.on_registered_service(address, valid_till)
+        if self.last_block[0] > block_number:
+            fork = self.chain_history.head
+            if fork is not None:
+                self.last_block = (fork.number, fork.hash)
+            else:
+                self.last_block = (block_number, HexBytes(b""))
+        CHAIN_REORGS.inc()
+        log.info(f"Rolled back after block {block_number} with {len(updates)} registry updates")
+
+    def remove_service(self, service_address: Address) -> None:
+        """Drop a service and its local user, e.g. when its registration got orphaned."""
+        self._checkpoint_dirty = True
+        self.expiry_index.remove(service_address)
+        local_user = self.to_local_user(service_address)
+        if local_user is not None:
+            self.local_users.discard(local_user)
+
+    def expire_services(self, timestamp: int) -> List[Tuple[Address, int]]:
+        """Drop all services with `valid_till <= timestamp` and their local users.
+
+        Returns:
+            The expired services with their `valid_till`.
+        """
+        expired = self.expiry_index.pop_expired_items(timestamp)
+        if not expired:
+            return expired
+        self._checkpoint_dirty = True
+        for address, _ in expired:
+            local_user = self.to_local_user(address)
+            if local_user is not None:
+                self.local_users.discard(local_user)
+        log.debug(f"{len(expired)} services expired.")
+        return expired
 
     def update_local_users(self) -> None:
-        """Probe all `self.registered_services` addresses for a local UserID and update
+        """Probe all `self.registered_services` addresses for a local user id and update
         `self.local_users` accordingly.
         """
-        local_users: List[UserID] = []
+        local_users: Set[str] = set()
         for address in self.registered_services.keys():
             candidate = self.to_local_user(address)
             if candidate is not None:
-                local_users.append(candidate)
+                local_users.add(candidate)
         log.debug(f"Now {len(local_users)} users registered for presence updates.")
         self.local_users = local_users
 
-    def to_local_user(self, address: Address) -> Optional[UserID]:
-        """Create a UserID for a local user from a registered service address."""
-        log.debug(f"Creating UserID for address {to_checksum_address(address)}")
-        user_id = self._module_api.get_qualified_user_id(str(to_checksum_address(address)).lower())
-        return user_id
+    def to_local_user(self, address: Address) -> Optional[str]:
+        """Return the user id string of a local user for a registered service address."""
+        return self._local_user_cache(to_canonical_address(address))
+
+    def _make_local_user(self, address: bytes) -> str:
+        # The lowercase hex address is the localpart, no checksumming (keccak) required
+        localpart = to_normalized_address(address)
+        log.debug(f"Creating UserID for address {localpart}")
+        return str(self._module_api.get_qualified_user_id(localpart))
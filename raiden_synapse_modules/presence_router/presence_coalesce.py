@@ -0,0 +1,124 @@
+import logging
+from collections import OrderedDict
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from raiden_synapse_modules.metrics import PRESENCE_COALESCED_BATCHES, PRESENCE_NOOP_UPDATES
+
+if TYPE_CHECKING:
+    from synapse.handlers.presence import UserPresenceState
+
+log = logging.getLogger(__name__)
+
+PRESENCE_COALESCE_WINDOW_DEFAULT = 0.0
+# Upper bound for the number of users whose last state is remembered
+MAX_REMEMBERED_STATES = 100000
+
+# (state, status_msg)
+StateKey = Tuple[str, Optional[str]]
+
+
+class CoalescedRouting(Dict[str, FrozenSet["UserPresenceState"]]):
+    """`get_users_for_states` result that only lists the users to notify right away.
+
+    Synapse iterates over the mapping to decide whose syncs to wake up, and looks up the
+    entry of a syncing user to filter the presence it reads. Lookups of the other `users`
+    still return all `states`, so what a service user reads never depends on coalescing.
+    """
+
+    def __init__(
+        self,
+        notified: Collection[str],
+        states: FrozenSet["UserPresenceState"],
+        users: Set[str],
+    ) -> None:
+        super().__init__(dict.fromkeys(notified, states))
+        self.states = states
+        self.users = users
+
+    def __missing__(self, user_id: str) -> FrozenSet["UserPresenceState"]:
+        if user_id in self.users:
+            return self.states
+        raise KeyError(user_id)
+
+
+class PresenceCoalescer:
+    """Limits how often the service users are notified about presence changes.
+
+    - updates that don't change a user's `state` or `status_msg` (e.g. a bumped
+      `last_active_ts`) don't notify anybody
+    - the first change after a quiet `window` notifies right away, all further changes
+      within the window are covered by a single `notify()` call at its end
+
+    A notified service user reads the current state of every user that changed since its
+    last sync, so a user flapping within the window only shows up with its latest state.
+
+    The last states of at most `max_users` users are remembered, the least recently updated
+    are forgotten first. An update of a forgotten user counts as a change.
+
+    Args:
+        notify: Wakes up the service users, so they sync the pending presence.
+        clock: Synapse's `Clock`.
+    """
+
+    def __init__(
+        self,
+        notify: Callable[[], None],
+        clock: Any,
+        window: float,
+        max_users: int = MAX_REMEMBERED_STATES,
+    ) -> None:
+        self.notify = notify
+        self.clock = clock
+        self.window = window
+        self.max_users = max_users
+        # user_id -> key of the last update seen for that user
+        self.last_states: "OrderedDict[str, StateKey]" = OrderedDict()
+        self.last_notified = float("-inf")
+        self.notify_scheduled = False
+
+    def changed_states(self, states: Iterable["UserPresenceState"]) -> int:
+        """Remember the given states, return how many of them are actual changes."""
+        changed = noop = 0
+        for state in states:
+            key = (state.state, state.status_msg)
+            if self.last_states.get(state.user_id) == key:
+                noop += 1
+            else:
+                self.last_states[state.user_id] = key
+                changed += 1
+            self.last_states.move_to_end(state.user_id)
+        while len(self.last_states) > self.max_users:
+            self.last_states.popitem(last=False)
+        PRESENCE_NOOP_UPDATES.inc(noop)
+        return changed
+
+    def notify_now(self, states: Iterable["UserPresenceState"]) -> bool:
+        """Whether the service users should be notified about `states` right away."""
+        if not self.changed_states(states):
+            return False
+        now = self.clock.time()
+        if now >= self.last_notified + self.window:
+            self.last_notified = now
+            return True
+        if not self.notify_scheduled:
+            self.notify_scheduled = True
+            self.clock.call_later(self.last_notified + self.window - now, self._notify)
+        PRESENCE_COALESCED_BATCHES.inc()
+        return False
+
+    def _notify(self) -> None:
+        self.notify_scheduled = False
+        self.last_notified = self.clock.time()
+        log.debug("Notifying service users about coalesced presence changes")
+        self.notify()
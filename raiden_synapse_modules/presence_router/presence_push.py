@@ -0,0 +1,93 @@
+import logging
+from typing import Any, Awaitable, Callable, Iterable, List, Set
+
+from synapse.module_api import run_in_background
+
+from raiden_synapse_modules.metrics import (
+    PRESENCE_PUSH_PENDING,
+    PRESENCE_PUSH_TIME,
+    PRESENCE_PUSH_USERS,
+    PRESENCE_PUSHES,
+)
+
+log = logging.getLogger(__name__)
+
+PRESENCE_PUSH_WINDOW_DEFAULT = 1.0
+PRESENCE_PUSH_PAGE_SIZE_DEFAULT = 10
+PRESENCE_PUSH_PAGES_PER_SECOND_DEFAULT = 1.0
+
+
+class PresencePusher:
+    """Sends the current presences to newly registered services, spread out over time.
+
+    Every push of `send_local_online_presence_to` hands the recipients a snapshot of all
+    online users, so pushing to many services at once causes a traffic spike. Instead:
+
+    - services scheduled within `window` seconds share one push, a service that is scheduled
+      again before it was pushed to is only pushed to once
+    - a push is sent in pages of at most `page_size` services, at no more than
+      `pages_per_second` pages per second (0 for no limit)
+    - services scheduled while a push is running are appended to it
+
+    Args:
+        send: Sends the presences to a list of users, e.g.
+            `ModuleApi.send_local_online_presence_to`.
+        clock: Synapse's `Clock`.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[List[str]], Awaitable[None]],
+        clock: Any,
+        window: float = PRESENCE_PUSH_WINDOW_DEFAULT,
+        page_size: int = PRESENCE_PUSH_PAGE_SIZE_DEFAULT,
+        pages_per_second: float = PRESENCE_PUSH_PAGES_PER_SECOND_DEFAULT,
+    ) -> None:
+        self.send = send
+        self.clock = clock
+        self.window = window
+        self.page_size = page_size
+        self.pages_per_second = pages_per_second
+        self.pending: Set[str] = set()
+        self.is_pushing = False
+        self._flush_scheduled = False
+
+    def schedule(self, users: Iterable[str]) -> None:
+        """Push the current presences to `users` with the next page(s)."""
+        self.pending.update(users)
+        PRESENCE_PUSH_PENDING.set(len(self.pending))
+        if self.pending and not self._flush_scheduled and not self.is_pushing:
+            self._flush_scheduled = True
+            self.clock.call_later(self.window, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        run_in_background(self.push_pending)
+
+    def _next_page(self) -> List[str]:
+        page = sorted(self.pending)[: self.page_size]
+        self.pending.difference_update(page)
+        PRESENCE_PUSH_PENDING.set(len(self.pending))
+        return page
+
+    async def push_pending(self) -> None:
+        """Push to all pending users, page by page."""
+        if self.is_pushing:
+            return
+        self.is_pushing = True
+        try:
+            with PRESENCE_PUSH_TIME.time():
+                while self.pending:
+                    page = self._next_page()
+                    log.debug(f"Sending presences to {len(page)} users")
+                    try:
+                        await self.send(page)
+                    except Exception as ex:  # pylint: disable=broad-except
+                        log.error(f"Sending presences to {len(page)} users failed: {ex}")
+                    else:
+                        PRESENCE_PUSH_USERS.inc(len(page))
+                    if self.pending and self.pages_per_second > 0:
+                        await self.clock.sleep(1 / self.pages_per_second)
+            PRESENCE_PUSHES.inc()
+        finally:
+            self.is_pushing = False
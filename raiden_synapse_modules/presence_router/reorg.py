@@ -0,0 +1,170 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Deque, Dict, List, Optional, Tuple
+
+from eth_typing import Address
+from hexbytes import HexBytes
+
+if TYPE_CHECKING:
+    from web3.types import BlockData, EventData
+
+# Number of recent block headers kept to find the fork point of a reorg
+BLOCK_HISTORY_SIZE = 128
+BLOCK_CONFIRMATIONS_DEFAULT = 0
+
+# (block number, address, valid_till before, valid_till after)
+Change = Tuple[int, Address, Optional[int], Optional[int]]
+
+
+class DeepReorgError(Exception):
+    """None of the recorded blocks is part of the canonical chain anymore."""
+
+
+@dataclass(frozen=True)
+class BlockRecord:
+    number: int
+    hash: HexBytes
+    timestamp: int
+
+
+class ChainHistory:
+    """Recent blocks and the registry changes made in them, so reorgs can be undone.
+
+    - `blocks` is a ring buffer of the last `size` block headers that were seen
+    - `changes` journals every registry change in the order it was applied, with the
+      number of the block that caused it and the `valid_till` (None if unregistered)
+      before and after it
+    - events wait in `pending` until their block has `confirmations` blocks on top
+
+    The journal isn't sorted by block number: expiries are recorded at the confirmed
+    block, and events of older blocks can still be applied after them. On a reorg,
+    `roll_back` drops everything after the fork point and returns the registry updates
+    that restore the state at the fork point. Changes in blocks older than the oldest
+    recorded header are final and get dropped from the journal.
+    """
+
+    def __init__(
+        self, confirmations: int = BLOCK_CONFIRMATIONS_DEFAULT, size: int = BLOCK_HISTORY_SIZE
+    ) -> None:
+        self.confirmations = confirmations
+        self.blocks: Deque[BlockRecord] = deque(maxlen=size)
+        self.changes: Deque[Change] = deque()
+        # (blockHash, logIndex) -> event, so fetching an event twice doesn't apply it twice
+        self.pending: Dict[Tuple[HexBytes, int], "EventData"] = {}
+
+    @property
+    def head(self) -> Optional[BlockRecord]:
+        return self.blocks[-1] if self.blocks else None
+
+    def add_block(self, block: "BlockData") -> None:
+        """Record a new head, which must not fork off (see `find_fork`)."""
+        head = self.head
+        if head is not None and block["number"] <= head.number:
+            return
+        self.blocks.append(
+            BlockRecord(
+                number=block["number"], hash=HexBytes(block["hash"]), timestamp=block["timestamp"]
+            )
+        )
+        oldest = self.blocks[0].number
+        if any(change[0] < oldest for change in self.changes):
+            self.changes = deque(change for change in self.changes if change[0] >= oldest)
+
+    def add_events(self, events: List["EventData"]) -> None:
+        for event in events:
+            self.pending[(HexBytes(event["blockHash"]), event["logIndex"])] = event
+
+    def record(
+        self,
+        block_number: int,
+        address: Address,
+        previous: Optional[int],
+        current: Optional[int],
+    ) -> None:
+        """Journal a registry change of `valid_till` from `previous` to `current`."""
+        self.changes.append((block_number, address, previous, current))
+
+    def pop_confirmed(self) -> List["EventData"]:
+        """Remove and return the pending events with enough confirmations, in chain order."""
+        if self.confirmations == 0:
+            confirmed = list(self.pending.values())
+        elif self.head is None:
+            return []
+        else:
+            last_confirmed = self.head.number - self.confirmations
+            confirmed = [
+                event for event in self.pending.values() if event["blockNumber"] <= last_confirmed
+            ]
+        for event in confirmed:
+            del self.pending[(HexBytes(event["blockHash"]), event["logIndex"])]
+        return sorted(confirmed, key=lambda event: (event["blockNumber"], event["logIndex"]))
+
+    def confirmed_block(self) -> Optional[BlockRecord]:
+        """The newest recorded block with enough confirmations."""
+        if self.head is None:
+            return None
+        last_confirmed = self.head.number - self.confirmations
+        for record in reversed(self.blocks):
+            if record.number <= last_confirmed:
+                return record
+        return None
+
+    def find_fork(
+        self, block: "BlockData", canonical_hash: Optional[Callable[[int], HexBytes]] = None
+    ) -> Optional[int]:
+        """Number of the newest recorded block that `block` descends from, None if that is
+        the head (no reorg).
+
+        Blocks are matched by `parentHash` first. Without a match, `canonical_hash(number)`
+        is asked for the recorded blocks, newest first. Without `canonical_hash`, recorded
+        blocks below `block` are assumed to be canonical.
+        """
+        head = self.head
+        if head is None or block["parentHash"] == head.hash or block["hash"] == head.hash:
+            return None
+        for record in reversed(self.blocks):
+            if record.number >= block["number"]:
+                continue
+            if (
+                record.hash == block["parentHash"]
+                or canonical_hash is None
+                or canonical_hash(record.number) == record.hash
+            ):
+                return None if record is head else record.number
+        raise DeepReorgError(
+            f"Block {block['number']} forks off before the {len(self.blocks)} recorded blocks"
+        )
+
+    def roll_back(self, block_number: int) -> List[Tuple[Address, Optional[int]]]:
+        """Forget everything after `block_number`.
+
+        Returns:
+            The `(address, valid_till)` updates to apply in order. All changes since the
+            first orphaned one are reverted newest first, then the changes of older blocks
+            that were applied after it are applied again.
+        """
+        while self.blocks and self.blocks[-1].number > block_number:
+            self.blocks.pop()
+        for key, event in list(self.pending.items()):
+            if event["blockNumber"] > block_number:
+                del self.pending[key]
+        first_orphaned = next(
+            (index for index, change in enumerate(self.changes) if change[0] > block_number),
+            len(self.changes),
+        )
+        kept = list(self.changes)[:first_orphaned]
+        undone = list(self.changes)[first_orphaned:]
+        updates: List[Tuple[Address, Optional[int]]] = []
+        valid_till: Dict[Address, Optional[int]] = {}
+        for _, address, previous, _ in reversed(undone):
+            updates.append((address, previous))
+            valid_till[address] = previous
+        for number, address, previous, current in undone:
+            if number > block_number:
+                continue
+            # The change now follows the state at the fork point
+            kept.append((number, address, valid_till.get(address, previous), current))
+            updates.append((address, current))
+            valid_till[address] = current
+        self.changes = deque(kept)
+        return updates
@@ -0,0 +1,269 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, TypeVar
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import HTTPProvider
+from web3.providers.base import BaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from raiden_synapse_modules.metrics import (
+    RPC_ENDPOINT_ERRORS,
+    RPC_ENDPOINT_LATENCY,
+    RPC_ENDPOINT_UP,
+    RPC_HEDGED_REQUESTS,
+)
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Connections kept alive per endpoint
+POOL_MAXSIZE = 8
+# Weight of the newest sample in the moving latency average
+LATENCY_SMOOTHING = 0.3
+# An endpoint is skipped for this long after its first failure, doubled on every further one
+RETRY_DELAY_MIN = 5.0
+RETRY_DELAY_MAX = 300.0
+
+# Filters only exist on the node that installed them
+FILTER_METHODS = {
+    "eth_getFilterChanges",
+    "eth_getFilterLogs",
+    "eth_uninstallFilter",
+}
+NEW_FILTER_METHODS = {"eth_newFilter", "eth_newBlockFilter", "eth_newPendingTransactionFilter"}
+# Seconds until a raw POST to an endpoint times out, as for web3's own requests
+POST_TIMEOUT_DEFAULT = 10
+# Reads that are safe to send to a second endpoint while the first one is slow
+HEDGED_METHODS = {
+    "eth_blockNumber",
+    "eth_chainId",
+    "eth_call",
+    "eth_getBlockByHash",
+    "eth_getBlockByNumber",
+    "eth_getLogs",
+}
+
+
+@dataclass
+class PoolEndpoint:
+    """An ethereum node of the pool and what is known about its health."""
+
+    provider: HTTPProvider
+    session: requests.Session
+    url: str
+    label: str
+    # Moving average of the request latency in seconds
+    latency: float = 0.0
+    # Consecutive failed requests
+    failures: int = 0
+    # While failing, the `time.monotonic()` before which the endpoint is only a last resort
+    retry_at: float = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.failures == 0 or now >= self.retry_at
+
+
+def endpoint_label(index: int, url: str) -> str:
+    """Metric label of an endpoint, without path or credentials (e.g. API keys)."""
+    return f"{index}:{urlparse(url).hostname}"
+
+
+class RPCPool(BaseProvider):
+    """
+    web3 provider that spreads JSON-RPC requests over several ethereum nodes.
+
+    Every request goes to the healthy endpoint with the lowest average latency. Transport
+    errors mark the endpoint as failing and the request is retried on the next one. A failing
+    endpoint gets another chance after an exponentially growing delay.
+
+    With `hedge_after` set, idempotent reads that take longer than that are also sent to
+    the next best endpoint, and the first answer wins. Filters are kept on the endpoint that
+    installed them: if it fails, the node reports "filter not found" and the caller renews
+    them.
+
+    Each endpoint uses its own `requests.Session`, so connections are kept alive.
+    """
+
+    def __init__(
+        self,
+        urls: Sequence[str],
+        hedge_after: float = 0,
+        request_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        if not urls:
+            raise ValueError("An RPC pool needs at least one endpoint")
+        super().__init__()
+        self.hedge_after = hedge_after
+        self.endpoints: List[PoolEndpoint] = []
+        for index, url in enumerate(urls):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            provider = HTTPProvider(url, request_kwargs=request_kwargs, session=session)
+            endpoint = PoolEndpoint(
+                provider=provider, session=session, url=url, label=endpoint_label(index, url)
+            )
+            RPC_ENDPOINT_UP.labels(endpoint=endpoint.label).set(1)
+            self.endpoints.append(endpoint)
+        # Endpoint that installed each filter, by filter id
+        self._filter_endpoints: Dict[str, PoolEndpoint] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=2 * len(self.endpoints), thread_name_prefix="rpc-pool"
+        )
+
+    def __str__(self) -> str:
+        return f"RPC pool {[endpoint.label for endpoint in self.endpoints]}"
+
+    def ranked(self) -> List[PoolEndpoint]:
+        """Healthy endpoints by latency, followed by the failing ones."""
+        now = time.monotonic()
+        with self._lock:
+            return sorted(
+                self.endpoints,
+                key=lambda endpoint: (not endpoint.is_healthy(now), endpoint.latency),
+            )
+
+    def status(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "endpoint": endpoint.label,
+                "healthy": endpoint.is_healthy(now),
+                "latency": endpoint.latency,
+                "failures": endpoint.failures,
+            }
+            for endpoint in self.endpoints
+        ]
+
+    def _record_success(self, endpoint: PoolEndpoint, latency: float) -> None:
+        with self._lock:
+            if endpoint.latency == 0:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += LATENCY_SMOOTHING * (latency - endpoint.latency)
+            endpoint.failures = 0
+        RPC_ENDPOINT_LATENCY.labels(endpoint=endpoint.label).set(endpoint.latency)
+        RPC_ENDPOINT_UP.labels(endpoint=endpoint.label).set(1)
+
+    def _record_failure(self, endpoint: PoolEndpoint, error: Exception) -> None:
+        with self._lock:
+            endpoint.failures += 1
+            delay = min(RETRY_DELAY_MAX, RETRY_DELAY_MIN * 2 ** (endpoint.failures - 1))
+            endpoint.retry_at = time.monotonic() + delay
+        RPC_ENDPOINT_ERRORS.labels(endpoint=endpoint.label).inc()
+        RPC_ENDPOINT_UP.labels(endpoint=endpoint.label).set(0)
+        log.warning(f"Ethereum RPC endpoint {endpoint.label} failed: {error}")
+
+    def _send(self, endpoint: PoolEndpoint, send: Callable[[PoolEndpoint], T]) -> T:
+        """Run `send(endpoint)` and update the endpoint's health and latency."""
+        start = time.monotonic()
+        try:
+            response = send(endpoint)
+        except (requests.RequestException, ValueError) as ex:
+            self._record_failure(endpoint, ex)
+            raise
+        self._record_success(endpoint, time.monotonic() - start)
+        return response
+
+    def _call(self, endpoint: PoolEndpoint, method: RPCEndpoint, params: Any) -> RPCResponse:
+        return self._send(
+            endpoint, lambda endpoint: endpoint.provider.make_request(method, params)
+        )
+
+    @staticmethod
+    def _post(endpoint: PoolEndpoint, data: bytes) -> bytes:
+        kwargs = {"timeout": POST_TIMEOUT_DEFAULT, **endpoint.provider.get_request_kwargs()}
+        response = endpoint.session.post(endpoint.url, data=data, **kwargs)
+        response.raise_for_status()
+        return response.content
+
+    def _hedged_call(
+        self, endpoints: List[PoolEndpoint], method: RPCEndpoint, params: Any
+    ) -> RPCResponse:
+        """Ask the endpoints in order. The next one is asked as soon as all requests in
+        flight failed or none of them answered within `hedge_after`, the first answer wins."""
+        pending: Set[Future] = set()
+        error: Optional[BaseException] = None
+        for endpoint in endpoints:
+            if pending:
+                RPC_HEDGED_REQUESTS.inc()
+            pending.add(self._executor.submit(self._call, endpoint, method, params))
+            while pending:
+                done, pending = wait(
+                    pending, timeout=self.hedge_after, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+                if not done:
+                    break
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        assert error is not None
+        raise error
+
+    def _filter_call(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        """Send a filter request to the endpoint that installed the filter `params[0]`.
+        Unknown filters go to the best endpoint, which reports them as not found."""
+        filter_id = params[0]
+        with self._lock:
+            if method == "eth_uninstallFilter":
+                endpoint = self._filter_endpoints.pop(filter_id, None)
+            else:
+                endpoint = self._filter_endpoints.get(filter_id)
+        return self._call(endpoint or self.ranked()[0], method, params)
+
+    def _new_filter_call(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        endpoint = self.ranked()[0]
+        response = self._call(endpoint, method, params)
+        if "result" in response:
+            with self._lock:
+                self._filter_endpoints[response["result"]] = endpoint
+        return response
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        if method in FILTER_METHODS:
+            return self._filter_call(method, params)
+        if method in NEW_FILTER_METHODS:
+            return self._new_filter_call(method, params)
+
+        endpoints = self.ranked()
+        if self.hedge_after > 0 and method in HEDGED_METHODS and len(endpoints) > 1:
+            return self._hedged_call(endpoints, method, params)
+
+        error: Optional[Exception] = None
+        for endpoint in endpoints:
+            try:
+                return self._call(endpoint, method, params)
+            except (requests.RequestException, ValueError) as ex:
+                error = ex
+        assert error is not None
+        raise error
+
+    def post(self, data: bytes) -> bytes:
+        """POST a raw (e.g. batch) JSON-RPC payload, failing over like `make_request`."""
+        error: Optional[Exception] = None
+        for endpoint in self.ranked():
+            try:
+                return self._send(endpoint, lambda endpoint: self._post(endpoint, data))
+            except requests.RequestException as ex:
+                error = ex
+        assert error is not None
+        raise error
+
+    def isConnected(self) -> bool:  # pylint: disable=invalid-name
+        return any(endpoint.provider.isConnected() for endpoint in self.endpoints)
@@ -0,0 +1,189 @@
+import asyncio
+import itertools
+import json
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, cast
+
+from web3._utils.method_formatters import block_formatter, log_entry_formatter
+from web3.contract import Contract
+from web3.types import BlockData, EventData, LogReceipt
+from websockets.client import connect
+
+from raiden_contracts.constants import EVENT_REGISTERED_SERVICE
+from raiden_synapse_modules.metrics import RPC_LATENCY
+from raiden_synapse_modules.presence_router.blockchain_support import (
+    LogBackfill,
+    registered_service_log_filter,
+)
+from raiden_synapse_modules.presence_router.constants import (
+    LOG_CHUNK_SIZE_DEFAULT,
+    LOG_PARALLELISM_DEFAULT,
+)
+
+log = logging.getLogger(__name__)
+
+# Delay before the first reconnection attempt, doubled on every further failure
+RECONNECT_DELAY_MIN = 1.0
+RECONNECT_DELAY_MAX = 60.0
+# How long `stop` waits for the connection to be closed
+STOP_TIMEOUT = 5.0
+
+
+class RegistrySubscription:
+    """
+    Follows new block headers and `RegisteredService` events via `eth_subscribe` on a
+    WebSocket endpoint.
+
+    web3 v5 can't subscribe, so the connection is handled with `websockets` in a daemon
+    thread that runs its own asyncio loop. `on_update(block, registered_services, None,
+    False)` is called from that thread. After every (re)connect, the events from
+    `from_block()` up to the latest block are backfilled by a `LogBackfill` on the web3 of
+    `service_registry`, so nothing is lost while the connection was down. Long outages are
+    fetched in chunks of at most `log_chunk_size` blocks. The backfill is reported with
+    `on_update(latest, registered_services, None, True)`: blocks were missed, and the node
+    doesn't report logs removed by a reorg in the meantime. When the node removes a log
+    because of a reorg, `on_update(None, [], orphaned_block, False)` reports the first
+    orphaned block.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        service_registry: Contract,
+        from_block: Callable[[], int],
+        on_update: Callable[[Optional[BlockData], List[EventData], Optional[int], bool], None],
+        log_chunk_size: int = LOG_CHUNK_SIZE_DEFAULT,
+        log_parallelism: int = LOG_PARALLELISM_DEFAULT,
+    ) -> None:
+        self.url = url
+        self.service_registry = service_registry
+        self.log_chunk_size = log_chunk_size
+        self.log_parallelism = log_parallelism
+        self.from_block = from_block
+        self.on_update = on_update
+        self.failures = 0
+        self.connected = threading.Event()
+        self._event = getattr(service_registry.events, EVENT_REGISTERED_SERVICE)()
+        self._log_filter = registered_service_log_filter(service_registry)
+        self._request_ids = itertools.count()
+        self._notifications: List[Dict[str, Any]] = []
+        self._stopped = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_until_complete,
+            args=(self._run(),),
+            name="registry-subscription",
+            daemon=True,
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, timeout: float = STOP_TIMEOUT) -> None:
+        """Cancel the subscription loop, which closes the connection, and wait up to
+        `timeout` seconds for the thread to end."""
+        self._stopped = True
+        if not self._thread.is_alive():
+            return
+        self._loop.call_soon_threadsafe(self._cancel)
+        self._thread.join(timeout)
+
+    def _cancel(self) -> None:
+        for task in asyncio.all_tasks(self._loop):
+            task.cancel()
+
+    def reconnect_delay(self) -> float:
+        return min(RECONNECT_DELAY_MAX, RECONNECT_DELAY_MIN * 2 ** (self.failures - 1))
+
+    async def _run(self) -> None:
+        try:
+            while not self._stopped:
+                try:
+                    await self._follow()
+                except Exception as ex:  # pylint: disable=broad-except
+                    self.connected.clear()
+                    self.failures += 1
+                    delay = self.reconnect_delay()
+                    log.error(
+                        f"Subscription to {self.url} failed: {ex}. Reconnecting in {delay}s."
+                    )
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            log.info(f"Subscription to {self.url} stopped")
+        finally:
+            self.connected.clear()
+
+    async def _request(self, ws: Any, method: str, params: List[Any]) -> Any:
+        """Send a JSON-RPC request and wait for its result.
+
+        Notifications that arrive in the meantime are kept for `_next_notification`.
+        """
+        request_id = next(self._request_ids)
+        request = {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+        with RPC_LATENCY.labels(method=method).time():
+            await ws.send(json.dumps(request))
+            while True:
+                response = json.loads(await ws.recv())
+                if response.get("id") == request_id:
+                    break
+                self._notifications.append(response)
+        if "error" in response:
+            raise ValueError(f"{method} failed: {response['error']}")
+        return response["result"]
+
+    async def _next_notification(self, ws: Any) -> Dict[str, Any]:
+        if self._notifications:
+            return self._notifications.pop(0)
+        return json.loads(await ws.recv())
+
+    async def _follow(self) -> None:
+        async with connect(self.url) as ws:
+            self._notifications = []
+            heads_subscription = await self._request(ws, "eth_subscribe", ["newHeads"])
+            logs_subscription = await self._request(
+                ws, "eth_subscribe", ["logs", self._log_filter]
+            )
+            await self._backfill(ws)
+            self.failures = 0
+            self.connected.set()
+            log.info(f"Subscribed to new blocks and registry events at {self.url}")
+
+            while not self._stopped:
+                message = await self._next_notification(ws)
+                if message.get("method") != "eth_subscription":
+                    continue
+                subscription = message["params"]["subscription"]
+                result = message["params"]["result"]
+                if subscription == heads_subscription:
+                    self.on_update(cast(BlockData, block_formatter(result)), [], None, False)
+                elif subscription == logs_subscription and result.get("removed"):
+                    removed = cast(LogReceipt, log_entry_formatter(result))
+                    self.on_update(None, [], removed["blockNumber"], False)
+                elif subscription == logs_subscription:
+                    self.on_update(None, self._decode([result]), None, False)
+
+    async def _backfill(self, ws: Any) -> None:
+        """Fetch everything missed before the subscriptions were active."""
+        latest = cast(
+            BlockData,
+            block_formatter(await self._request(ws, "eth_getBlockByNumber", ["latest", False])),
+        )
+        from_block = self.from_block()
+        events: List[EventData] = []
+        if from_block <= latest["number"]:
+            backfill = LogBackfill(
+                self.service_registry,
+                cursor=from_block,
+                chunk_size=self.log_chunk_size,
+                parallelism=self.log_parallelism,
+            )
+            # Blocking web3 requests, notifications wait in the connection meanwhile
+            events = await asyncio.get_running_loop().run_in_executor(
+                None, backfill.fetch, latest["number"]
+            )
+            log.debug(f"Backfilled {len(events)} registry events since block {from_block}")
+        self.on_update(latest, events, None, True)
+
+    def _decode(self, logs: List[Dict[str, Any]]) -> List[EventData]:
+        return [self._event.processLog(log_entry_formatter(entry)) for entry in logs]
@@ -0,0 +1,116 @@
+import logging
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Any, Counter, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL_DEFAULT = 0.01
+MAX_PROFILE_DURATION_DEFAULT = 300
+
+
+class SamplingProfiler:
+    """In-process sampling profiler for diagnosing stalls of a running homeserver.
+
+    While running, a daemon thread takes the stacks of all other threads every `interval`
+    seconds with `sys._current_frames()`. Nothing is traced in between, so the profiled
+    threads only pay for the GIL hand-over of each sample. A profile stops by itself after
+    the `duration` given to `start`.
+
+    The result is in the collapsed stack format (one `thread;outer;...;inner count` line per
+    distinct stack), as read by `flamegraph.pl` and https://www.speedscope.app.
+    """
+
+    def __init__(self, max_duration: float = MAX_PROFILE_DURATION_DEFAULT) -> None:
+        self.max_duration = max_duration
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.interval = SAMPLE_INTERVAL_DEFAULT
+        self.duration = 0.0
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float, interval: float = SAMPLE_INTERVAL_DEFAULT) -> bool:
+        """Discard the last profile and sample for `duration` seconds (at most
+        `max_duration`). Returns False if a profile is already running."""
+        if self.running:
+            return False
+        if duration <= 0 or interval <= 0:
+            raise ValueError("Profile duration and sample interval must be positive")
+        with self._lock:
+            self._stacks = Counter()
+            self.samples = 0
+        self.interval = interval
+        self.duration = min(duration, self.max_duration)
+        self.started_at = time.time()
+        self.stopped_at = None
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="raiden-profiler", args=(self.duration,), daemon=True
+        )
+        self._thread.start()
+        log.info(f"Started profiling for {self.duration}s, sampling every {interval}s")
+        return True
+
+    def stop(self) -> bool:
+        """Stop the running profile early. Returns False if none is running."""
+        if not self.running:
+            return False
+        assert self._thread is not None
+        self._stop.set()
+        self._thread.join()
+        return True
+
+    def _run(self, duration: float) -> None:
+        own_thread = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            self._sample(own_thread)
+        self.stopped_at = time.time()
+        log.info(f"Stopped profiling after {self.samples} samples")
+
+    def _sample(self, own_thread: int) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = [
+            self._collapse(names.get(ident, str(ident)), frame)
+            for ident, frame in sys._current_frames().items()
+            if ident != own_thread
+        ]
+        with self._lock:
+            self._stacks.update(stacks)
+            self.samples += 1
+
+    @staticmethod
+    def _collapse(thread_name: str, frame: Optional[FrameType]) -> str:
+        functions: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        functions.append(thread_name)
+        return ";".join(reversed(functions))
+
+    def collapsed(self) -> str:
+        """The stacks sampled so far, most frequent first."""
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "stopped_at": self.stopped_at,
+            "duration": self.duration,
+            "interval": self.interval,
+            "samples": self.samples,
+        }
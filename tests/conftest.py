@@ -1,6 +1,12 @@
 # pylint: disable=unused-import
 
-from typing import Callable, Literal
+import asyncio
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Literal, Set, Tuple
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -9,6 +15,8 @@ from eth_typing import Address
 from web3 import Web3
 from web3.contract import Contract
 from web3.types import TxParams
+from websockets.exceptions import ConnectionClosed
+from websockets.server import serve
 
 from raiden_contracts.tests.fixtures.base import (
     auto_revert_chain,
@@ -64,6 +72,165 @@ def blockchain() -> EthereumTester:
     return chain
 
 
+class FakeRPCServer(ThreadingHTTPServer):
+    """JSON-RPC over HTTP stand-in node that forwards calls to an eth_tester backed web3
+    and counts the requests it received."""
+
+    def __init__(self, web3: Web3) -> None:  # noqa: F811
+        super().__init__(("127.0.0.1", 0), FakeRPCHandler)
+        self.web3 = web3
+        self.http_requests = 0
+        self.rpc_calls: List[str] = []
+        self.lock = threading.Lock()
+        # Seconds to wait before answering a request
+        self.delay = 0.0
+        # Whether JSON-RPC batches are answered, like most nodes do
+        self.batches = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handle_rpc(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            self.rpc_calls.append(request["method"])
+            return forward_rpc(self.web3, request)
+
+
+def forward_rpc(web3: Web3, request: Dict[str, Any]) -> Dict[str, Any]:  # noqa: F811
+    response: Dict[str, Any] = {"jsonrpc": "2.0", "id": request.get("id")}
+    try:
+        result = web3.manager.request_blocking(request["method"], request["params"])
+        response["result"] = json.loads(Web3.toJSON(result))
+    except Exception as ex:  # pylint: disable=broad-except
+        response["error"] = {"code": -32000, "message": str(ex)}
+    return response
+
+
+class FakeRPCHandler(BaseHTTPRequestHandler):
+    server: FakeRPCServer
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        self.server.http_requests += 1
+        time.sleep(self.server.delay)
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if isinstance(payload, list) and not self.server.batches:
+            response: Any = {"jsonrpc": "2.0", "id": None, "error": {"code": -32600}}
+        elif isinstance(payload, list):
+            response = [self.server.handle_rpc(request) for request in payload]
+        else:
+            response = self.server.handle_rpc(payload)
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: Any) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+@contextmanager
+def running_fake_rpc(web3: Web3) -> Iterator[FakeRPCServer]:  # noqa: F811
+    server = FakeRPCServer(web3)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(name="fake_rpc")
+def fake_rpc(web3: Web3) -> Iterator[FakeRPCServer]:  # noqa: F811
+    with running_fake_rpc(web3) as server:
+        yield server
+
+
+class FakeWSServer:
+    """JSON-RPC over WebSocket stand-in node with `eth_subscribe` support.
+
+    Plain calls are forwarded to an eth_tester backed web3, subscription notifications are
+    only sent when a test calls `notify`.
+    """
+
+    def __init__(self, web3: Web3) -> None:  # noqa: F811
+        self.web3 = web3
+        self.rpc_calls: List[str] = []
+        # subscription id -> (connection, subscription type)
+        self.subscriptions: Dict[str, Tuple[Any, str]] = {}
+        self.connections: Set[Any] = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = self._run(self._serve())
+
+    def _run(self, coroutine: Any) -> Any:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout=10)
+
+    async def _serve(self) -> Any:
+        return await serve(self._handle, "127.0.0.1", 0)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"ws://{host}:{port}"
+
+    async def _handle(self, ws: Any, _path: str = "") -> None:
+        self.connections.add(ws)
+        try:
+            async for message in ws:
+                request = json.loads(message)
+                self.rpc_calls.append(request["method"])
+                if request["method"] == "eth_subscribe":
+                    subscription = hex(len(self.subscriptions) + 1)
+                    self.subscriptions[subscription] = (ws, request["params"][0])
+                    response = {"jsonrpc": "2.0", "id": request["id"], "result": subscription}
+                else:
+                    response = forward_rpc(self.web3, request)
+                await ws.send(json.dumps(response))
+        except ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(ws)
+
+    def notify(self, subscription_type: str, result: Any) -> None:
+        """Send `result` to all open subscriptions of the given type."""
+
+        async def send() -> None:
+            for subscription, (ws, kind) in list(self.subscriptions.items()):
+                if kind != subscription_type or ws not in self.connections:
+                    continue
+                params = {"subscription": subscription, "result": result}
+                await ws.send(
+                    json.dumps({"jsonrpc": "2.0", "method": "eth_subscription", "params": params})
+                )
+
+        self._run(send())
+
+    def drop_connections(self) -> None:
+        async def close() -> None:
+            for ws in list(self.connections):
+                await ws.close()
+
+        self._run(close())
+
+    def stop(self) -> None:
+        self.server.close()
+        self._run(self.server.wait_closed())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@pytest.fixture(name="fake_ws_rpc")
+def fake_ws_rpc(web3: Web3) -> Iterator[FakeWSServer]:  # noqa: F811
+    server = FakeWSServer(web3)
+    yield server
+    server.stop()
+
+
 @pytest.fixture(name="presence_router", scope="function")
 def presence_router(
     web3: Web3, service_registry_with_deposits: Contract  # noqa: F811
@@ -74,8 +241,10 @@ def presence_router(
             "ethereum_rpc": "http://foo.bar",
         }
     )
+    module_api = MagicMock()
+    module_api.get_qualified_user_id.side_effect = lambda localpart: f"@{localpart}:server"
     with patch(
         "raiden_synapse_modules.presence_router.pfs.PFSPresenceRouter.setup_web3",
         return_value=web3,
     ):
-        return PFSPresenceRouter(config, MagicMock())
+        return PFSPresenceRouter(config, module_api)
@@ -1,15 +1,21 @@
-from typing import Callable
+from typing import Any, Callable, List, Tuple
+from unittest.mock import patch
 
 import pytest
-from web3 import Web3
+from conftest import FakeRPCServer, register_service
+from prometheus_client import REGISTRY
+from web3 import HTTPProvider, Web3
 from web3.contract import Contract
 
+from raiden_contracts.contract_manager import ContractManager
 from raiden_synapse_modules.presence_router.blockchain_support import (
+    LogBackfill,
+    install_filters,
     read_initial_services_addresses,
+    rpc_latency_middleware,
+    service_registry_abi,
     setup_contract_from_address,
-    install_filters,
 )
-from conftest import register_service
 
 
 @pytest.mark.parametrize("number_of_services", [2])
@@ -35,11 +41,34 @@ def test_setup_contract_from_address(
     assert service_registry.functions.everMadeDepositsLen().call() == number_of_services
 
 
+@pytest.mark.parametrize("number_of_services", [0])
+def test_service_registry_abi_cache(service_registry_with_deposits: Contract) -> None:
+    address = service_registry_with_deposits.address
+    w3 = service_registry_with_deposits.web3
+    service_registry_abi.cache_clear()
+
+    with patch(
+        "raiden_synapse_modules.presence_router.blockchain_support.ContractManager",
+        wraps=ContractManager,
+    ) as contract_manager:
+        for _ in range(10):
+            registry = setup_contract_from_address(address, w3)  # type: ignore
+            assert registry.abi == service_registry_with_deposits.abi
+
+    # the precompiled contracts are only parsed for the first setup
+    assert contract_manager.call_count == 1
+    assert service_registry_abi.cache_info().misses == 1
+    assert service_registry_abi.cache_info().hits == 9
+
+
 @pytest.mark.parametrize("number_of_services", [0])
 def test_install_filters(
     service_registry_with_deposits: Contract, custom_token: Contract, get_accounts: Callable
 ) -> None:
-    block_filter, event_filter = install_filters(service_registry_with_deposits)
+    block_filter, event_filter = install_filters(
+        service_registry_with_deposits,
+        from_block=service_registry_with_deposits.web3.eth.block_number + 1,
+    )
     assert block_filter.get_all_entries() == []
     assert event_filter.get_all_entries() == []
     account = get_accounts(1)[0]
@@ -48,3 +77,105 @@ def test_install_filters(
     assert len(event_filter.get_all_entries()) == 1
     event = event_filter.get_all_entries()[0]
     assert event.args.service.lower() == account.lower()  # type: ignore
+
+
+@pytest.mark.parametrize("number_of_services", [3])
+def test_read_initial_services_addresses_batched(
+    service_registry_with_deposits: Contract, fake_rpc: FakeRPCServer, number_of_services: int
+) -> None:
+    sequential = read_initial_services_addresses(service_registry_with_deposits, "latest")
+    assert len(sequential) == number_of_services
+
+    w3 = Web3(HTTPProvider(fake_rpc.url))
+    service_registry = setup_contract_from_address(
+        service_registry_with_deposits.address, w3  # type: ignore
+    )
+    batched = read_initial_services_addresses(service_registry, "latest", batch_size=100)
+    assert batched == sequential
+    # block pinning, deposits length, deposit addresses, registrations
+    assert fake_rpc.http_requests == 4
+    assert fake_rpc.rpc_calls.count("eth_call") == 1 + 2 * number_of_services
+
+    fake_rpc.http_requests = 0
+    batched = read_initial_services_addresses(service_registry, "latest", batch_size=2)
+    assert batched == sequential
+    # 3 deposits and 3 registrations in 2 concurrent batches each
+    assert fake_rpc.http_requests == 1 + 1 + 2 + 2
+
+    # nodes without batch support get the calls one by one
+    fake_rpc.batches = False
+    fake_rpc.rpc_calls = []
+    batched = read_initial_services_addresses(service_registry, "latest", batch_size=100)
+    assert batched == sequential
+    assert fake_rpc.rpc_calls.count("eth_call") == 1 + 3 * number_of_services
+
+
+def test_rpc_latency_middleware(web3: Web3) -> None:
+    def samples() -> float:
+        value = REGISTRY.get_sample_value(
+            "raiden_presence_router_rpc_seconds_count", {"method": "eth_chainId"}
+        )
+        return value or 0
+
+    def make_request(method: Any, params: Any) -> Any:
+        return {"result": method}
+
+    before = samples()
+    middleware = rpc_latency_middleware(make_request, web3)
+    assert middleware("eth_chainId", []) == {"result": "eth_chainId"}  # type: ignore
+    assert samples() == before + 1
+
+
+@pytest.mark.parametrize("number_of_services", [3])
+def test_log_backfill(web3: Web3, service_registry_with_deposits: Contract) -> None:
+    registry = service_registry_with_deposits
+    head = web3.eth.block_number
+    expected = [
+        event.args.service for event in registry.events.RegisteredService.getLogs(fromBlock=0)
+    ]
+    assert len(expected) == 3
+    get_logs = web3.eth.get_logs
+    requested: List[Tuple[int, int]] = []
+
+    def limited_get_logs(params: Any) -> Any:
+        requested.append((params["fromBlock"], params["toBlock"]))
+        if params["toBlock"] - params["fromBlock"] >= 4:
+            raise ValueError({"code": -32005, "message": "query returned more than 10000 results"})
+        return get_logs(params)
+
+    # the chunk size adapts to the range limit of the node
+    backfill = LogBackfill(registry, cursor=0, chunk_size=16, parallelism=2)
+    with patch.object(web3.eth, "get_logs", side_effect=limited_get_logs):
+        events = backfill.fetch(head)
+    assert [event["args"]["service"] for event in events] == expected
+    assert backfill.cursor == head + 1
+    assert any(end - start >= 4 for start, end in requested)
+    assert backfill.fetch(head) == []
+
+    # after a failure, the backfill resumes with the first unfinished chunk
+    def flaky_get_logs(params: Any) -> Any:
+        if params["fromBlock"] >= head // 2:
+            raise ConnectionError()
+        return get_logs(params)
+
+    backfill = LogBackfill(registry, cursor=0, chunk_size=2, parallelism=1)
+    with patch.object(web3.eth, "get_logs", side_effect=flaky_get_logs):
+        with pytest.raises(ConnectionError):
+            backfill.fetch(head)
+    assert 0 < backfill.cursor < head
+    resumed_from = backfill.cursor
+    requested.clear()
+    with patch.object(web3.eth, "get_logs", side_effect=limited_get_logs):
+        events = backfill.fetch(head)
+    assert [event["args"]["service"] for event in events] == expected
+    assert min(start for start, _ in requested) == resumed_from
+
+    # a reset after a reorg drops the events kept from an unfinished fetch
+    backfill = LogBackfill(registry, cursor=0, chunk_size=2, parallelism=1)
+    with patch.object(web3.eth, "get_logs", side_effect=flaky_get_logs):
+        with pytest.raises(ConnectionError):
+            backfill.fetch(head)
+    backfill.reset(head + 1)
+    assert backfill.fetch(head) == []
+    backfill.advance(head - 1)
+    assert backfill.cursor == head + 1
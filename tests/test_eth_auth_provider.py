@@ -0,0 +1,221 @@
+import asyncio
+import threading
+from typing import Any, Callable, Iterator, List, Tuple
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from coincurve import PrivateKey
+from prometheus_client import REGISTRY
+from twisted.internet.defer import Deferred, succeed
+
+from raiden_synapse_modules.eth_auth_provider import (
+    EthAuthProvider,
+    _eth_sign_sha3,
+    _recover,
+    _sha3,
+)
+
+HOSTNAME = "server"
+
+
+def make_login(private_key: PrivateKey, hostname: str = HOSTNAME) -> Tuple[str, str]:
+    signature = private_key.sign_recoverable(_eth_sign_sha3(hostname.encode()), hasher=None)
+    address = _sha3(private_key.public_key.format(compressed=False)[1:])[12:]
+    return f"@0x{address.hex()}:{hostname}", f"0x{signature.hex()}"
+
+
+@pytest.fixture(name="asyncio_threadpool")
+def asyncio_threadpool() -> Iterator[None]:
+    """Run the thread pool mode on an asyncio loop instead of the twisted reactor."""
+
+    async def defer_to_thread(_reactor: Any, f: Callable, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(None, f, *args)
+
+    def make_deferred_yieldable(deferred: Any) -> Any:
+        return deferred.asFuture(asyncio.get_running_loop())
+
+    with patch("raiden_synapse_modules.eth_auth_provider.defer_to_thread", defer_to_thread), patch(
+        "raiden_synapse_modules.eth_auth_provider.make_deferred_yieldable",
+        make_deferred_yieldable,
+    ):
+        yield
+
+
+@pytest.fixture(name="account_handler")
+def account_handler() -> MagicMock:
+    handler = MagicMock()
+    handler._hs.hostname = HOSTNAME
+    handler.check_user_exists = AsyncMock(return_value=True)
+    handler.register_user = AsyncMock()
+    return handler
+
+
+def test_check_password(account_handler: MagicMock) -> None:
+    provider = EthAuthProvider({}, account_handler)
+    user_id, password = make_login(PrivateKey())
+    assert asyncio.run(provider.check_password(user_id, password))
+
+    other_user_id, _ = make_login(PrivateKey())
+    assert not asyncio.run(provider.check_password(other_user_id, password))
+    _, other_host_password = make_login(PrivateKey(), hostname="other")
+    assert not asyncio.run(provider.check_password(user_id, other_host_password))
+    assert not asyncio.run(provider.check_password(user_id, ""))
+
+
+def test_login_metrics(account_handler: MagicMock) -> None:
+    def logins(outcome: str) -> float:
+        value = REGISTRY.get_sample_value(
+            "raiden_auth_logins_total", {"provider": "eth", "outcome": outcome}
+        )
+        return value or 0
+
+    provider = EthAuthProvider({}, account_handler)
+    before = {outcome: logins(outcome) for outcome in ("success", "invalid_password_format")}
+    user_id, password = make_login(PrivateKey())
+    assert asyncio.run(provider.check_password(user_id, password))
+    assert not asyncio.run(provider.check_password(user_id, "0x00"))
+    assert logins("success") == before["success"] + 1
+    assert logins("invalid_password_format") == before["invalid_password_format"] + 1
+
+
+def test_known_users(account_handler: MagicMock) -> None:
+    provider = EthAuthProvider({}, account_handler)
+    account_handler.check_user_exists.return_value = False
+    user_id, password = make_login(PrivateKey())
+    assert asyncio.run(provider.check_password(user_id, password))
+    assert account_handler.register_user.call_count == 1
+    assert asyncio.run(provider.check_password(user_id, password))
+    assert account_handler.check_user_exists.call_count == 1
+    assert account_handler.register_user.call_count == 1
+
+    # Synapse deletes all access tokens of a deactivated user
+    asyncio.run(provider.on_logged_out(user_id, "DEVICE", "token"))
+    assert user_id not in provider.known_users._expiry
+    assert asyncio.run(provider.check_password(user_id, password))
+    assert account_handler.check_user_exists.call_count == 2
+
+    status = provider.status()
+    assert status["known_users_cache"]["hits"] == 1
+    assert status["known_users_cache"]["misses"] == 2
+    # the same signature was recovered three times
+    assert status["recovery_cache"]["hit_rate"] == 2 / 3
+
+
+def test_login_guard(account_handler: MagicMock) -> None:
+    """Concurrent junk for an address only gets a bounded number of recoveries, and its
+    owner can log in again once the queue drained."""
+    user_id, password = make_login(PrivateKey())
+    junk = [f"0x{bytes(PrivateKey().secret + bytes(33)).hex()}" for _ in range(20)]
+    delays: List[float] = []
+
+    def sleep(delay: float) -> Deferred:
+        delays.append(delay)
+        return succeed(None)
+
+    account_handler._hs.get_clock().sleep.side_effect = sleep
+    provider = EthAuthProvider(
+        {
+            "login_rate_limit_per_second": 1,
+            "login_rate_limit_burst": 2,
+            "login_rate_limit_max_delay_seconds": 3,
+        },
+        account_handler,
+    )
+
+    async def login_concurrently(passwords: List[str]) -> List[bool]:
+        return await asyncio.gather(
+            *(provider.check_password(user_id, bad_password) for bad_password in passwords)
+        )
+
+    monotonic = "raiden_synapse_modules.login_guard.time.monotonic"
+    with patch(
+        "raiden_synapse_modules.eth_auth_provider._recover", side_effect=_recover
+    ) as recover:
+        with patch(monotonic, return_value=100):
+            assert not any(asyncio.run(login_concurrently(junk)))
+            # the burst, then one login per second of the maximum delay
+            assert recover.call_count == 2 + 3
+            assert delays == [1, 2, 3]
+            assert not asyncio.run(provider.check_password(user_id, password))
+            assert recover.call_count == 5
+        with patch(monotonic, return_value=110):
+            assert asyncio.run(provider.check_password(user_id, password))
+            # the valid login took no token
+            assert not any(asyncio.run(login_concurrently(junk[-2:])))
+            assert recover.call_count == 6 + 2
+
+
+def test_recovery_cache(account_handler: MagicMock) -> None:
+    provider = EthAuthProvider({"recovery_cache_size": 2}, account_handler)
+    logins = [make_login(PrivateKey()) for _ in range(3)]
+    for user_id, password in logins[:2] * 2:
+        assert asyncio.run(provider.check_password(user_id, password))
+    info = provider.recover_signer.cache_info()
+    assert (info.hits, info.misses) == (2, 2)
+
+    user_id, password = logins[2]
+    assert asyncio.run(provider.check_password(user_id, password))
+    info = provider.recover_signer.cache_info()
+    assert (info.misses, info.currsize) == (3, 2)
+
+
+@pytest.mark.usefixtures("asyncio_threadpool")
+def test_recovery_in_threadpool(account_handler: MagicMock) -> None:
+    provider = EthAuthProvider(
+        {
+            "recovery_in_threadpool": True,
+            "max_concurrent_recoveries": 1,
+            "max_queued_recoveries": 1,
+        },
+        account_handler,
+    )
+    logins = [make_login(PrivateKey()) for _ in range(3)]
+
+    async def login_all() -> List[bool]:
+        return await asyncio.gather(
+            *(provider.check_password(user_id, password) for user_id, password in logins)
+        )
+
+    # one recovery running, one queued, the third login is rejected
+    assert asyncio.run(login_all()) == [True, True, False]
+    assert asyncio.run(login_all()) == [True, True, False]
+    assert provider.recover_signer.cache_info().hits == 2
+
+
+@pytest.mark.usefixtures("asyncio_threadpool")
+def test_recovery_off_event_loop(account_handler: MagicMock) -> None:
+    """With `recovery_in_threadpool`, no signature of 100 concurrent logins is recovered on
+    the event loop thread, and at most `max_concurrent_recoveries` run at once."""
+    logins = [make_login(PrivateKey()) for _ in range(100)]
+    lock = threading.Lock()
+    recovery_threads: List[int] = []
+    running = 0
+    max_running = 0
+
+    def recover(*args: Any, **kwargs: Any) -> bytes:
+        nonlocal running, max_running
+        with lock:
+            recovery_threads.append(threading.get_ident())
+            running += 1
+            max_running = max(max_running, running)
+        try:
+            return _recover(*args, **kwargs)
+        finally:
+            with lock:
+                running -= 1
+
+    async def login_all(provider: EthAuthProvider) -> List[bool]:
+        return await asyncio.gather(
+            *(provider.check_password(user_id, password) for user_id, password in logins)
+        )
+
+    with patch("raiden_synapse_modules.eth_auth_provider._recover", side_effect=recover):
+        assert all(asyncio.run(login_all(EthAuthProvider({}, account_handler))))
+        assert set(recovery_threads) == {threading.get_ident()}
+
+        recovery_threads.clear()
+        config = {"recovery_in_threadpool": True, "max_concurrent_recoveries": 2}
+        assert all(asyncio.run(login_all(EthAuthProvider(config, account_handler))))
+    assert len(recovery_threads) == len(logins)
+    assert threading.get_ident() not in recovery_threads
+    assert max_running <= 2
@@ -0,0 +1,74 @@
+import random
+from typing import Dict, List, Optional, cast
+from unittest.mock import patch
+
+from eth_typing import Address
+
+from raiden_synapse_modules.presence_router.expiry import ExpiryIndex
+
+
+def make_address(index: int) -> Address:
+    return Address(index.to_bytes(20, "big"))
+
+
+def test_expiry_index() -> None:
+    services: Dict[Address, int] = {make_address(1): 10, make_address(2): 20}
+    index = ExpiryIndex(services)
+    assert index.next_expiry == 10
+
+    # renewal leaves a stale heap entry behind
+    index.update(make_address(1), 30)
+    assert index.next_expiry == 20
+    index.update(make_address(3), 5)
+    assert index.next_expiry == 5
+
+    assert index.pop_expired(4) == []
+    assert index.pop_expired(20) == [make_address(3), make_address(2)]
+    assert services == {make_address(1): 30}
+    assert index.next_expiry == 30
+    assert index.pop_expired(30) == [make_address(1)]
+    # mypy keeps the `int` narrowed by the assert above, but pop_expired changes it
+    assert cast(Optional[int], index.next_expiry) is None
+    assert len(index) == 0
+
+    index.update(make_address(4), 40)
+    assert index.pop_expired_items(50) == [(make_address(4), 40)]
+
+
+def test_expiry_index_compaction() -> None:
+    index = ExpiryIndex({})
+    for valid_till in range(1000):
+        index.update(make_address(1), valid_till)
+    assert len(index._heap) <= 64 + 2
+    assert index.next_expiry == 999
+
+
+def test_expiry_index_many_services() -> None:
+    """10k services, renewals in every block and a few expiries per block. Only expired
+    and stale heap entries are looked at, never the whole mapping."""
+    number_of_services = 10_000
+    blocks = 200
+    renewals_per_block = 50
+    rng = random.Random(42)
+    expiries = {make_address(i): rng.randint(1, blocks * 20) for i in range(number_of_services)}
+    renewals: List[List[int]] = [
+        [rng.randrange(number_of_services) for _ in range(renewals_per_block)]
+        for _ in range(blocks)
+    ]
+
+    index = ExpiryIndex(dict(expiries))
+    naive = dict(expiries)
+    expired = 0
+    with patch.object(index, "_is_stale", wraps=index._is_stale) as is_stale:
+        for timestamp, renewed in enumerate(renewals):
+            for i in renewed:
+                index.update(make_address(i), timestamp + blocks * 10)
+                naive[make_address(i)] = timestamp + blocks * 10
+            expired += len(index.pop_expired(timestamp))
+            naive = {address: expiry for address, expiry in naive.items() if expiry > timestamp}
+            assert index.services == naive
+
+    assert expired > blocks
+    # every heap entry is examined at most once: the expired services and the entries left
+    # stale by renewals
+    assert is_stale.call_count <= expired + blocks * renewals_per_block
@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Optional
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from synapse.api.errors import HttpResponseException
+
+from raiden_synapse_modules.federation_whitelist_reloader import (
+    RETRY_INTERVAL_MIN,
+    FederationWhitelistReloaderProvider,
+)
+
+
+def make_reloader(
+    worker_name: Optional[str] = None, **config: Any
+) -> FederationWhitelistReloaderProvider:
+    account_handler = MagicMock()
+    account_handler._hs.config.federation_domain_whitelist = None
+    account_handler._hs.config.worker_name = worker_name
+    with patch.dict("os.environ", {"URL_KNOWN_FEDERATION_SERVERS": "http://known.servers"}):
+        return FederationWhitelistReloaderProvider(
+            {"update_interval": 600, **config}, account_handler
+        )
+
+
+@pytest.fixture(name="reloader")
+def reloader() -> FederationWhitelistReloaderProvider:
+    return make_reloader()
+
+
+def known_servers(*servers: str) -> bytes:
+    return json.dumps({"all_servers": list(servers)}).encode()
+
+
+def test_apply_known_servers(reloader: FederationWhitelistReloaderProvider) -> None:
+    config = reloader.hs.config
+    assert reloader.status()["version"] is None
+    reloader._apply_known_servers(known_servers("a.org", "b.org"))
+    assert config.federation_domain_whitelist == {"a.org": True, "b.org": True}
+    version = reloader.status()["version"]
+    assert version == hashlib.sha256(known_servers("a.org", "b.org")).hexdigest()
+
+    # unchanged content is not applied again
+    whitelist = config.federation_domain_whitelist
+    reloader._apply_known_servers(known_servers("a.org", "b.org"))
+    assert config.federation_domain_whitelist is whitelist
+
+    with patch.object(reloader, "log") as log:
+        reloader._apply_known_servers(known_servers("b.org", "c.org"))
+    assert config.federation_domain_whitelist == {"b.org": True, "c.org": True}
+    assert reloader.status()["version"] != version
+    assert reloader.status()["domains"] == 2
+    log.warning.assert_called_once_with(
+        "Updated federation whitelist. Added: %s, removed: %s", ["c.org"], ["a.org"]
+    )
+
+    with pytest.raises(ValueError):
+        reloader._apply_known_servers(b'{"servers": []}')
+    assert config.federation_domain_whitelist == {"b.org": True, "c.org": True}
+
+
+def test_retry_backoff(reloader: FederationWhitelistReloaderProvider) -> None:
+    call_later = reloader.clock.call_later
+    error = HttpResponseException(500, "Internal Server Error", b"")
+    with patch.object(reloader, "_fetch_known_servers", AsyncMock(side_effect=error)):
+        for failures in range(1, 8):
+            asyncio.run(reloader._check_and_update_whitelist())
+            delay = call_later.call_args[0][0]
+            expected = min(600, RETRY_INTERVAL_MIN * 2 ** (failures - 1))
+            assert expected / 2 <= delay <= expected
+
+    # unexpected errors are retried the same way
+    with patch.object(reloader, "_fetch_known_servers", AsyncMock(side_effect=KeyError("x"))):
+        asyncio.run(reloader._check_and_update_whitelist())
+    assert reloader.failures == 8
+    assert 300 <= call_later.call_args[0][0] <= 600
+
+    # not modified
+    with patch.object(reloader, "_fetch_known_servers", AsyncMock(return_value=None)):
+        asyncio.run(reloader._check_and_update_whitelist())
+    assert call_later.call_args[0][0] == 600
+    assert reloader.failures == 0
+
+
+def test_whitelist_cache(tmp_path: Path) -> None:
+    cache_path = tmp_path / "whitelist.json"
+    reloader = make_reloader(cache_path=str(cache_path))
+    assert reloader.hs.config.federation_domain_whitelist is None
+
+    async def fetch() -> bytes:
+        reloader.etag = b'"v1"'
+        return known_servers("a.org")
+
+    with patch.object(reloader, "_fetch_known_servers", fetch):
+        asyncio.run(reloader._check_and_update_whitelist())
+    assert cache_path.exists()
+
+    # a restart applies the cached list right away
+    reloader = make_reloader(cache_path=str(cache_path))
+    assert reloader.hs.config.federation_domain_whitelist == {"a.org": True}
+    assert reloader.etag == b'"v1"'
+    assert reloader.last_modified is None
+
+    cache_path.write_text(json.dumps({"body": '{"all_servers": "a.org"}'}))
+    reloader = make_reloader(cache_path=str(cache_path))
+    assert reloader.hs.config.federation_domain_whitelist is None
+
+
+def test_follow_whitelist_cache(tmp_path: Path) -> None:
+    cache_path = tmp_path / "whitelist.json"
+    fetcher = make_reloader(cache_path=str(cache_path), fetch_worker="sender")
+    assert not fetcher.is_fetcher
+    fetcher = make_reloader("sender", cache_path=str(cache_path), fetch_worker="sender")
+    assert fetcher.is_fetcher
+
+    follower = make_reloader("generic", cache_path=str(cache_path), fetch_worker="sender")
+    assert not follower.is_fetcher
+    follower.clock.call_later.assert_called_once_with(10, follower.follow_cache)
+    follower.follow_cache()
+    assert follower.hs.config.federation_domain_whitelist is None
+
+    fetch = AsyncMock(return_value=known_servers("a.org"))
+    with patch.object(fetcher, "_fetch_known_servers", fetch):
+        asyncio.run(fetcher._check_and_update_whitelist())
+    follower.follow_cache()
+    assert follower.hs.config.federation_domain_whitelist == {"a.org": True}
+
+    # unchanged file isn't read again
+    with patch.object(follower, "_load_cache") as load_cache:
+        follower.follow_cache()
+    load_cache.assert_not_called()
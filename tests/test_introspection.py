@@ -0,0 +1,132 @@
+import asyncio
+import json
+import time
+from typing import Any, Dict, List
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from synapse.api.errors import AuthError, SynapseError
+from synapse.config import ConfigError
+
+from raiden_synapse_modules.introspection import (
+    INTROSPECTION_PATH_DEFAULT,
+    IntrospectionResource,
+    RaidenIntrospection,
+    add_status_source,
+    cache_stats,
+)
+from raiden_synapse_modules.profiler import SamplingProfiler
+
+
+def busy_loop(seconds: float) -> None:
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def make_request(*path: str, **args: str) -> MagicMock:
+    request = MagicMock()
+    request.postpath = [segment.encode() for segment in path]
+    request.args = {name.encode(): [value.encode()] for name, value in args.items()}
+    return request
+
+
+def make_resource(admin: bool = True) -> IntrospectionResource:
+    module_api = MagicMock()
+    module_api.get_user_by_req = AsyncMock()
+    module_api._hs.get_auth().is_server_admin = AsyncMock(return_value=admin)
+    return IntrospectionResource(module_api, SamplingProfiler(max_duration=1))
+
+
+def test_sampling_profiler() -> None:
+    profiler = SamplingProfiler(max_duration=0.2)
+    assert profiler.start(duration=10, interval=0.001)
+    assert not profiler.start(duration=10)
+    assert profiler.duration == 0.2
+    busy_loop(0.3)
+    assert not profiler.running
+    assert not profiler.stop()
+
+    assert profiler.samples > 0
+    lines = profiler.collapsed().splitlines()
+    stack, count = lines[0].rsplit(" ", 1)
+    # the main thread spent all the time in `busy_loop`
+    assert stack.startswith("MainThread;")
+    assert "busy_loop" in stack
+    assert int(count) > 0
+
+    assert profiler.start(duration=10, interval=0.001)
+    assert profiler.stop()
+    assert profiler.status()["stopped_at"] is not None
+    with pytest.raises(ValueError):
+        profiler.start(duration=0)
+
+
+def test_introspection_status() -> None:
+    resource = make_resource()
+    add_status_source("test", lambda: {"answer": 42})
+    add_status_source("broken", lambda: {"answer": 1 // 0})
+
+    response = asyncio.run(resource._async_render_GET(make_request()))
+    assert response is not None
+    code, status = response
+    assert code == 200
+    assert status["modules"]["test"] == {"answer": 42}
+    assert "error" in status["modules"]["broken"]
+    assert status["profiler"]["running"] is False
+    json.dumps(status)
+
+    with pytest.raises(AuthError):
+        asyncio.run(make_resource(admin=False)._async_render_GET(make_request()))
+    with pytest.raises(SynapseError):
+        asyncio.run(resource._async_render_GET(make_request("unknown")))
+
+    assert cache_stats(hits=3, misses=1, size=2)["hit_rate"] == 0.75
+    assert cache_stats(hits=0, misses=0, size=0)["hit_rate"] is None
+
+
+def test_introspection_profiler() -> None:
+    resource = make_resource()
+    with pytest.raises(SynapseError):
+        asyncio.run(resource._async_render_GET(make_request("profiler", "profile")))
+
+    start = make_request("profiler", "start", duration="5", interval_ms="1")
+    code, status = asyncio.run(resource._async_render_POST(start))
+    # capped at `max_duration`
+    assert code == 200 and status["running"] and status["duration"] == 1
+    with pytest.raises(SynapseError) as conflict:
+        asyncio.run(resource._async_render_POST(start))
+    assert conflict.value.code == 409
+    busy_loop(0.05)
+    code, status = asyncio.run(resource._async_render_POST(make_request("profiler", "stop")))
+    assert code == 200 and not status["running"] and status["samples"] > 0
+    with pytest.raises(SynapseError):
+        asyncio.run(resource._async_render_POST(make_request("profiler", "stop")))
+
+    request = make_request("profiler", "profile")
+    with patch("raiden_synapse_modules.introspection.finish_request") as finish_request:
+        assert asyncio.run(resource._async_render_GET(request)) is None
+    body = b"".join(call.args[0] for call in request.write.call_args_list)
+    assert b"busy_loop" in body
+    finish_request.assert_called_once_with(request)
+
+    with pytest.raises(SynapseError):
+        bad = make_request("profiler", "start", duration="0")
+        asyncio.run(resource._async_render_POST(bad))
+
+
+def test_introspection_module() -> None:
+    config = RaidenIntrospection.parse_config({})
+    assert config.path == INTROSPECTION_PATH_DEFAULT
+    api = MagicMock()
+    module = RaidenIntrospection(config, api)
+    api.register_web_resource.assert_called_once_with(INTROSPECTION_PATH_DEFAULT, module.resource)
+
+    invalid_configs: List[Dict[str, Any]] = [
+        {"path": "relative"},
+        {"max_profile_duration_seconds": "long"},
+        {"max_profile_duration_seconds": 0},
+    ]
+    for invalid_config in invalid_configs:
+        with pytest.raises(ConfigError):
+            RaidenIntrospection.parse_config(invalid_config)
@@ -0,0 +1,31 @@
+from unittest.mock import patch
+
+from raiden_synapse_modules.known_users import KnownUsersCache
+
+
+def test_known_users_cache() -> None:
+    with patch("raiden_synapse_modules.known_users.time.monotonic", return_value=100):
+        cache = KnownUsersCache(max_size=2, ttl=10)
+        cache.add("@a:server")
+        cache.add("@b:server")
+        assert "@a:server" in cache
+        # `@b:server` is the least recently used one now
+        cache.add("@c:server")
+        assert "@b:server" not in cache
+        assert "@a:server" in cache
+        assert "@c:server" in cache
+
+        cache.invalidate("@a:server")
+        assert "@a:server" not in cache
+        assert len(cache) == 1
+        assert (cache.hits, cache.misses) == (3, 2)
+
+    with patch("raiden_synapse_modules.known_users.time.monotonic", return_value=110):
+        assert "@c:server" not in cache
+        assert len(cache) == 0
+
+
+def test_known_users_cache_disabled() -> None:
+    cache = KnownUsersCache.from_config({"known_users_cache_size": 0})
+    cache.add("@a:server")
+    assert "@a:server" not in cache
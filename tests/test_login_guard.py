@@ -0,0 +1,36 @@
+from unittest.mock import patch
+
+from raiden_synapse_modules.login_guard import LoginGuard
+
+ADDRESS = "0xaa"
+
+
+def test_rate_limit() -> None:
+    guard = LoginGuard(rate=0.5, burst=2, max_delay=5)
+    with patch("raiden_synapse_modules.login_guard.time.monotonic", return_value=100):
+        assert guard.reserve(ADDRESS) == 0
+        assert guard.reserve(ADDRESS) == 0
+        # tokens are taken in advance, so concurrent logins queue up
+        assert guard.reserve(ADDRESS) == 2
+        assert guard.reserve(ADDRESS) == 4
+        # ... until the wait would exceed `max_delay`
+        assert guard.reserve(ADDRESS) is None
+        assert guard.reserve("0xbb") == 0
+    with patch("raiden_synapse_modules.login_guard.time.monotonic", return_value=101):
+        assert guard.reserve(ADDRESS) == 5
+    with patch("raiden_synapse_modules.login_guard.time.monotonic", return_value=110):
+        assert guard.reserve(ADDRESS) == 0
+
+
+def test_rate_limit_refund() -> None:
+    guard = LoginGuard(rate=0, burst=1, max_delay=3)
+    for _ in range(3):
+        # valid logins give their token back
+        assert guard.reserve(ADDRESS) == 0
+        guard.refund(ADDRESS)
+    assert guard.reserve(ADDRESS) == 0
+    assert guard.reserve(ADDRESS) is None
+
+    disabled = LoginGuard.from_config({"login_rate_limit_burst": 0})
+    for _ in range(3):
+        assert disabled.reserve(ADDRESS) == 0
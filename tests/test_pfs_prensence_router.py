@@ -1,11 +1,33 @@
-from unittest.mock import MagicMock
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from dataclasses import replace
+from pathlib import Path
+from typing import Any, Callable, List, Optional, cast
+from unittest.mock import MagicMock, create_autospec, patch
 
 import pytest
-from eth_utils import to_checksum_address
+from conftest import FakeWSServer, register_service
+from eth_tester import EthereumTester
+from eth_utils import encode_hex, to_canonical_address, to_checksum_address
+from hexbytes import HexBytes
+from prometheus_client import REGISTRY
 from requests.exceptions import ReadTimeout
 from synapse.config import ConfigError
+from synapse.handlers.presence import UserPresenceState
+from synapse.server import DataStore, HomeServer, Notifier  # synapse.notifier is circular
+from web3 import Web3
+from web3._utils.filters import Filter
+from web3.contract import Contract
+from web3.types import FilterParams
 
-from raiden_synapse_modules.presence_router.pfs import PFSPresenceRouter
+from raiden_synapse_modules.introspection import STATUS_SOURCES
+from raiden_synapse_modules.presence_router import blockchain_support, pfs
+from raiden_synapse_modules.presence_router.checkpoint import load_checkpoint, save_checkpoint
+from raiden_synapse_modules.presence_router.pfs import ChainUpdate, PFSPresenceRouter
+from raiden_synapse_modules.presence_router.presence_coalesce import PresenceCoalescer
 
 
 def test_parse_config() -> None:
@@ -36,6 +58,37 @@ def test_parse_config() -> None:
             }
         )
     assert config.blockchain_sync == 15
+    assert config.ethereum_ws_rpc is None
+    with pytest.raises(ConfigError):
+        PFSPresenceRouter.parse_config(
+            {"ethereum_rpc": "http://foo.bar", "ethereum_ws_rpc": "http://foo.bar"}
+        )
+    config = PFSPresenceRouter.parse_config(
+        {"ethereum_rpc": "http://foo.bar", "ethereum_ws_rpc": "wss://foo.bar/ws"}
+    )
+    assert config.ethereum_ws_rpc == "wss://foo.bar/ws"
+    with pytest.raises(ConfigError):
+        PFSPresenceRouter.parse_config({"ethereum_rpc": "http://foo.bar", "log_chunk_size": 0})
+    config = PFSPresenceRouter.parse_config(
+        {"ethereum_rpc": ["http://foo.bar", "https://bar.foo"], "rpc_hedge_after_seconds": 0.5}
+    )
+    assert config.ethereum_rpc == "http://foo.bar"
+    assert config.ethereum_rpc_endpoints == ["http://foo.bar", "https://bar.foo"]
+    assert config.rpc_hedge_after == 0.5
+    with pytest.raises(ConfigError):
+        PFSPresenceRouter.parse_config({"ethereum_rpc": ["http://foo.bar", "bar"]})
+    with pytest.raises(ConfigError):
+        PFSPresenceRouter.parse_config({"ethereum_rpc": []})
+    assert config.presence_coalesce_window == 0
+    assert config.block_confirmations == 0
+    with pytest.raises(ConfigError):
+        PFSPresenceRouter.parse_config(
+            {"ethereum_rpc": "http://foo.bar", "block_confirmations": -1}
+        )
+    with pytest.raises(ConfigError):
+        PFSPresenceRouter.parse_config(
+            {"ethereum_rpc": "http://foo.bar", "presence_coalesce_window_seconds": "foo"}
+        )
 
 
 def test_handle_eth_connection_timeout(presence_router: PFSPresenceRouter) -> None:
@@ -46,3 +99,700 @@ def test_handle_eth_connection_timeout(presence_router: PFSPresenceRouter) -> No
         presence_router._check_filters_once()
     except ReadTimeout:
         pytest.fail("Unexpected ReadTimeout")
+
+
+def test_sync_backoff(presence_router: PFSPresenceRouter) -> None:
+    call_later = presence_router._clock.call_later
+    presence_router._config.blockchain_sync = 10
+
+    async def fail(*args: Any) -> None:  # pylint: disable=unused-argument
+        raise ConnectionError()
+
+    with patch("raiden_synapse_modules.presence_router.pfs.defer_to_thread", side_effect=fail):
+        for expected_delay in [20, 40, 80, 160, 300, 300]:
+            asyncio.run(presence_router._sync())
+            assert call_later.call_args[0][0] == expected_delay
+
+    async def dropped_filter(*args: Any) -> None:  # pylint: disable=unused-argument
+        raise ValueError("filter not found")
+
+    presence_router.block_filter = cast(Optional[Filter], MagicMock())
+    with patch(
+        "raiden_synapse_modules.presence_router.pfs.defer_to_thread", side_effect=dropped_filter
+    ):
+        asyncio.run(presence_router._sync())
+    assert presence_router.block_filter is None
+
+    async def no_changes(*args: Any) -> ChainUpdate:  # pylint: disable=unused-argument
+        return ChainUpdate(block=None, registered_services=[])
+
+    with patch(
+        "raiden_synapse_modules.presence_router.pfs.defer_to_thread", side_effect=no_changes
+    ):
+        asyncio.run(presence_router._sync())
+    assert call_later.call_args[0][0] == 10
+    assert presence_router._sync_failures == 0
+
+
+def test_block_header_fetch(
+    presence_router: PFSPresenceRouter, ethereum_tester: EthereumTester
+) -> None:
+    presence_router._setup_filters()
+    get_block = presence_router.web3.eth.getBlock
+    with patch.object(presence_router.web3.eth, "getBlock", wraps=get_block) as mocked:
+        # services are registered for a long time, the header is only fetched for the checkpoint
+        ethereum_tester.mine_blocks(5)
+        presence_router._check_filters_once()
+        assert mocked.call_count == 1
+        assert presence_router.last_block[0] == presence_router.web3.eth.block_number
+
+        ethereum_tester.mine_blocks(5)
+        presence_router._check_filters_once()
+        assert mocked.call_count == 1
+
+        # a service is about to expire: only the newest header gets fetched
+        address = next(iter(presence_router.registered_services))
+        presence_router.on_registered_service(address, 0)
+        ethereum_tester.mine_blocks(5)
+        presence_router._check_filters_once()
+        assert mocked.call_count == 2
+        assert presence_router.last_block[0] == presence_router.web3.eth.block_number
+        assert address not in presence_router.registered_services
+
+
+@pytest.mark.parametrize("number_of_services", [1])
+def test_filter_renewal_backfill(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    custom_token: Contract,
+    get_accounts: Callable,
+) -> None:
+    router = make_presence_router(web3, service_registry_with_deposits, log_chunk_size=2)
+    scanned_block = router.last_block[0]
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    get_logs = web3.eth.get_logs
+    with patch.object(web3.eth, "get_logs", wraps=get_logs) as mocked:
+        # only the blocks since the registry scan are fetched, in chunks of two blocks
+        router._setup_filters()
+        router._check_filters_once()
+        assert account in router.registered_services
+        ranges = [call.args[0] for call in mocked.call_args_list]
+        assert ranges[0]["fromBlock"] == scanned_block + 1
+        assert ranges[-1]["toBlock"] == web3.eth.block_number
+        assert all(params["toBlock"] - params["fromBlock"] <= 1 for params in ranges)
+
+        # a dropped filter resumes at the cursor instead of rescanning
+        mocked.reset_mock()
+        router.block_filter = router.event_filter = None
+        router._check_filters_once()
+        assert mocked.call_count == 0
+        account = get_accounts(1)[0]
+        register_service(service_registry_with_deposits, custom_token, account)
+        router._check_filters_once()
+        assert account in router.registered_services
+        assert mocked.call_count == 0
+
+        # events reported by a filter aren't fetched again when it gets renewed
+        assert router.log_backfill.cursor == web3.eth.block_number + 1
+        router.block_filter = router.event_filter = None
+        with patch.object(router.presence_pusher, "schedule") as schedule:
+            router._check_filters_once()
+        assert mocked.call_count == 0
+        assert schedule.call_count == 0
+
+
+@pytest.mark.parametrize("number_of_services", [1])
+def test_filter_failure_after_backfill(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    custom_token: Contract,
+    get_accounts: Callable,
+) -> None:
+    router = make_presence_router(web3, service_registry_with_deposits)
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    router._setup_filters()
+    with patch.object(
+        router, "_fetch_chain_update", side_effect=ValueError({"message": "filter not found"})
+    ):
+        with pytest.raises(ValueError):
+            router._check_filters_once()
+    # the backfill is done, its events wait for the next sync
+    assert router._backfill_to is None
+    assert router.log_backfill.cursor == web3.eth.block_number + 1
+    assert account not in router.registered_services
+
+    router._check_filters_once()
+    assert account in router.registered_services
+
+
+def test_get_users_for_states(presence_router: PFSPresenceRouter) -> None:
+    presence_router.local_users = {"@0x01:server", "@0x02:server"}
+    old = UserPresenceState.default("@alice:server")
+    new = old.copy_and_replace(state="online")
+    other = UserPresenceState.default("@bob:server")
+    destinations = asyncio.run(presence_router.get_users_for_states([old, other, new]))
+    assert destinations == {
+        "@0x01:server": {new, other},
+        "@0x02:server": {new, other},
+    }
+    assert destinations["@0x01:server"] is destinations["@0x02:server"]
+
+    presence_router.local_users = set()
+    assert asyncio.run(presence_router.get_users_for_states([old])) == {}
+
+
+def test_get_users_for_states_coalesced(presence_router: PFSPresenceRouter) -> None:
+    presence_router.local_users = {"@0x01:server", "@0x02:server"}
+    clock = MagicMock()
+    clock.time.return_value = 100.0
+    notify = MagicMock()
+    presence_router.presence_coalescer = PresenceCoalescer(notify, clock, window=1)
+    online = UserPresenceState.default("@alice:server").copy_and_replace(state="online")
+    offline = online.copy_and_replace(state="offline")
+
+    # the first change is routed right away
+    destinations = asyncio.run(presence_router.get_users_for_states([online]))
+    assert set(destinations) == presence_router.local_users
+
+    # changes within the window only wake up the service users at its end
+    destinations = asyncio.run(presence_router.get_users_for_states([offline]))
+    assert set(destinations) == set()
+    assert clock.call_later.call_count == 1
+    # ... but a syncing service user still reads them
+    assert destinations["@0x01:server"] == {offline}
+    with pytest.raises(KeyError):
+        destinations["@alice:server"]  # pylint: disable=pointless-statement
+
+    # unchanged states are never routed
+    clock.time.return_value = 200.0
+    destinations = asyncio.run(
+        presence_router.get_users_for_states([offline.copy_and_replace(last_active_ts=1)])
+    )
+    assert set(destinations) == set()
+    notify.assert_not_called()
+
+
+def test_notify_local_users(presence_router: PFSPresenceRouter) -> None:
+    # fails if the Synapse internals used to wake up the service users change
+    hs = presence_router._module_api._hs
+    assert HomeServer.get_notifier and HomeServer.get_datastore
+    hs.get_notifier.return_value = create_autospec(Notifier, instance=True)
+    hs.get_datastore.return_value = create_autospec(DataStore, instance=True)
+    hs.get_datastore().get_current_presence_token.return_value = 7
+
+    presence_router.local_users = set()
+    presence_router._notify_local_users()
+    hs.get_notifier().on_new_event.assert_not_called()
+
+    presence_router.local_users = {"@0x01:server"}
+    presence_router._notify_local_users()
+    hs.get_notifier().on_new_event.assert_called_once_with(
+        "presence_key", 7, users=["@0x01:server"]
+    )
+
+
+def test_get_interested_users(presence_router: PFSPresenceRouter) -> None:
+    address = next(iter(presence_router.registered_services))
+    user_id = presence_router.to_local_user(address)
+    assert user_id is not None
+    assert asyncio.run(presence_router.get_interested_users(user_id)) == "ALL"
+    assert asyncio.run(presence_router.get_interested_users("@someone:server")) == set()
+
+    presence_router.on_registered_service(address, 0)
+    presence_router.expire_services(1)
+    assert asyncio.run(presence_router.get_interested_users(user_id)) == set()
+
+
+def test_to_local_user(presence_router: PFSPresenceRouter) -> None:
+    address = "0x1234567890AbcdEF1234567890aBcdef12345678"
+    get_qualified_user_id = presence_router._module_api.get_qualified_user_id
+    get_qualified_user_id.reset_mock()
+    user_id = "@0x1234567890abcdef1234567890abcdef12345678:server"
+    assert presence_router.to_local_user(address) == user_id  # type: ignore
+    assert presence_router.to_local_user(to_canonical_address(address)) == user_id
+    assert get_qualified_user_id.call_count == 1
+
+
+@pytest.mark.parametrize("number_of_services", [2])
+def test_introspection_status(presence_router: PFSPresenceRouter) -> None:
+    status = json.loads(json.dumps(STATUS_SOURCES["presence_router"]()))
+    assert status["registered_services"] == {
+        to_checksum_address(address): valid_till
+        for address, valid_till in presence_router.registered_services.items()
+    }
+    assert len(status["registered_services"]) == 2
+    assert status["next_expiry"] == presence_router.next_expiry
+    assert status["last_block"]["number"] == presence_router.last_block[0]
+    assert status["sync_lag_seconds"] >= 0
+
+
+def test_get_users_for_states_shared_set(presence_router: PFSPresenceRouter) -> None:
+    """50k updates fanned out to 200 services are stored once, not once per destination."""
+    presence_router.local_users = {f"@0x{i:040x}:server" for i in range(200)}
+    states = [UserPresenceState.default(f"@user{i}:server") for i in range(50_000)]
+
+    destinations = asyncio.run(presence_router.get_users_for_states(states))
+
+    assert destinations == {user: set(states) for user in presence_router.local_users}
+    assert len({id(routed) for routed in destinations.values()}) == 1
+
+
+def make_presence_router(
+    web3: Web3, service_registry: Contract, worker_name: Optional[str] = None, **config: Any
+) -> PFSPresenceRouter:
+    router_config = PFSPresenceRouter.parse_config(
+        {
+            "service_registry_address": f"{service_registry.address}",
+            "ethereum_rpc": "http://foo.bar",
+            **config,
+        }
+    )
+    module_api = MagicMock()
+    module_api._hs.config.worker_name = worker_name
+    module_api.get_qualified_user_id.side_effect = lambda localpart: f"@{localpart}:server"
+    with patch(
+        "raiden_synapse_modules.presence_router.pfs.PFSPresenceRouter.setup_web3",
+        return_value=web3,
+    ):
+        return PFSPresenceRouter(router_config, module_api)
+
+
+@pytest.mark.parametrize("number_of_services", [2])
+def test_registry_checkpoint(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    custom_token: Contract,
+    get_accounts: Callable,
+    tmp_path: Path,
+) -> None:
+    checkpoint_path = tmp_path / "registry.json"
+    router = make_presence_router(
+        web3, service_registry_with_deposits, registry_checkpoint_path=str(checkpoint_path)
+    )
+    assert len(router.registered_services) == 2
+    checkpoint = load_checkpoint(checkpoint_path)
+    assert checkpoint is not None
+    assert checkpoint.block_number == web3.eth.block_number
+    assert checkpoint.services == router.registered_services
+
+    # a restart only replays the events since the checkpoint
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    with patch.object(
+        blockchain_support,
+        "read_initial_services_addresses",
+        side_effect=AssertionError("Unexpected full rescan"),
+    ):
+        router = make_presence_router(
+            web3, service_registry_with_deposits, registry_checkpoint_path=str(checkpoint_path)
+        )
+    assert len(router.registered_services) == 2
+    router._setup_filters()
+    router._check_filters_once()
+    assert len(router.registered_services) == 3
+    assert account in router.registered_services
+    checkpoint = load_checkpoint(checkpoint_path)
+    assert checkpoint is not None
+    assert checkpoint.services == router.registered_services
+
+
+@pytest.mark.parametrize("number_of_services", [1])
+def test_registry_checkpoint_throttle(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    ethereum_tester: EthereumTester,
+    tmp_path: Path,
+) -> None:
+    checkpoint_path = tmp_path / "registry.json"
+    router = make_presence_router(
+        web3, service_registry_with_deposits, registry_checkpoint_path=str(checkpoint_path)
+    )
+    router._reactor.addSystemEventTrigger.assert_called_once_with(
+        "before", "shutdown", router.save_checkpoint
+    )
+    saved_block = router.last_block[0]
+
+    # new blocks without registry changes don't rewrite the checkpoint every time
+    with patch.object(router, "save_checkpoint", wraps=router.save_checkpoint) as save:
+        for _ in range(3):
+            ethereum_tester.mine_blocks(1)
+            router._apply_chain_update(
+                ChainUpdate(block=web3.eth.getBlock("latest"), registered_services=[])
+            )
+        assert save.call_count == 0
+        checkpoint = load_checkpoint(checkpoint_path)
+        assert checkpoint is not None and checkpoint.block_number == saved_block
+
+        # but once the interval passed
+        router._checkpoint_saved_at -= pfs.CHECKPOINT_INTERVAL_SECONDS
+        ethereum_tester.mine_blocks(1)
+        router._apply_chain_update(
+            ChainUpdate(block=web3.eth.getBlock("latest"), registered_services=[])
+        )
+        assert save.call_count == 1
+
+        # registry changes are published right away
+        expired = next(iter(router.registered_services))
+        router.on_registered_service(expired, 0)
+        ethereum_tester.mine_blocks(1)
+        router._apply_chain_update(
+            ChainUpdate(block=web3.eth.getBlock("latest"), registered_services=[])
+        )
+        assert save.call_count == 2
+    checkpoint = load_checkpoint(checkpoint_path)
+    assert checkpoint is not None
+    assert checkpoint.block_number == web3.eth.block_number
+    assert checkpoint.services == {}
+
+
+@pytest.mark.parametrize("number_of_services", [1])
+def test_registry_checkpoint_rescan_on_fork(
+    web3: Web3, service_registry_with_deposits: Contract, tmp_path: Path
+) -> None:
+    checkpoint_path = tmp_path / "registry.json"
+    router = make_presence_router(
+        web3, service_registry_with_deposits, registry_checkpoint_path=str(checkpoint_path)
+    )
+    checkpoint = load_checkpoint(checkpoint_path)
+    assert checkpoint is not None
+
+    forked = replace(checkpoint, block_hash=encode_hex(b"\x01" * 32), registered_services={})
+    save_checkpoint(checkpoint_path, forked)
+    router = make_presence_router(
+        web3, service_registry_with_deposits, registry_checkpoint_path=str(checkpoint_path)
+    )
+    assert len(router.registered_services) == 1
+
+    other_chain = replace(checkpoint, chain_id=checkpoint.chain_id + 1, registered_services={})
+    save_checkpoint(checkpoint_path, other_chain)
+    router = make_presence_router(
+        web3, service_registry_with_deposits, registry_checkpoint_path=str(checkpoint_path)
+    )
+    assert len(router.registered_services) == 1
+
+
+@pytest.mark.parametrize("number_of_services", [2])
+def test_chain_sync_follower(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    custom_token: Contract,
+    get_accounts: Callable,
+    tmp_path: Path,
+) -> None:
+    checkpoint_path = str(tmp_path / "registry.json")
+    with patch(
+        "raiden_synapse_modules.presence_router.pfs.PFSPresenceRouter.setup_web3",
+        side_effect=AssertionError("Unexpected ethereum connection"),
+    ):
+        follower = make_presence_router(
+            web3,
+            service_registry_with_deposits,
+            worker_name="generic",
+            registry_checkpoint_path=checkpoint_path,
+        )
+    assert not follower.is_chain_sync_owner
+    assert follower.registered_services == {}
+
+    owner = make_presence_router(
+        web3, service_registry_with_deposits, registry_checkpoint_path=checkpoint_path
+    )
+    assert owner.is_chain_sync_owner
+    follower.follow_checkpoint()
+    assert follower.registered_services == owner.registered_services
+    assert follower.local_users == owner.local_users
+
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    owner._setup_filters()
+    owner._check_filters_once()
+    # expire one of the services on the owner only
+    expired = next(iter(owner.registered_services))
+    owner.on_registered_service(expired, 0)
+    owner.expire_services(1)
+    owner.save_checkpoint()
+    follower.follow_checkpoint()
+    assert len(follower.registered_services) == 2
+    assert follower.registered_services == owner.registered_services
+    assert follower.local_users == owner.local_users
+    assert expired not in follower.registered_services
+
+
+FOLLOWER_STARTUP = """
+import sys
+from unittest.mock import MagicMock
+
+import synapse.module_api
+
+# Synapse itself loads some of them (e.g. `requests` for `treq`)
+preloaded = set(sys.modules)
+from raiden_synapse_modules.presence_router.pfs import PFSPresenceRouter
+
+config = PFSPresenceRouter.parse_config(
+    {
+        "service_registry_address": "0x" + "00" * 20,
+        "ethereum_rpc": "http://foo.bar",
+        "registry_checkpoint_path": sys.argv[1],
+    }
+)
+module_api = MagicMock()
+module_api._hs.config.worker_name = "generic"
+PFSPresenceRouter(config, module_api)
+
+heavy = {"web3", "raiden_contracts", "requests", "websockets"}
+print(sorted(heavy & (sys.modules.keys() - preloaded)))
+"""
+
+
+def test_chain_sync_follower_startup(tmp_path: Path) -> None:
+    """Followers never talk to the ethereum node, so they don't import web3 and the
+    contracts. Runs in a fresh interpreter, as this one imported them already."""
+    result = subprocess.run(
+        [sys.executable, "-c", FOLLOWER_STARTUP, str(tmp_path / "registry.json")],
+        capture_output=True,
+        check=True,
+        cwd=Path(__file__).parents[1],
+        text=True,
+    )
+    assert result.stdout.strip() == "[]"
+
+
+@pytest.mark.parametrize("number_of_services", [1])
+def test_reorg_rollback(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    custom_token: Contract,
+    get_accounts: Callable,
+    ethereum_tester: EthereumTester,
+) -> None:
+    router = make_presence_router(web3, service_registry_with_deposits)
+    router._setup_filters()
+    (service,) = router.registered_services
+    timestamp = web3.eth.get_block("latest")["timestamp"]
+    router.on_registered_service(service, timestamp + 1000)
+    ethereum_tester.mine_blocks(1)
+    router._check_filters_once()
+    snapshot = ethereum_tester.take_snapshot()
+
+    # a registration and an expiry in blocks that get orphaned
+    orphaned = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, orphaned)
+    ethereum_tester.time_travel(timestamp + 2000)
+    ethereum_tester.mine_blocks(1)
+    router._check_filters_once()
+    assert orphaned in router.registered_services
+    assert service not in router.registered_services
+
+    # a longer fork replaces them
+    ethereum_tester.revert_to_snapshot(snapshot)
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    ethereum_tester.mine_blocks(5)
+    reorgs = REGISTRY.get_sample_value("raiden_presence_router_chain_reorgs_total")
+    with patch.object(
+        blockchain_support,
+        "read_initial_services_addresses",
+        side_effect=AssertionError("Unexpected full rescan"),
+    ):
+        router._check_filters_once()
+    assert router.registered_services == {
+        service: timestamp + 1000,
+        account: router.registered_services[account],
+    }
+    assert router.to_local_user(orphaned) not in router.local_users
+    assert router.to_local_user(service) in router.local_users
+    latest = web3.eth.get_block("latest")
+    assert router.last_block == (latest["number"], HexBytes(latest["hash"]))
+    assert REGISTRY.get_sample_value("raiden_presence_router_chain_reorgs_total") == reorgs + 1
+
+
+@pytest.mark.parametrize("number_of_services", [1])
+def test_block_confirmations(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    custom_token: Contract,
+    get_accounts: Callable,
+    ethereum_tester: EthereumTester,
+) -> None:
+    router = make_presence_router(web3, service_registry_with_deposits, block_confirmations=3)
+    router._setup_filters()
+    snapshot = ethereum_tester.take_snapshot()
+
+    # unconfirmed events wait, and are dropped if their block gets orphaned
+    orphaned = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, orphaned)
+    router._check_filters_once()
+    assert orphaned not in router.registered_services
+    assert len(router.chain_history.pending) == 1
+
+    ethereum_tester.revert_to_snapshot(snapshot)
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    router._check_filters_once()
+    assert account not in router.registered_services
+    ethereum_tester.mine_blocks(3)
+    router._check_filters_once()
+    assert account in router.registered_services
+    assert orphaned not in router.registered_services
+    assert router.chain_history.pending == {}
+    assert router.last_block[0] <= web3.eth.block_number - 3
+
+
+def apply_subscription_updates(router: PFSPresenceRouter, count: int) -> List[ChainUpdate]:
+    """Wait for `count` updates handed to the (mocked) reactor and apply them."""
+    call_from_thread = router._reactor.callFromThread
+    deadline = time.time() + 10
+    while call_from_thread.call_count < count:
+        assert time.time() < deadline, "Timeout waiting for subscription updates"
+        time.sleep(0.01)
+    calls = [call.args for call in call_from_thread.call_args_list]
+    call_from_thread.reset_mock()
+
+    async def defer_to_thread(_reactor: Any, f: Callable, *args: Any) -> Any:
+        return f(*args)
+
+    with patch.object(pfs, "defer_to_thread", defer_to_thread):
+        for function, *args in calls:
+            function(*args)
+    return [args[0] for _, *args in calls]
+
+
+@pytest.mark.parametrize("number_of_services", [1])
+@patch("raiden_synapse_modules.presence_router.subscription.RECONNECT_DELAY_MIN", 0.01)
+def test_ws_subscription(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    custom_token: Contract,
+    get_accounts: Callable,
+    fake_ws_rpc: FakeWSServer,
+) -> None:
+    router = make_presence_router(
+        web3, service_registry_with_deposits, ethereum_ws_rpc=fake_ws_rpc.url, log_chunk_size=2
+    )
+    assert router.subscription is not None
+    # nothing to backfill on the first connect, the registry was just read
+    (update,) = apply_subscription_updates(router, 1)
+    assert update.block is not None and update.registered_services == []
+    assert fake_ws_rpc.rpc_calls == ["eth_subscribe", "eth_subscribe", "eth_getBlockByNumber"]
+    assert {kind for _, kind in fake_ws_rpc.subscriptions.values()} == {"newHeads", "logs"}
+
+    # notifications are applied as they arrive
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    block_number = web3.eth.block_number
+    log_filter = router.subscription._log_filter
+    (raw_log,) = web3.eth.get_logs(cast(FilterParams, {**log_filter, "fromBlock": block_number}))
+    fake_ws_rpc.notify("logs", json.loads(Web3.toJSON(raw_log)))
+    fake_ws_rpc.notify("newHeads", json.loads(Web3.toJSON(web3.eth.get_block("latest"))))
+    apply_subscription_updates(router, 2)
+    assert account in router.registered_services
+    assert router.last_block[0] == block_number
+
+    # events that were never notified are backfilled after reconnecting
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    backfill_from = router.last_block[0] + 1
+    with patch.object(web3.eth, "get_logs", wraps=web3.eth.get_logs) as get_logs:
+        fake_ws_rpc.drop_connections()
+        (update,) = apply_subscription_updates(router, 1)
+    assert [event["args"]["service"] for event in update.registered_services] == [account]
+    assert account in router.registered_services
+    assert router.last_block[0] == web3.eth.block_number
+    # fetched in chunks of `log_chunk_size` blocks
+    ranges = [(call.args[0]["fromBlock"], call.args[0]["toBlock"]) for call in get_logs.mock_calls]
+    assert ranges[0][0] == backfill_from and max(end for _, end in ranges) == web3.eth.block_number
+    assert len(ranges) > 1 and all(end - start <= 1 for start, end in ranges)
+    assert len(router.registered_services) == 3
+
+    # a log removed by a reorg rolls back everything from its block on
+    (raw_log,) = web3.eth.get_logs(cast(FilterParams, {**log_filter, "fromBlock": "latest"}))
+    fake_ws_rpc.notify("logs", {**json.loads(Web3.toJSON(raw_log)), "removed": True})
+    apply_subscription_updates(router, 1)
+    assert account not in router.registered_services
+    assert router.last_block[0] < web3.eth.block_number
+
+    router._reactor.addSystemEventTrigger.assert_any_call(
+        "before", "shutdown", router.subscription.stop
+    )
+    router.subscription.stop()
+    assert not router.subscription._thread.is_alive()
+    assert not router.subscription.connected.is_set()
+    deadline = time.time() + 10
+    while fake_ws_rpc.connections:
+        assert time.time() < deadline, "Timeout waiting for the connection to close"
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("number_of_services", [1])
+@patch("raiden_synapse_modules.presence_router.subscription.RECONNECT_DELAY_MIN", 0.01)
+def test_ws_reconnect_reorg(
+    web3: Web3,
+    service_registry_with_deposits: Contract,
+    custom_token: Contract,
+    get_accounts: Callable,
+    ethereum_tester: EthereumTester,
+    fake_ws_rpc: FakeWSServer,
+) -> None:
+    router = make_presence_router(
+        web3, service_registry_with_deposits, ethereum_ws_rpc=fake_ws_rpc.url
+    )
+    assert router.subscription is not None
+    apply_subscription_updates(router, 1)
+    snapshot = ethereum_tester.take_snapshot()
+
+    orphaned = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, orphaned)
+    log_filter = cast(FilterParams, {**router.subscription._log_filter, "fromBlock": "latest"})
+    (raw_log,) = web3.eth.get_logs(log_filter)
+    fake_ws_rpc.notify("logs", json.loads(Web3.toJSON(raw_log)))
+    fake_ws_rpc.notify("newHeads", json.loads(Web3.toJSON(web3.eth.get_block("latest"))))
+    apply_subscription_updates(router, 2)
+    assert orphaned in router.registered_services
+
+    # a longer fork replaces the block while disconnected, no removed log is ever notified
+    ethereum_tester.revert_to_snapshot(snapshot)
+    account = get_accounts(1)[0]
+    register_service(service_registry_with_deposits, custom_token, account)
+    ethereum_tester.mine_blocks(5)
+    reorgs = REGISTRY.get_sample_value("raiden_presence_router_chain_reorgs_total")
+    fake_ws_rpc.drop_connections()
+    apply_subscription_updates(router, 1)
+    assert orphaned not in router.registered_services
+    assert account in router.registered_services
+    latest = web3.eth.get_block("latest")
+    assert router.last_block == (latest["number"], HexBytes(latest["hash"]))
+    assert REGISTRY.get_sample_value("raiden_presence_router_chain_reorgs_total") == reorgs + 1
+    assert router._held_updates is None
+
+
+def test_subscription_updates_held_during_reorg_check(
+    presence_router: PFSPresenceRouter,
+) -> None:
+    """Updates arriving while the reorg check after a reconnect runs are applied after it."""
+    block = {"number": 10, "hash": HexBytes("0x10"), "timestamp": 1}
+    presence_router.chain_history.add_block(cast(Any, block))
+    applied: List[ChainUpdate] = []
+    with patch.object(presence_router, "_apply_chain_update", applied.append), patch.object(
+        pfs, "run_in_background"
+    ) as run_in_background:
+        reconnect = ChainUpdate(block=cast(Any, {**block, "number": 12}), registered_services=[])
+        later = ChainUpdate(block=cast(Any, {**block, "number": 13}), registered_services=[])
+        presence_router._apply_subscription_update(reconnect, True)
+        presence_router._apply_subscription_update(later, False)
+        assert applied == []
+        run_in_background.assert_called_once_with(
+            presence_router._check_reorg_and_apply, reconnect
+        )
+    assert presence_router._held_updates == [(later, False)]
+
+    async def defer_to_thread(_reactor: Any, f: Callable, *args: Any) -> Any:
+        return f(*args)
+
+    with patch.object(presence_router, "_apply_chain_update", applied.append), patch.object(
+        presence_router, "_check_reorg"
+    ) as check_reorg, patch.object(pfs, "defer_to_thread", defer_to_thread):
+        asyncio.run(presence_router._check_reorg_and_apply(reconnect))
+    check_reorg.assert_called_once_with(reconnect)
+    assert applied == [reconnect, later]
+    assert presence_router._held_updates is None
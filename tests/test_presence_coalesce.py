@@ -0,0 +1,127 @@
+import random
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from prometheus_client import REGISTRY
+from synapse.handlers.presence import UserPresenceState
+
+from raiden_synapse_modules.presence_router.presence_coalesce import PresenceCoalescer
+
+
+class FakeClock:
+    """Synapse `Clock` on virtual time, which only moves forward in `advance`."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.calls: List[Tuple[float, int, Callable, Tuple]] = []
+
+    def time(self) -> float:
+        return self.now
+
+    def call_later(self, delay: float, callback: Callable, *args: Any) -> None:
+        self.calls.append((self.now + delay, len(self.calls), callback, args))
+
+    def advance(self, seconds: float) -> None:
+        end = self.now + seconds
+        while True:
+            due = [call for call in self.calls if call[0] <= end]
+            if not due:
+                break
+            call = min(due)
+            self.calls.remove(call)
+            self.now = call[0]
+            call[2](*call[3])
+        self.now = end
+
+
+class ServiceUser:
+    """Syncs like Synapse: when woken up, it reads the current state of every user that
+    changed since its last sync."""
+
+    def __init__(self, current: Dict[str, UserPresenceState]) -> None:
+        self.current = current
+        self.changed: Set[str] = set()
+        self.view: Dict[str, str] = {}
+        self.syncs = 0
+
+    def sync(self) -> None:
+        self.syncs += 1
+        for user_id in self.changed:
+            self.view[user_id] = self.current[user_id].state
+        self.changed.clear()
+
+
+def simulate(window: Optional[float]) -> Tuple[ServiceUser, Dict[str, UserPresenceState]]:
+    """100 nodes flapping online and offline for a minute, 1000 updates in total."""
+    rng = random.Random(42)
+    clock = FakeClock()
+    current: Dict[str, UserPresenceState] = {}
+    service = ServiceUser(current)
+    coalescer = None if window is None else PresenceCoalescer(service.sync, clock, window)
+    for timestamp in sorted(rng.uniform(0, 60) for _ in range(1000)):
+        clock.advance(timestamp - clock.now)
+        user_id = f"@0x{rng.randrange(100):040x}:server"
+        state = current.get(user_id, UserPresenceState.default(user_id))
+        if rng.random() < 0.5:
+            # a bumped `last_active_ts` only
+            state = state.copy_and_replace(last_active_ts=int(timestamp * 1000))
+        else:
+            state = state.copy_and_replace(
+                state="offline" if state.state == "online" else "online"
+            )
+        current[user_id] = state
+        service.changed.add(user_id)
+        if coalescer is None or coalescer.notify_now([state]):
+            service.sync()
+    clock.advance(3600)
+    return service, current
+
+
+def test_presence_coalescer() -> None:
+    clock = FakeClock()
+    notifications: List[float] = []
+    coalescer = PresenceCoalescer(lambda: notifications.append(clock.now), clock, window=1)
+    online = UserPresenceState.default("@alice:server").copy_and_replace(state="online")
+    offline = online.copy_and_replace(state="offline")
+    noops = REGISTRY.get_sample_value("raiden_presence_router_presence_noop_updates_total")
+
+    assert coalescer.notify_now([online])
+    assert not coalescer.notify_now([online.copy_and_replace(last_active_ts=1)])
+    clock.advance(0.5)
+    assert not coalescer.notify_now([offline])
+    assert not coalescer.notify_now([online])
+    assert notifications == []
+    clock.advance(0.5)
+    assert notifications == [1.0]
+    assert not coalescer.notify_now([online.copy_and_replace(status_msg="away")])
+    clock.advance(5)
+    assert notifications == [1.0, 2.0]
+    assert coalescer.notify_now([offline])
+    assert REGISTRY.get_sample_value("raiden_presence_router_presence_noop_updates_total") == (
+        noops + 1
+    )
+
+
+def test_presence_coalescer_remembers_bounded_states() -> None:
+    clock = FakeClock()
+    coalescer = PresenceCoalescer(lambda: None, clock, window=0, max_users=2)
+    states = [
+        UserPresenceState.default(f"@{name}:server").copy_and_replace(state="online")
+        for name in ("alice", "bob", "carol")
+    ]
+    assert coalescer.changed_states(states[:2]) == 2
+    # alice was updated last, so bob is forgotten first
+    assert coalescer.changed_states([states[0], states[2]]) == 1
+    assert list(coalescer.last_states) == ["@alice:server", "@carol:server"]
+    assert coalescer.changed_states(states) == 1
+
+
+def test_presence_coalescer_flapping_nodes() -> None:
+    immediate, current = simulate(window=None)
+    coalesced, _ = simulate(window=2)
+
+    expected = {user_id: state.state for user_id, state in current.items()}
+    assert immediate.view == expected
+    assert coalesced.view == expected
+    # every update syncs without coalescing, at most one sync per window with it
+    assert immediate.syncs == 1000
+    assert coalesced.syncs <= 60 / 2 + 1
@@ -0,0 +1,145 @@
+import asyncio
+import random
+from collections import Counter
+from typing import Any, Callable, Iterator, List, Tuple
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from raiden_synapse_modules.presence_router.presence_push import PresencePusher
+
+
+class FakeClock:
+    """Synapse `Clock` on virtual time, which only moves forward in `advance`."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.calls: List[Tuple[float, int, Callable, Tuple]] = []
+
+    def call_later(self, delay: float, callback: Callable, *args: Any) -> None:
+        self.calls.append((self.now + delay, len(self.calls), callback, args))
+
+    async def sleep(self, seconds: float) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self.call_later(seconds, future.set_result, None)
+        await future
+
+    async def advance(self, seconds: float) -> None:
+        end = self.now + seconds
+        while True:
+            for _ in range(10):
+                await asyncio.sleep(0)
+            due = [call for call in self.calls if call[0] <= end]
+            if not due:
+                break
+            call = min(due)
+            self.calls.remove(call)
+            self.now = call[0]
+            call[2](*call[3])
+        self.now = end
+
+
+class FakeModuleApi:
+    """Records which users got the presences of `online_users` users at what time."""
+
+    def __init__(self, clock: FakeClock, online_users: int) -> None:
+        self.clock = clock
+        self.online_users = online_users
+        self.pushes: List[Tuple[float, List[str]]] = []
+
+    async def send_local_online_presence_to(self, users: List[str]) -> None:
+        self.pushes.append((self.clock.now, list(users)))
+
+    def peak_states_per_second(self) -> int:
+        per_second: Counter = Counter()
+        for timestamp, users in self.pushes:
+            per_second[int(timestamp)] += self.online_users * len(users)
+        return max(per_second.values())
+
+
+@pytest.fixture(autouse=True)
+def run_in_asyncio() -> Iterator[None]:
+    with patch(
+        "raiden_synapse_modules.presence_router.presence_push.run_in_background",
+        side_effect=lambda f, *args: asyncio.ensure_future(f(*args)),
+    ):
+        yield
+
+
+def test_presence_push() -> None:
+    clock = FakeClock()
+    module_api = FakeModuleApi(clock, online_users=1)
+    pusher = PresencePusher(
+        module_api.send_local_online_presence_to,
+        clock,
+        window=1,
+        page_size=2,
+        pages_per_second=2,
+    )
+    pushes = REGISTRY.get_sample_value("raiden_presence_router_presence_pushes_total")
+
+    async def run() -> None:
+        # services scheduled within the window share one push
+        pusher.schedule(["@a:server", "@b:server", "@c:server"])
+        await clock.advance(0.5)
+        pusher.schedule(["@a:server", "@d:server"])
+        assert module_api.pushes == []
+        await clock.advance(0.5)
+        assert module_api.pushes == [(1.0, ["@a:server", "@b:server"])]
+        assert pusher.is_pushing
+
+        # services scheduled during a push are appended to it
+        pusher.schedule(["@e:server"])
+        await clock.advance(10)
+        assert module_api.pushes[1:] == [
+            (1.5, ["@c:server", "@d:server"]),
+            (2.0, ["@e:server"]),
+        ]
+        assert not pusher.is_pushing and not pusher.pending
+
+    asyncio.run(run())
+    assert REGISTRY.get_sample_value("raiden_presence_router_presence_pushes_total") == (
+        pushes + 1
+    )
+    assert REGISTRY.get_sample_value("raiden_presence_router_presence_push_pending_users") == 0
+
+
+def test_presence_push_registration_burst() -> None:
+    """500 services registering within 10 seconds while 20k users are online, compared to
+    pushing to every service right away."""
+    rng = random.Random(42)
+    registrations = sorted((rng.uniform(0, 10), f"@0x{i:040x}:server") for i in range(500))
+
+    async def run(pusher_factory: Callable[[FakeClock, FakeModuleApi], Any]) -> FakeModuleApi:
+        clock = FakeClock()
+        module_api = FakeModuleApi(clock, online_users=20_000)
+        schedule = pusher_factory(clock, module_api)
+        for timestamp, user in registrations:
+            await clock.advance(timestamp - clock.now)
+            schedule([user])
+        await clock.advance(3600)
+        return module_api
+
+    def immediately(clock: FakeClock, module_api: FakeModuleApi) -> Any:
+        return lambda users: asyncio.ensure_future(module_api.send_local_online_presence_to(users))
+
+    def paced(clock: FakeClock, module_api: FakeModuleApi) -> Any:
+        return PresencePusher(
+            module_api.send_local_online_presence_to, clock, page_size=10, pages_per_second=2
+        ).schedule
+
+    burst = asyncio.run(run(immediately))
+    streamed = asyncio.run(run(paced))
+
+    assert sorted(user for _, users in burst.pushes for user in users) == sorted(
+        user for _, users in streamed.pushes for user in users
+    )
+    assert len(burst.pushes) == 500
+    # full pages of 10 services, at most one every half second
+    assert len(streamed.pushes) == 50
+    assert all(len(users) == 10 for _, users in streamed.pushes)
+    timestamps = [timestamp for timestamp, _ in streamed.pushes]
+    assert all(later - earlier >= 0.5 for earlier, later in zip(timestamps, timestamps[1:]))
+    assert streamed.peak_states_per_second() <= 20_000 * 10 * 2
+    assert streamed.peak_states_per_second() < burst.peak_states_per_second()
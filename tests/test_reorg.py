@@ -0,0 +1,133 @@
+from typing import Dict, List, cast
+
+import pytest
+from eth_typing import Address
+from hexbytes import HexBytes
+from web3.types import BlockData, EventData
+
+from raiden_synapse_modules.presence_router.reorg import ChainHistory, DeepReorgError
+
+
+def make_address(index: int) -> Address:
+    return Address(index.to_bytes(20, "big"))
+
+
+def make_chain(start: int, end: int, fork: int = 0, parent: bytes = b"") -> List[BlockData]:
+    """Headers of blocks `start` to `end`, `fork` tells chains at the same height apart."""
+    blocks = []
+    for number in range(start, end + 1):
+        block_hash = HexBytes(bytes([fork, number]) * 16)
+        header = {
+            "number": number,
+            "hash": block_hash,
+            "parentHash": parent,
+            "timestamp": 10 * number,
+        }
+        blocks.append(cast(BlockData, header))
+        parent = block_hash
+    return blocks
+
+
+def make_event(block: BlockData, log_index: int = 0) -> EventData:
+    return cast(
+        EventData,
+        {"blockNumber": block["number"], "blockHash": block["hash"], "logIndex": log_index},
+    )
+
+
+def test_chain_history_fork() -> None:
+    history = ChainHistory(size=4)
+    chain = make_chain(1, 6)
+    for block in chain[:3]:
+        assert history.find_fork(block) is None
+        history.add_block(block)
+
+    # a competing block at the same height, and a longer fork built on block 2
+    uncle = make_chain(3, 3, fork=1, parent=chain[1]["hash"])[0]
+    assert history.find_fork(uncle) == 2
+    fork = make_chain(3, 5, fork=1, parent=chain[1]["hash"])
+    # after a gap, the recorded blocks are checked with the node
+    assert history.find_fork(fork[-1]) is None
+    canonical: Dict[int, HexBytes] = {block["number"]: block["hash"] for block in chain[:2] + fork}
+    assert history.find_fork(fork[-1], canonical_hash=canonical.__getitem__) == 2
+    canonical = {block["number"]: block["hash"] for block in chain}
+    assert history.find_fork(chain[-1], canonical_hash=canonical.__getitem__) is None
+
+    for block in chain[3:]:
+        history.add_block(block)
+    assert [record.number for record in history.blocks] == [3, 4, 5, 6]
+    with pytest.raises(DeepReorgError):
+        history.find_fork(make_chain(7, 7, fork=2)[0], canonical_hash=lambda number: HexBytes(b""))
+
+
+def test_chain_history_roll_back() -> None:
+    history = ChainHistory(size=3)
+    chain = make_chain(1, 5)
+    for block in chain[:3]:
+        history.add_block(block)
+    history.record(2, make_address(1), None, 20)
+    history.record(3, make_address(2), 10, 30)
+    history.record(3, make_address(1), 20, 40)
+    history.add_events([make_event(chain[2])])
+
+    # changes are reverted newest first, events of orphaned blocks are dropped
+    assert history.roll_back(2) == [(make_address(1), 20), (make_address(2), 10)]
+    assert history.head is not None and history.head.number == 2
+    assert history.pending == {}
+
+    # changes older than the recorded blocks are final
+    for block in chain[2:]:
+        history.add_block(block)
+    assert [record.number for record in history.blocks] == [3, 4, 5]
+    assert list(history.changes) == []
+
+
+def test_chain_history_roll_back_out_of_order() -> None:
+    history = ChainHistory()
+    for block in make_chain(1, 5):
+        history.add_block(block)
+    # an expiry at the confirmed block, then a late event of an older block
+    history.record(4, make_address(1), 10, None)
+    history.record(3, make_address(1), None, 20)
+    history.record(5, make_address(2), None, 30)
+
+    # the expiry is reverted, the older event applied again on top of the state before it
+    assert history.roll_back(3) == [
+        (make_address(2), None),
+        (make_address(1), None),
+        (make_address(1), 10),
+        (make_address(1), 20),
+    ]
+    assert list(history.changes) == [(3, make_address(1), 10, 20)]
+    assert history.roll_back(2) == [(make_address(1), 10)]
+
+    # old changes are pruned by block number, wherever they are in the journal
+    history.record(3, make_address(1), None, 20)
+    history.record(2, make_address(2), None, 30)
+    for block in make_chain(3, 130):
+        history.add_block(block)
+    assert history.blocks[0].number == 3
+    assert list(history.changes) == [(3, make_address(1), None, 20)]
+
+
+def test_chain_history_confirmations() -> None:
+    history = ChainHistory(confirmations=2)
+    chain = make_chain(1, 5)
+    history.add_events([make_event(chain[1], 1), make_event(chain[1]), make_event(chain[1])])
+    assert history.pop_confirmed() == []
+
+    history.add_block(chain[2])
+    assert history.pop_confirmed() == []
+    assert history.confirmed_block() is None
+    history.add_block(chain[3])
+    assert history.pop_confirmed() == [make_event(chain[1]), make_event(chain[1], 1)]
+    assert history.pending == {}
+    # only recorded blocks can be confirmed
+    assert history.confirmed_block() is None
+    history.add_block(chain[4])
+    confirmed = history.confirmed_block()
+    assert confirmed is not None and confirmed.number == 3
+
+    history.confirmations = 0
+    history.add_events([make_event(chain[4])])
+    assert history.pop_confirmed() == [make_event(chain[4])]
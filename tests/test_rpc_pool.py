@@ -0,0 +1,116 @@
+import time
+
+import pytest
+from conftest import FakeRPCServer, running_fake_rpc
+from prometheus_client import REGISTRY
+from web3 import Web3
+from web3.contract import Contract
+
+from raiden_synapse_modules.presence_router.blockchain_support import (
+    read_initial_services_addresses,
+    setup_contract_from_address,
+)
+from raiden_synapse_modules.presence_router.rpc_pool import RPCPool
+
+# Nothing listens there, connections are refused right away
+DEAD_ENDPOINT = "http://127.0.0.1:1"
+
+
+def test_rpc_pool_failover(web3: Web3, fake_rpc: FakeRPCServer) -> None:
+    pool = RPCPool([DEAD_ENDPOINT, fake_rpc.url])
+    pool_web3 = Web3(pool)
+    assert pool_web3.eth.block_number == web3.eth.block_number
+    dead, alive = pool.endpoints
+    assert dead.failures == 1
+    assert alive.failures == 0 and alive.latency > 0
+    assert pool.ranked() == [alive, dead]
+    assert (
+        REGISTRY.get_sample_value(
+            "raiden_presence_router_rpc_endpoint_up", {"endpoint": dead.label}
+        )
+        == 0
+    )
+    assert dead.label == "0:127.0.0.1"
+
+    # the failing endpoint is skipped until its retry delay passed
+    assert pool_web3.eth.chain_id == web3.eth.chain_id
+    assert dead.failures == 1
+    assert [status["healthy"] for status in pool.status()] == [False, True]
+
+
+def test_rpc_pool_hedging(web3: Web3) -> None:
+    with running_fake_rpc(web3) as slow, running_fake_rpc(web3) as fast:
+        slow.delay = 0.5
+        pool = RPCPool([slow.url, fast.url], hedge_after=0.05)
+        pool_web3 = Web3(pool)
+        hedged = REGISTRY.get_sample_value("raiden_presence_router_rpc_hedged_requests_total")
+
+        start = time.monotonic()
+        assert pool_web3.eth.block_number == web3.eth.block_number
+        assert time.monotonic() - start < 0.4
+        assert (
+            REGISTRY.get_sample_value("raiden_presence_router_rpc_hedged_requests_total")
+            == hedged + 1
+        )
+
+        # once the slow answer arrived, the fast endpoint is preferred
+        time.sleep(0.6)
+        assert pool.ranked()[0] is pool.endpoints[1]
+        slow.rpc_calls.clear()
+        pool_web3.eth.get_block("latest")
+        assert slow.rpc_calls == []
+
+
+def test_rpc_pool_filters_stay_on_their_endpoint(web3: Web3, fake_rpc: FakeRPCServer) -> None:
+    with running_fake_rpc(web3) as other:
+        pool = RPCPool([fake_rpc.url, other.url])
+        pool_web3 = Web3(pool)
+        block_filter = pool_web3.eth.filter("latest")
+        installed_on = fake_rpc if "eth_newBlockFilter" in fake_rpc.rpc_calls else other
+        for _ in range(5):
+            pool_web3.eth.block_number
+            block_filter.get_new_entries()
+        assert installed_on.rpc_calls.count("eth_getFilterChanges") == 5
+
+
+def test_rpc_pool_filters_are_routed_by_id(web3: Web3, fake_rpc: FakeRPCServer) -> None:
+    with running_fake_rpc(web3) as other:
+        pool = RPCPool([fake_rpc.url, other.url])
+        pool_web3 = Web3(pool)
+        first, second = pool.endpoints
+        # the filters are installed on different endpoints
+        second.failures, second.retry_at = 1, float("inf")
+        first_filter = pool_web3.eth.filter("latest")
+        first.failures, first.retry_at = 1, float("inf")
+        second.failures = 0
+        second_filter = pool_web3.eth.filter("latest")
+        assert fake_rpc.rpc_calls.count("eth_newBlockFilter") == 1
+        assert other.rpc_calls.count("eth_newBlockFilter") == 1
+
+        for _ in range(3):
+            first_filter.get_new_entries()
+            second_filter.get_new_entries()
+        assert fake_rpc.rpc_calls.count("eth_getFilterChanges") == 3
+        assert other.rpc_calls.count("eth_getFilterChanges") == 3
+
+        assert pool_web3.eth.uninstall_filter(first_filter.filter_id)
+        assert fake_rpc.rpc_calls.count("eth_uninstallFilter") == 1
+        assert first_filter.filter_id not in pool._filter_endpoints
+        assert second_filter.filter_id in pool._filter_endpoints
+
+
+@pytest.mark.parametrize("number_of_services", [3])
+def test_rpc_pool_batch_request(
+    service_registry_with_deposits: Contract, fake_rpc: FakeRPCServer
+) -> None:
+    pool_web3 = Web3(RPCPool([DEAD_ENDPOINT, fake_rpc.url]))
+    registry = setup_contract_from_address(
+        service_registry_with_deposits.address, pool_web3  # type: ignore
+    )
+    batched = read_initial_services_addresses(registry, "latest", batch_size=10)
+    assert batched == read_initial_services_addresses(service_registry_with_deposits, "latest")
+    assert len(batched) == 3
+    # block pinning, deposits length, deposit addresses, registrations
+    assert fake_rpc.http_requests == 4
+    # batches go through the pool's session of the endpoint
+    assert pool_web3.provider.endpoints[1].failures == 0  # type: ignore